@@ -16,28 +16,467 @@
    limitations under the License.
 """
 
-import argparse, urllib2, gzip, shutil, shlex, subprocess, os.path
+import argparse, urllib2, urlparse, ftplib, httplib, hashlib, json, gzip, shutil, shlex, subprocess, threading, time, re, os.path
 
 from socket import error as SocketError
+from multiprocessing.pool import ThreadPool
 import errno
 
+from compression import decompress_file, threadedreader
+from fastqindex import index_fastq
+from fastqsplitter import fastqsplitter
+from filecache import cache_from_environment
+from enametadata import metadata_from_environment
+from toolrunner import toolrunner
+from genomeindex import indexregistry, index_files, index_prefix, tool_version
+
 try :
     import pysam
 except ImportError :
     print "[Error] Cannot import \"pysam\" package. Have you installed it?"
     exit(-1)
 
+# Number of files that are downloaded at the same time
+DOWNLOAD_THREADS = 4
+
+# Maximum number of connections that are open to a single server at a time,
+# across all of the downloads in the process
+HOST_CONNECTIONS = 4
+
+# Number of byte ranges that a file is split into for a segmented download
+DOWNLOAD_SEGMENTS = 4
+
+# Files smaller than this many bytes per segment are downloaded over a single
+# connection
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+
+# Number of bytes read from a connection at a time by a segment
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of times a failed download, or segment, is restarted
+DOWNLOAD_RETRIES = 5
+
+# Seconds without any data before a connection is treated as failed
+DOWNLOAD_TIMEOUT = 60
+
+# Seconds to wait before the first restart of a download. This doubles for
+# each restart up to DOWNLOAD_BACKOFF_MAX
+DOWNLOAD_BACKOFF = 2
+DOWNLOAD_BACKOFF_MAX = 120
+
+# Suffix of the sidecar file that records the progress of a download. A file
+# with a sidecar has not been completely downloaded.
+DOWNLOAD_STATE_SUFFIX = '.download'
+
+# Minimum number of seconds between saves of the sidecar while the segments
+# are being downloaded
+DOWNLOAD_STATE_INTERVAL = 5
+
+# Number of bytes of a FASTA file that are processed at a time when the
+# headers are rewritten
+FASTA_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Rough peak memory of each indexer as a multiple of the size of the genome
+# FASTA file, used to keep the indexers that are run at the same time within
+# the memory budget
+INDEXER_MEMORY = {'bwa' : 6, 'bowtie' : 4, 'gem' : 8}
+
+# Errors from a dropped or broken connection, after which a download is
+# restarted
+DOWNLOAD_ERRORS = (httplib.HTTPException,) + ftplib.all_errors
+
+HOST_LOCK = threading.Lock()
+HOST_SLOTS = {}
+
+
+def host_slot(url):
+    """
+    Get the semaphore that limits the number of connections to the server
+    for a URL. This is shared by all of the downloads in the process.
+    """
+    host = urlparse.urlparse(url).netloc
+    with HOST_LOCK:
+        if host not in HOST_SLOTS:
+            HOST_SLOTS[host] = threading.BoundedSemaphore(HOST_CONNECTIONS)
+        return HOST_SLOTS[host]
+
+
+def backoff_delay(restart_counter):
+    """
+    Seconds to wait before restarting a download for the given time
+    """
+    return min(DOWNLOAD_BACKOFF * 2 ** (restart_counter - 1), DOWNLOAD_BACKOFF_MAX)
+
+
+def remote_validator(url):
+    """
+    Get a string that changes when a remote file changes, to check that a
+    cached copy of a file without a checksum is still current. For HTTP this
+    is made from the ETag, Last-Modified and Content-Length headers, for FTP
+    from the modification time and size.
+
+    Returns
+    -------
+    str
+        None if the server does not give any of them or cannot be reached
+    """
+    parsed = urlparse.urlparse(url)
+    values = []
+    try:
+        with host_slot(url):
+            if parsed.scheme == 'ftp':
+                path = urllib2.unquote(parsed.path)
+                ftp = ftplib.FTP(timeout=DOWNLOAD_TIMEOUT)
+                try:
+                    ftp.connect(parsed.hostname, parsed.port or ftplib.FTP_PORT)
+                    ftp.login(parsed.username or 'anonymous', parsed.password or '')
+                    ftp.voidcmd('TYPE I')
+                    for command in ['MDTM ' + path, 'SIZE ' + path]:
+                        try:
+                            values.append(ftp.sendcmd(command).split(' ', 1)[-1])
+                        except ftplib.error_perm:
+                            pass
+                finally:
+                    ftp.close()
+            else:
+                request = urllib2.Request(url)
+                request.get_method = lambda: 'HEAD'
+                req = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+                try:
+                    info = req.info()
+                    for header in ['etag', 'last-modified', 'content-length']:
+                        if info.get(header) is not None:
+                            values.append(header + ': ' + info.get(header))
+                finally:
+                    req.close()
+    except DOWNLOAD_ERRORS:
+        return None
+
+    if len(values) == 0:
+        return None
+    return '\n'.join(values)
+
+
+def download_complete(file_location):
+    """
+    Check that a file exists and is not a partial download
+    """
+    return os.path.isfile(file_location) and os.path.isfile(file_location + DOWNLOAD_STATE_SUFFIX) == False
+
+
+def ena_headers_replaced(file_path):
+    """
+    Check if replaceENAHeader() has already been run on a FASTA file: the
+    first header has no ENA stable_id and the .fai it writes is at least as
+    new as the file
+    """
+    fai_file = file_path + '.fai'
+    if os.path.isfile(fai_file) == False or os.path.getmtime(fai_file) < os.path.getmtime(file_path):
+        return False
+    with open(file_path, 'rb') as f_in:
+        return '|' not in f_in.readline()
+
+
+def file_md5(file_location):
+    """
+    Get the MD5 checksum of a file as a hex string
+    """
+    md5 = hashlib.md5()
+    with open(file_location, 'rb') as f_in:
+        while True:
+            data = f_in.read(DOWNLOAD_CHUNK_SIZE)
+            if data == '':
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+class downloadstate:
+    """
+    Progress of a download, saved in a sidecar file alongside the file being
+    downloaded so that the download can be resumed at the right byte if it
+    is interrupted, including by the process being restarted. The sidecar is
+    removed once the download is complete.
+
+    For single stream downloads the position is the size of the partial
+    file. For segmented downloads the position reached by each segment is
+    saved, after the data has been flushed to the file.
+    """
+
+    def __init__(self, file_location, url):
+        """
+        Initialise the state
+
+        Parameters
+        ----------
+        file_location : str
+            Location of the file being downloaded
+        url : str
+            URL of the file
+        """
+        self.state_file = file_location + DOWNLOAD_STATE_SUFFIX
+        self.url = url
+        self.size = None
+        self.segments = None
+        self.lock = threading.Lock()
+        self.saved = 0
+        # False once the server has answered a range request with the whole
+        # file, so the segments cannot be downloaded
+        self.ranges = True
+
+    def load(self):
+        """
+        Load the state from the sidecar file. Returns False if there is no
+        sidecar or if it was for a different URL.
+        """
+        if os.path.isfile(self.state_file) == False:
+            return False
+
+        with open(self.state_file, 'r') as f_in:
+            try:
+                state = json.load(f_in)
+            except ValueError:
+                return False
+
+        if state.get('url') != self.url:
+            return False
+
+        self.size = state.get('size')
+        self.segments = state.get('segments')
+        return True
+
+    def save(self):
+        """
+        Save the state to the sidecar file. The file is replaced in a single
+        step so that it is never left half written.
+        """
+        with self.lock:
+            tmp_file = self.state_file + '.tmp'
+            with open(tmp_file, 'w') as f_out:
+                json.dump({'url': self.url, 'size': self.size, 'segments': self.segments}, f_out)
+            os.rename(tmp_file, self.state_file)
+            self.saved = time.time()
+
+    def setPosition(self, segment, position):
+        """
+        Record the position that a segment has been downloaded up to. The
+        sidecar is only saved if it has not been saved for
+        DOWNLOAD_STATE_INTERVAL seconds. A resumed download may fetch again
+        the data downloaded since then, but none is lost.
+        """
+        self.segments[segment][1] = position
+        if time.time() - self.saved >= DOWNLOAD_STATE_INTERVAL:
+            self.save()
+
+    def remove(self):
+        """
+        Remove the sidecar file once the download is complete
+        """
+        if os.path.isfile(self.state_file):
+            os.remove(self.state_file)
+
+
+class ftpstream:
+    """
+    File-like reader for a file on an FTP server, starting from a byte
+    offset with the REST command. urllib2 cannot resume FTP downloads.
+    """
+
+    def __init__(self, url, position = 0):
+        """
+        Connect to the server and start the transfer
+
+        Parameters
+        ----------
+        url : str
+            ftp:// URL of the file
+        position : int
+            Offset in the file to start from
+        """
+        parsed = urlparse.urlparse(url)
+        path = urllib2.unquote(parsed.path)
+
+        self.ftp = ftplib.FTP(timeout=DOWNLOAD_TIMEOUT)
+        self.ftp.connect(parsed.hostname, parsed.port or ftplib.FTP_PORT)
+        self.ftp.login(parsed.username or 'anonymous', parsed.password or '')
+        self.ftp.voidcmd('TYPE I')
+
+        try:
+            self.size = self.ftp.size(path)
+        except ftplib.error_perm:
+            self.size = None
+
+        self.conn = self.ftp.transfercmd('RETR ' + path, rest=position if position > 0 else None)
+        self.position = position
+
+    def read(self, size):
+        """
+        Return up to size bytes, or an empty string at the end of the file
+        """
+        return self.conn.recv(size)
+
+    def close(self):
+        """
+        Close the data connection and the session
+        """
+        self.conn.close()
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+
+class urlstream:
+    """
+    File-like reader for a remote file. If the connection fails part way
+    through, the reader reconnects and carries on from the byte it got to,
+    waiting longer before each attempt (as download_file() does). The MD5
+    checksum of the data is checked at the end of the stream.
+
+    The stream holds one of the connection slots for the server until it is
+    closed.
+    """
+
+    def __init__(self, url, opener, md5 = None):
+        """
+        Initialise the reader and open the connection
+
+        Parameters
+        ----------
+        url : str
+            URL of the file
+        opener : function
+            Called as opener(url, position) to open a connection, see
+            common.open_stream()
+        md5 : str
+            MD5 checksum of the file, if it is known
+        """
+        self.url = url
+        self.opener = opener
+        self.md5 = md5
+        self.checksum = None
+        if md5 is not None:
+            self.checksum = hashlib.md5()
+
+        self.position = 0
+        self.size = None
+        self.stream = None
+
+        self.slot = host_slot(url)
+        self.slot.acquire()
+        try:
+            self.connect()
+        except:
+            self.slot.release()
+            self.slot = None
+            raise
+
+    def connect(self):
+        """
+        Open a connection starting from the current position
+        """
+        stream, start, size = self.opener(self.url, self.position)
+        if self.size is None:
+            self.size = size
+        self.stream = stream
+
+        # The server could not resume, so skip the data that has been read
+        skip = self.position - start
+        while skip > 0:
+            data = stream.read(min(skip, DOWNLOAD_CHUNK_SIZE))
+            if data == '':
+                raise IOError("Connection closed at byte " + str(self.position - skip))
+            skip -= len(data)
+
+    def closeStream(self):
+        """
+        Close the current connection, ignoring any errors
+        """
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except ftplib.all_errors:
+                pass
+            self.stream = None
+
+    def read(self, size = DOWNLOAD_CHUNK_SIZE):
+        """
+        Return up to size bytes, or an empty string at the end of the file
+        """
+        restart_counter = 0
+        while True:
+            try:
+                if self.stream is None:
+                    self.connect()
+                data = self.stream.read(size)
+                if data == '' and self.size is not None and self.position < self.size:
+                    raise IOError("Connection closed at byte " + str(self.position))
+                break
+            except ftplib.error_perm:
+                raise
+            except urllib2.HTTPError as e:
+                if e.code < 500:
+                    raise
+                print e
+            except DOWNLOAD_ERRORS as e:
+                print e
+
+            self.closeStream()
+            restart_counter += 1
+            if restart_counter >= DOWNLOAD_RETRIES:
+                raise IOError("Failed to download " + self.url)
+            print "Attempting to restart download at byte " + str(self.position) + " ..."
+            time.sleep(backoff_delay(restart_counter))
+
+        self.position += len(data)
+        if self.checksum is not None:
+            if data != '':
+                self.checksum.update(data)
+            else:
+                checksum = self.checksum.hexdigest()
+                self.checksum = None
+                if checksum != self.md5.lower():
+                    raise IOError("MD5 checksum does not match for " + self.url)
+        return data
+
+    def close(self):
+        """
+        Close the connection and free the slot for the server
+        """
+        self.closeStream()
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+
+
 class common:
     """
     Functions for downloading and processing *-seq FastQ files. Functions
     provided allow for the downloading andindexing of the genome assemblies.
     """
     
-    def __init__ (self):
+    def __init__ (self, cache = None, metadata = None):
         """
         Initialise the module
+        
+        Parameters
+        ----------
+        cache : filecache
+            Shared cache for the downloaded files. By default this is set up
+            from the MG_CACHE_DIR environment variable, and files are
+            downloaded directly if it is not set.
+        metadata : enametadata
+            Cached access to the ENA reports. By default the reports are
+            cached alongside the shared cache for the files.
         """
         self.ready = ""
+        self.cache = cache
+        if cache is None:
+            self.cache = cache_from_environment()
+        self.metadata = metadata
+        if metadata is None:
+            self.metadata = metadata_from_environment()
+        self.indexer_stats = {}
     
     
     def getGenomeFile(self, data_dir, species, assembly, index = True):
@@ -58,15 +497,14 @@ class common:
         file_name_unzipped = file_name.replace('.fa.gz', '.fa')
         print file_name
         
-        if os.path.isfile(file_name) == False:
+        if download_complete(file_name) == False:
             ftp_url = 'ftp://ftp.ensembl.org/pub/current_fasta/' + species.lower() + '/dna/' + species[0].upper() + species[1:] + '.' + assembly + '.dna.toplevel.fa.gz'
             
-            self.download_file(file_name, ftp_url)
+            self.fetch(file_name, ftp_url)
             
         if os.path.isfile(file_name_unzipped) == False:
             print "Unzipping"
-            with gzip.open(file_name, 'rb') as f_in, open(file_name_unzipped, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            decompress_file(file_name, file_name_unzipped)
         
         indexes = {}
         if index == True:
@@ -83,24 +521,21 @@ class common:
         
         file_name = data_dir + species + '_' + assembly + '/' + species + '.' + assembly + '.fa'
         
-        if os.path.isfile(file_name) == False:
-          ftp_list_url = 'ftp://ftp.ebi.ac.uk/pub/databases/ena/assembly/' + assembly[0:7] + '/' + assembly[0:10] + '/' + assembly + '_sequence_report.txt'
-          res_list = urllib2.urlopen(ftp_list_url)
-          table = res_list.read()
-          table = table.split("\n")
-          
+        if download_complete(file_name) == False:
           chr_list = []
-          for row in table:
-              col = row.split("\t")
-              if len(col) > 5 and col[3] == 'assembled-molecule':
-                  chr_list.append(col[0])
+          for sequence in self.metadata.sequenceReport(assembly):
+              if sequence.get('sequence-role') == 'assembled-molecule':
+                  chr_list.append(sequence['accession'])
           
           ftp_url = 'http://www.ebi.ac.uk/ena/data/view/' + ','.join(chr_list) + '&display=fasta'
-          self.download_file(file_name, ftp_url)
+          self.fetch(file_name, ftp_url)
         
         indexes = {}
         if index == True:
-            self.replaceENAHeader(file_name)
+            # Rewriting the headers changes the modification time, which
+            # would make the index registry check the whole file again
+            if ena_headers_replaced(file_name) == False:
+                self.replaceENAHeader(file_name)
             indexes = self.run_indexers(file_name)
         
         return {'unzipped': file_name, 'index' : indexes}
@@ -111,26 +546,127 @@ class common:
         The ENA header has pipes in the header as part of teh stable_id. This
         function removes the ENA stable_id and replaces it with the final
         section after splitting the stable ID on the pipe.
+        
+        The file is processed in blocks of FASTA_BLOCK_SIZE. Only the header
+        lines are rewritten, the sequence between them is copied straight
+        through. The new file is written alongside the original and renamed
+        over it, and the samtools faidx index (.fai) for the new file is
+        built in the same pass.
+        
+        Returns
+        -------
+        str
+            Location of the .fai index
         """
         from tempfile import mkstemp
-        from shutil import move
-        from os import remove, close
-        
-        #Create temp file
-        fh, abs_path = mkstemp()
-        with open(abs_path,'w') as new_file:
-            with open(file_path) as old_file:
-                for line in old_file:
-                    if line[0] == '>':
-                        space_line = line.split(" ")
-                        new_file.write(">" + space_line[0].split("|")[-1].replace(">", "") + " " + " ".join(space_line[1:]))
-                    else:
-                        new_file.write(line)
-        close(fh)
-        #Remove original file
-        remove(file_path)
-        #Move new file
-        move(abs_path, file_path)
+        
+        file_dir = os.path.dirname(os.path.abspath(file_path))
+        
+        # [name, length, offset, line bases, line width] for each sequence
+        fai_entries = []
+        entry = None
+        
+        # Characters of the first line of the current sequence that were in
+        # earlier blocks, and the last character copied, for sequences on a
+        # single long line
+        first_line = 0
+        last_char = ''
+        
+        #Create temp file in the same directory so that it can be renamed
+        fh, abs_path = mkstemp(dir=file_dir, prefix=os.path.basename(file_path) + '.')
+        fai_path = None
+        try:
+            with os.fdopen(fh, 'wb') as new_file:
+                with open(file_path, 'rb') as old_file:
+                    data = ''
+                    line_start = True
+                    offset = 0
+                    eof = False
+                    while eof == False:
+                        block = old_file.read(FASTA_BLOCK_SIZE)
+                        eof = (block == '')
+                        data = data + block if data != '' else block
+                        
+                        i = 0
+                        while i < len(data):
+                            if line_start == True and data[i] == '>':
+                                end = data.find('\n', i)
+                                if end == -1 and eof == False:
+                                    break
+                                if end == -1:
+                                    end = len(data) - 1
+                                    line = data[i:] + '\n'
+                                else:
+                                    line = data[i:end + 1]
+                                
+                                header = line.rstrip('\r\n')
+                                space_line = header.split(" ", 1)
+                                name = space_line[0].split("|")[-1].replace(">", "")
+                                header = ">" + name
+                                if len(space_line) > 1:
+                                    header += " " + space_line[1]
+                                header += line[len(line.rstrip('\r\n')):]
+                                
+                                new_file.write(header)
+                                offset += len(header)
+                                entry = [name, 0, offset, 0, 0]
+                                fai_entries.append(entry)
+                                first_line = 0
+                                
+                                i = end + 1
+                                line_start = True
+                                continue
+                            
+                            if entry is not None and entry[4] == 0:
+                                # The line lengths come from the first line of
+                                # the sequence. It is copied out as it is
+                                # read rather than held until its end.
+                                end = data.find('\n', i)
+                                if end == -1:
+                                    first_line += len(data) - i
+                                else:
+                                    entry[4] = first_line + end + 1 - i
+                                    entry[3] = entry[4] - 1
+                                    if (data[end - 1] if end > i else last_char) == '\r':
+                                        entry[3] -= 1
+                            
+                            # Copy everything up to the next header
+                            end = data.find('\n>', i)
+                            if end == -1:
+                                end = len(data)
+                            else:
+                                end += 1
+                            
+                            new_file.write(buffer(data, i, end - i))
+                            offset += end - i
+                            if entry is not None:
+                                entry[1] += end - i - data.count('\n', i, end) - data.count('\r', i, end)
+                            
+                            last_char = data[end - 1]
+                            line_start = (last_char == '\n')
+                            i = end
+                        
+                        data = data[i:]
+            
+            os.chmod(abs_path, os.stat(file_path).st_mode & 0777)
+            
+            fai_file = file_path + '.fai'
+            fai_fh, fai_path = mkstemp(dir=file_dir, prefix=os.path.basename(fai_file) + '.')
+            with os.fdopen(fai_fh, 'w') as f_fai:
+                for name, length, seq_offset, line_bases, line_width in fai_entries:
+                    f_fai.write(name + "\t" + str(length) + "\t" + str(seq_offset) + "\t" + str(line_bases) + "\t" + str(line_width) + "\n")
+            os.chmod(fai_path, 0644)
+        except:
+            for tmp_path in [abs_path, fai_path]:
+                if tmp_path is not None and os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        
+        #Replace the original file
+        os.rename(abs_path, file_path)
+        os.rename(fai_path, fai_file)
+        
+        return fai_file
     
     
     def getcDNAFiles(self, data_dir, species, assembly, e_release):
@@ -140,145 +676,672 @@ class common:
         
         file_name = data_dir + species + '_' + assembly + '/' + species + '.' + assembly + '.cdna.all.fa.gz'
         
-        if os.path.isfile(file_name) == False:
+        if download_complete(file_name) == False:
             ftp_url = 'ftp://ftp.ensembl.org/pub/release-' + e-release + '/' + species.lower() + '/cdna/' + species[0].upper() + species[1:] + '.' + assembly + '.cdna.all.fa.gz'
             
-            self.download_file(file_name, ftp_url)
+            self.fetch(file_name, ftp_url)
         
         return file_name
     
     
-    def getFastqFiles(self, ena_err_id, data_dir, ena_srr_id = None):
+    def getFastqFiles(self, ena_err_id, data_dir, ena_srr_id = None, decompress = True):
         """
         Function for downloading and extracting the FastQ files from the ENA
+        
+        If decompress is False then the .fastq.gz files are kept as they are
+        and their locations are returned. fastqreader is able to read these
+        directly.
         """
+        run_ids = None
+        if ena_srr_id != None:
+            run_ids = [ena_srr_id]
         
-        f_index = urllib2.urlopen(
-        'http://www.ebi.ac.uk/ena/data/warehouse/filereport?accession=' + str(ena_err_id) + '&result=read_run&fields=study_accession,run_accession,tax_id,scientific_name,instrument_model,library_layout,fastq_ftp&download=txt')
-        data = f_index.read()
-        rows = data.split("\n")
-        row_count = 0
-        files = []
-        gzfiles  = []
-        for row in rows:
-            if row_count == 0:
-                row_count += 1
-                continue
-            
-            row = row.rstrip()
-            row = row.split("\t")
-            
-            if len(row) < 6:
+        return [location for run_id, location in self.downloadFastqFiles(ena_err_id, data_dir, run_ids, decompress)]
+    
+    
+    def getFastqRuns(self, ena_err_id, data_dir, run_ids = None, decompress = True):
+        """
+        Download the FastQ files for a set of runs from the ENA at the same
+        time, rather than calling getFastqFiles() for each run in turn.
+        
+        Returns
+        -------
+        dict
+            Locations of the FastQ files for each run
+        """
+        run_files = {}
+        if run_ids != None:
+            for run_id in run_ids:
+                run_files[run_id] = []
+        
+        for run_id, location in self.downloadFastqFiles(ena_err_id, data_dir, run_ids, decompress):
+            run_files.setdefault(run_id, []).append(location)
+        
+        return run_files
+    
+    
+    def fastqFileReport(self, ena_err_id, data_dir, run_ids = None):
+        """
+        Get the FastQ files listed in the ENA filereport for an accession
+        
+        Parameters
+        ----------
+        ena_err_id : str
+            ENA accession to get the filereport for
+        data_dir : str
+            Location of the data directory. The files are saved in a
+            directory for the study
+        run_ids : list
+            Run accessions to get the files for. None for all of the runs
+        
+        Returns
+        -------
+        list
+            [run accession, location for the file, URL, MD5 checksum] for each
+            file in the order of the filereport
+        """
+        fastq_report = []
+        for run in self.metadata.filereport(ena_err_id):
+            project = run['study_accession']
+            srr_id = run['run_accession']
+            if (run_ids != None and srr_id not in run_ids):
                 continue
             
-            project = row[0]
-            srr_id = row[1]
-            if (ena_srr_id != None and srr_id != ena_srr_id):
-                continue
-            fastq_files = row[6].split(';')
-            row_count += 1
+            fastq_files = run['fastq_ftp'].split(';')
+            fastq_md5s = [None] * len(fastq_files)
+            if len(run.get('fastq_md5', '').split(';')) == len(fastq_files):
+                fastq_md5s = [md5 or None for md5 in run['fastq_md5'].split(';')]
             
-            for fastq_file in fastq_files:
+            for fastq_file, fastq_md5 in zip(fastq_files, fastq_md5s):
+                if fastq_file == '':
+                    continue
                 file_name = fastq_file.split("/")
                 
                 print data_dir + project + "/" + file_name[-1]
                 
-                if os.path.isfile(data_dir + '/' + project + "/" + file_name[-1]) == False and os.path.isfile(data_dir + '/' + project + "/" + file_name[-1].replace('.fastq.gz', '.fastq')) == False:
-                    file_location = data_dir + '/' + project + "/" + file_name[-1]
-                    ftp_url = "ftp://" + fastq_file
-                    self.download_file(file_location, ftp_url)
-                
-                if os.path.isfile(data_dir + '/' + project + "/" + file_name[-1]) == True:
-                    gzfiles.append(data_dir + '/' + project + "/" + file_name[-1])
-                files.append(data_dir + '/' + project + "/" + file_name[-1].replace('.fastq.gz', '.fastq'))
+                file_location = data_dir + '/' + project + "/" + file_name[-1]
+                fastq_report.append([srr_id, file_location, "ftp://" + fastq_file, fastq_md5])
         
-        for gzf in gzfiles:
-            with gzip.open(gzf, 'rb') as f_in, open(gzf.replace('.fastq.gz', '.fastq'), 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-            os.remove(gzf)
+        return fastq_report
+    
+    
+    def downloadFastqFiles(self, ena_err_id, data_dir, run_ids = None, decompress = True):
+        """
+        Download all of the FastQ files listed in the ENA filereport for an
+        accession. The files are downloaded concurrently on a pool of
+        DOWNLOAD_THREADS threads, with at most HOST_CONNECTIONS open to each
+        server, and each file is decompressed (or indexed if decompress is
+        False) as soon as it has been downloaded.
+        
+        Parameters
+        ----------
+        ena_err_id : str
+            ENA accession to get the filereport for
+        data_dir : str
+            Location of the data directory. The files are saved in a
+            directory for the study
+        run_ids : list
+            Run accessions to download the files for. None for all of the
+            runs
+        decompress : bool
+            Decompress the .fastq.gz files
         
-        return files
+        Returns
+        -------
+        list
+            (run accession, location of the FastQ file) in the order of the
+            filereport
+        """
+        tasks = [fastq_file + [decompress] for fastq_file in self.fastqFileReport(ena_err_id, data_dir, run_ids)]
+        
+        if len(tasks) == 0:
+            return []
+        
+        pool = ThreadPool(min(DOWNLOAD_THREADS, len(tasks)))
+        try:
+            locations = pool.map(self.fetchFastqFile, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        
+        return [(task[0], location) for task, location in zip(tasks, locations)]
     
     
-    def download_file(self, file_location, url):
+    def streamFastqFiles(self, ena_err_id, data_dir, ena_srr_id, tag = 'tmp', compression = None, reads_per_shard = 1000000, bases_per_shard = None, bytes_per_shard = None, stats = False, trimmer = None, sampler = None, on_shard = None):
         """
-        Function to download a file to a given location and file name. Will
-        attempt to restart the download up to 5 times if the connection is
-        closed by the remote server.
+        Streaming alternative to getFastqFiles() and fastqsplitter for a
+        paired end run. The FastQ files are split into shards as they are
+        downloaded and decompressed, without being saved, and on_shard is
+        called with each pair of shard files as soon as it has been written
+        so that the alignment of the shards can start while the rest of the
+        run is still being downloaded.
+        
+        Dropped connections are resumed (see urlstream) and the MD5 checksum
+        of each file is checked once it has been read. The files do not go
+        through the shared cache.
+        
+        The shards are saved in a tmp directory in the directory for the
+        study. The other parameters are as for fastqsplitter.
+        
+        Returns
+        -------
+        list
+            List of lists of the files that have been generated. Each sub list
+            contains the two paired end files for that shard.
         """
+        mates = []
+        for srr_id, file_location, url, md5 in self.fastqFileReport(ena_err_id, data_dir, [ena_srr_id]):
+            if re.search(r'_[12]\.fastq(\.gz)?$', file_location) is not None:
+                mates.append([file_location, url, md5])
+        mates.sort()
         
-        restart_counter = 0
+        if len(mates) != 2:
+            raise ValueError("Only paired end runs can be streamed: " + str(ena_srr_id))
         
-        while True:
-            meta = urllib2.urlopen(url)
-            info = meta.info()
-            if restart_counter > 0:
-                byte_start = int(os.stat(file_location).st_size) + 1
-                request = urllib2.Request(url, headers={"Range" : "bytes=" + str(byte_start) + "-" + str(info["content-length"])})
-            else:
-                request = urllib2.Request(url)
+        tmp_dir = os.path.join(os.path.dirname(mates[0][0]), 'tmp')
+        if os.path.isdir(tmp_dir) == False:
+            os.makedirs(tmp_dir)
+        
+        streams = []
+        try:
+            for file_location, url, md5 in mates:
+                stream = urlstream(url, self.open_stream, md5)
+                if file_location.endswith('.gz'):
+                    stream = threadedreader(stream)
+                streams.append(stream)
+            
+            fqs = fastqsplitter(mates[0][0], mates[1][0], tag, compression, reads_per_shard, 1, bases_per_shard, bytes_per_shard, stats=stats, trimmer=trimmer, sampler=sampler, on_shard=on_shard)
+            return fqs.splitStreams(streams[0], streams[1])
+        finally:
+            for stream in streams:
+                stream.close()
+    
+    
+    def fetchFastqFile(self, params):
+        """
+        Download a single FastQ file, unless it or the decompressed file is
+        already there, and then decompress or index it. This is run on the
+        thread pool in downloadFastqFiles().
+        
+        Parameters
+        ----------
+        params : list
+            run accession, location of the .fastq.gz file, FTP URL, MD5
+            checksum of the file from the filereport, decompress
+        
+        Returns
+        -------
+        str
+            Location of the FastQ file
+        """
+        run_id, file_location, ftp_url, md5, decompress = params
+        file_location_unzipped = file_location.replace('.fastq.gz', '.fastq')
+        
+        if download_complete(file_location) == False and os.path.isfile(file_location_unzipped) == False:
+            if self.fetch(file_location, ftp_url, md5) == False:
+                raise IOError("Failed to download " + ftp_url)
+        
+        if os.path.isfile(file_location) == False or file_location == file_location_unzipped:
+            return file_location_unzipped
+        
+        if decompress == False:
+            # Index the file now so that it can be split without another
+            # pass through it
+            index_fastq(file_location)
+            return file_location
+        
+        decompress_file(file_location, file_location_unzipped)
+        os.remove(file_location)
+        return file_location_unzipped
+    
+    
+    def fetch(self, file_location, url, md5 = None):
+        """
+        Get a file, from the shared cache if there is one, otherwise by
+        downloading it with download_file(). A cached file without an md5 is
+        checked against the server with remote_validator().
+        
+        Parameters
+        ----------
+        file_location : str
+            Location to save the file to
+        url : str
+            URL of the file
+        md5 : str
+            MD5 checksum of the file, if it is known
+        
+        Returns
+        -------
+        bool
+            True if the file is in place
+        """
+        if self.cache is None:
+            return self.download_file(file_location, url, md5=md5)
+        
+        return self.cache.fetch(file_location, url, lambda location, url, checksum: self.download_file(location, url, md5=checksum), md5, remote_validator)
+    
+    
+    def download_file(self, file_location, url, segments = DOWNLOAD_SEGMENTS, md5 = None):
+        """
+        Function to download a file to a given location and file name.
+        
+        Large files from HTTP servers that support range requests are split
+        into segments that are downloaded in parallel over separate
+        connections (see download_segments()). Otherwise the file is
+        downloaded over a single connection, as it is if the server turns out
+        not to take range requests part way through.
+        
+        The progress is kept in a sidecar file (see downloadstate), so an
+        interrupted download is restarted, up to DOWNLOAD_RETRIES times with
+        an exponential backoff, from the byte that it got to. This includes
+        downloads left over from a previous run. Downloads over FTP are
+        resumed with the REST command.
+        
+        At most HOST_CONNECTIONS connections to the same server are open at a
+        time, any others wait for a free slot.
+        
+        Parameters
+        ----------
+        file_location : str
+            Location to save the file to
+        url : str
+            URL of the file
+        segments : int
+            Maximum number of segments to download in parallel
+        md5 : str
+            MD5 checksum of the file. If this does not match then the file is
+            removed.
+        
+        Returns
+        -------
+        bool
+            True if the file was downloaded (and matches the checksum)
+        """
+        state = downloadstate(file_location, url)
+        if state.load() == False or os.path.isfile(file_location) == False:
+            state = downloadstate(file_location, url)
+        
+        if state.segments is None:
+            size = None
+            if segments > 1 and urlparse.urlparse(url).scheme in ['http', 'https'] and state.size is None:
+                with host_slot(url):
+                    size = self.range_size(url)
             
-            req = urllib2.urlopen(request)
-            CHUNK = 16 * 1024
+            if size is not None and size >= 2 * SEGMENT_MIN_SIZE:
+                segments = min(segments, size // SEGMENT_MIN_SIZE)
+                segment_size = -(-size // segments)
+                state.size = size
+                state.segments = [[start, start, min(start + segment_size, size)] for start in range(0, size, segment_size)]
+                state.save()
+                with open(file_location, 'wb') as f_out:
+                    f_out.truncate(size)
+        
+        if state.segments is not None:
+            complete = self.download_segments(file_location, url, state)
+            if complete == False and state.ranges == False:
+                # The segments are dropped from the sidecar, otherwise every
+                # later attempt would go back to the range requests
+                print "Downloading " + url + " over a single connection"
+                state.remove()
+                state = downloadstate(file_location, url)
+                complete = self.download_with_restarts(file_location, url, state)
+        else:
+            complete = self.download_with_restarts(file_location, url, state)
+        
+        if complete == False:
+            return False
+        
+        if md5 is not None and file_md5(file_location) != md5.lower():
+            print "MD5 checksum does not match for " + url
+            os.remove(file_location)
+            state.remove()
+            return False
+        
+        state.remove()
+        return True
+    
+    
+    def range_size(self, url):
+        """
+        Check whether the server supports range requests for a URL
+        
+        Returns
+        -------
+        int
+            Size of the file in bytes, or None if the server ignores ranges
+            or the request fails
+        """
+        request = urllib2.Request(url, headers={"Range" : "bytes=0-0"})
+        try:
+            req = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        except (SocketError, urllib2.URLError, httplib.HTTPException) as e:
+            print e
+            return None
+        
+        try:
+            if req.getcode() != 206:
+                return None
             
-            try:
-                if restart_counter == 0 :
-                    with open(file_location, 'wb') as fp:
-                        while True:
-                            chunk = req.read(CHUNK)
-                            if not chunk: break
-                            fp.write(chunk)
-                else:
-                    with open(file_location, 'ab') as fp:
-                        while True:
-                            chunk = req.read(CHUNK)
-                            if not chunk: break
-                            fp.write(chunk)
+            # Content-Range: bytes 0-0/<size>
+            size = req.info().get("content-range", "").split("/")[-1]
+            if size.isdigit() == False:
+                return None
+            return int(size)
+        finally:
+            req.close()
+    
+    
+    def download_segments(self, file_location, url, state):
+        """
+        Download a file as a set of byte ranges in parallel. The file is
+        preallocated and each segment writes to its own part of it through a
+        separate file handle (Python 2 has no os.pwrite). A segment that fails
+        is restarted from where it got to without affecting the others. If the
+        server answers a range request with the whole file, state.ranges is
+        set to False and the download fails.
+        
+        Parameters
+        ----------
+        file_location : str
+            Location to save the file to
+        url : str
+            URL of the file
+        state : downloadstate
+            Progress of the download with the [start, position, end] of each
+            segment
+        
+        Returns
+        -------
+        bool
+            True if all of the segments were downloaded
+        """
+        tasks = []
+        for segment in range(len(state.segments)):
+            tasks.append([file_location, url, state, segment])
+        
+        pool = ThreadPool(len(tasks))
+        try:
+            results = pool.map(self.download_segment, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        
+        return all(results)
+    
+    
+    def download_segment(self, params):
+        """
+        Download one byte range of a file into place. This is run on the
+        thread pool in download_segments().
+        
+        Parameters
+        ----------
+        params : list
+            file location, URL, downloadstate, number of the segment
+        
+        Returns
+        -------
+        bool
+            True if the range was downloaded
+        """
+        file_location, url, state, segment = params
+        start, position, end = state.segments[segment]
+        restart_counter = 0
+        
+        with open(file_location, 'r+b') as f_out:
+            f_out.seek(position)
+            while position < end:
+                try:
+                    with host_slot(url):
+                        request = urllib2.Request(url, headers={"Range" : "bytes=" + str(position) + "-" + str(end - 1)})
+                        req = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+                        try:
+                            if req.getcode() != 206:
+                                print "Range requests are not supported for " + url
+                                state.ranges = False
+                                return False
+                            
+                            while position < end:
+                                chunk = req.read(min(DOWNLOAD_CHUNK_SIZE, end - position))
+                                if not chunk: break
+                                f_out.write(chunk)
+                                f_out.flush()
+                                position += len(chunk)
+                                state.setPosition(segment, position)
+                        finally:
+                            req.close()
+                except (SocketError, urllib2.URLError, httplib.HTTPException) as e:
+                    print e
                 
-                req.close()
-            except SocketError as e:
-                if e.errno != errno.ECONNRESET:
+                state.save()
+                if position < end:
+                    restart_counter += 1
+                    if restart_counter >= DOWNLOAD_RETRIES:
+                        return False
+                    print "Attempting to restart segment at byte " + str(position) + " ..."
+                    time.sleep(backoff_delay(restart_counter))
+        
+        return True
+    
+    
+    def open_stream(self, url, position = 0):
+        """
+        Open a connection to download a file from a byte offset
+        
+        Returns
+        -------
+        tuple
+            (stream with read() and close(), offset in the file that the
+            stream starts at, size of the file or None if it is not known).
+            The offset is 0 if the server does not support resuming.
+        """
+        if urlparse.urlparse(url).scheme == 'ftp':
+            stream = ftpstream(url, position)
+            return (stream, position, stream.size)
+        
+        request = urllib2.Request(url)
+        if position > 0:
+            request.add_header("Range", "bytes=" + str(position) + "-")
+        req = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        info = req.info()
+        
+        if req.getcode() == 206:
+            size = info.get("content-range", "").split("/")[-1]
+            return (req, position, int(size) if size.isdigit() else None)
+        
+        size = info.get("content-length")
+        return (req, 0, int(size) if size is not None and size.isdigit() else None)
+    
+    
+    def download_with_restarts(self, file_location, url, state):
+        """
+        Download a file over a single connection. If the connection fails the
+        download is restarted from the end of the partial file, waiting
+        longer before each attempt.
+        
+        Returns
+        -------
+        bool
+            True if the file was downloaded
+        """
+        position = 0
+        if state.size is not None and os.path.isfile(file_location):
+            position = os.path.getsize(file_location)
+            if position > state.size:
+                position = 0
+        
+        restart_counter = 0
+        
+        while state.size is None or position < state.size:
+            finished = False
+            try:
+                with host_slot(url):
+                    stream, start, size = self.open_stream(url, position)
+                    try:
+                        state.size = size
+                        state.save()
+                        
+                        with open(file_location, 'ab' if start > 0 else 'wb') as fp:
+                            while True:
+                                chunk = stream.read(DOWNLOAD_CHUNK_SIZE)
+                                if not chunk: break
+                                fp.write(chunk)
+                        finished = True
+                    finally:
+                        stream.close()
+            except ftplib.error_perm:
+                raise
+            except urllib2.HTTPError as e:
+                if e.code < 500:
                     raise
                 print e
-                print "Attempting to restart download ..."
-                restart_counter += 1
+            except DOWNLOAD_ERRORS as e:
+                print e
+            
+            if os.path.isfile(file_location):
+                position = os.path.getsize(file_location)
+            if state.size is None and finished == True:
+                # Nothing to check the length against
+                break
+            if state.size is not None and position >= state.size:
+                break
             
-            if restart_counter >= 5 :
+            restart_counter += 1
+            if restart_counter >= DOWNLOAD_RETRIES:
                 return False
-            break
+            print "Attempting to restart download at byte " + str(position) + " ..."
+            time.sleep(backoff_delay(restart_counter))
         
         return True
     
     
-    def run_indexers(self, file_name):
+    def run_indexers(self, file_name, cores = None, memory = None):
         """
+        Create the BWA, Bowtie2 and GEM indexes for a genome FASTA file. The
+        indexes are saved alongside the FASTA file and recorded in its
+        indexregistry, so an index is only built if there is not already a
+        valid one for the same FASTA content and indexer version. The lock for
+        each indexer is held while it is built so that concurrent pipelines
+        wait for it rather than building it again.
+        
+        The indexers that are needed are run at the same time with a
+        toolrunner within the budget of cores and memory. The output of each
+        indexer is saved to <genome>.<indexer>.log and the wall time and peak
+        memory of each indexer are printed and kept in self.indexer_stats.
+        If any of the indexers fail an IOError is raised, once the indexes
+        that were built have been recorded.
         
+        Parameters
+        ----------
+        file_name : str
+            Location of the assembly file (.fa or .fa.gz)
+        cores : int
+            Number of cores the indexers can use. Defaults to all of the
+            cores on the machine
+        memory : int
+            Number of bytes of memory the indexers can use. Defaults to the
+            physical memory of the machine
+        
+        Returns
+        -------
+        dict
+            Locations of the primary bowtie, bwa and gem index files
         """
         
         file_name_unzipped = file_name.replace('.fa.gz', '.fa')
-        file_name_nofa = file_name_unzipped.replace('.fa', '')
         
         if os.path.isfile(file_name_unzipped) == False:
             print "Unzipping"
-            with gzip.open(file_name, 'rb') as f_in, open(file_name_unzipped, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            decompress_file(file_name, file_name_unzipped)
         
-        if os.path.isfile(file_name_unzipped + '.bwt') == False:
-            print "Indexing - BWA"
-            self.bwa_index_genome(file_name)
+        registry = indexregistry(file_name_unzipped)
+        runner = toolrunner(cores, memory)
         
-        if os.path.isfile(file_name_nofa + '.1.bt2') == False:
-            print "Indexing - Bowtie"
-            self.bowtie_index_genome(file_name_unzipped)
+        # BWA index is single threaded, so the other cores are split between
+        # Bowtie2 and GEM
+        threads = max(1, (runner.cores - 1) / 2)
+        genome_size = os.path.getsize(file_name_unzipped)
         
-        if os.path.isfile(file_name_nofa + '.gem') == False:
-            print "Indexing - GEM"
-            self.gem_index_genome(file_name_unzipped)
+        commands = {
+            'bwa' : (self.bwa_index_command(file_name_unzipped), 1),
+            'bowtie' : (self.bowtie_index_command(file_name_unzipped, threads), threads),
+            'gem' : (self.gem_index_command(file_name_unzipped, threads), threads)
+        }
         
-        return {'bowtie' : file_name_unzipped + '.1.bt2', 'bwa' : file_name_unzipped + '.bwt', 'gem' : file_name_unzipped + '.gem'}
+        indexes = {}
+        locks = []
+        try:
+            # The locks are always taken in the same order so that pipelines
+            # waiting on each other cannot deadlock
+            for tool in ['bwa', 'bowtie', 'gem']:
+                version = tool_version(tool)
+                entry = registry.lookup(tool, version)
+                if entry is None:
+                    lock = registry.lock(tool)
+                    lock.acquire()
+                    locks.append(lock)
+                    
+                    # Another pipeline may have built it while this one was
+                    # waiting for the lock
+                    entry = registry.lookup(tool, version)
+                
+                if entry is not None:
+                    indexes[tool] = registry.primary(entry)
+                    continue
+                
+                print "Indexing - " + tool
+                registry.remove(tool)
+                command_line, tool_threads = commands[tool]
+                runner.add(tool, command_line, tool_threads, INDEXER_MEMORY[tool] * genome_size, file_name_unzipped + '.' + tool + '.log')
+            
+            self.indexer_stats = runner.run()
+            failed = []
+            for tool in sorted(self.indexer_stats):
+                stats = self.indexer_stats[tool]
+                print "Indexed - {0}: {1:.1f}s wall time, {2:.1f} MB peak RSS, {3} threads, exit code {4} (log: {5})".format(
+                    tool, stats['wall_time'], stats['max_rss'] / 1048576.0, stats['threads'], stats['returncode'], stats['log_file'])
+                
+                files = index_files(file_name_unzipped, tool)
+                missing = [index_file for index_file in files if os.path.isfile(index_file) == False]
+                if stats['returncode'] != 0 or len(missing) > 0:
+                    print "[Error] " + tool + " indexing failed, see " + stats['log_file']
+                    failed.append(tool)
+                    continue
+                
+                registry.record(tool, tool_version(tool), commands[tool][0], files)
+                indexes[tool] = files[0]
+            
+            if len(failed) > 0:
+                raise IOError("Indexing failed for " + ', '.join(failed) + " of " + file_name_unzipped)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        
+        return indexes
+    
+    
+    def gem_index_command(self, genome_file, threads = 1):
+        """
+        Command line for indexing a genome FASTA file with GEM
+        """
+        return 'gem-indexer -T ' + str(threads) + ' -i ' + genome_file + ' -o ' + index_prefix(genome_file)
+    
+    
+    def bowtie_index_command(self, genome_file, threads = 1):
+        """
+        Command line for indexing a genome FASTA file with Bowtie2
+        """
+        return 'bowtie2-build --threads ' + str(threads) + ' ' + genome_file + ' ' + index_prefix(genome_file)
+    
+    
+    def bwa_index_command(self, genome_file):
+        """
+        Command line for indexing a genome FASTA file with BWA
+        """
+        return 'bwa index ' + genome_file
     
     
-    def gem_index_genome(self, genome_file):
+    def gem_index_genome(self, genome_file, threads = 1):
         """
         Create an index of the genome FASTA file with GEM. These are saved
         alongside the assembly file.
@@ -287,21 +1350,19 @@ class common:
         ----------
         genome_file : str
             Location of the assembly file in the file system
+        threads : int
+            Number of threads for the indexer to use
         """
-        file_name = genome_file.split("/")
-        
-        command_line = 'gem-indexer -i ' + genome_file + ' -o ' + file_name[-1].replace('.fa', '')
+        command_line = self.gem_index_command(genome_file, threads)
         
         args = shlex.split(command_line)
         p = subprocess.Popen(args)
         p.wait()
         
-        file_name = genome_file.split("/")
-        file_name[-1].replace('.fa', '.gem')
-        return '/'.join(file_name)
+        return index_files(genome_file, 'gem')[0]
     
     
-    def bowtie_index_genome(self, genome_file):
+    def bowtie_index_genome(self, genome_file, threads = 1):
         """
         Create an index of the genome FASTA file with Bowtie2. These are saved
         alongside the assembly file.
@@ -310,11 +1371,10 @@ class common:
         ----------
         genome_file : str
             Location of the assembly file in the file system
+        threads : int
+            Number of threads for the indexer to use
         """
-        file_name = genome_file.split("/")
-        file_name[-1].replace('.fa', '')
-        
-        command_line = 'bowtie2-build ' + genome_file + ' ' + file_name[-1].replace('.fa', '')
+        command_line = self.bowtie_index_command(genome_file, threads)
         
         args = shlex.split(command_line)
         p = subprocess.Popen(args)
@@ -333,28 +1393,13 @@ class common:
         genome_file : str
             Location of the assembly file in the file system
         """
-        command_line = 'bwa index ' + genome_file
+        command_line = self.bwa_index_command(genome_file)
         
         args = shlex.split(command_line)
         p = subprocess.Popen(args)
         p.wait()
         
-        amb_name = genome_file.split("/")
-        amb_name[-1].replace('.fa', '.amb')
-        
-        ann_name = genome_file.split("/")
-        ann_name[-1].replace('.fa', '.ann')
-        
-        bwt_name = genome_file.split("/")
-        bwt_name[-1].replace('.fa', '.bwt')
-        
-        pac_name = genome_file.split("/")
-        pac_name[-1].replace('.fa', '.pac')
-        
-        sa_name = genome_file.split("/")
-        sa_name[-1].replace('.fa', '.pac')
-        
-        return ('/'.join(amb_name), '/'.join(ann_name), '/'.join(bwt_name), '/'.join(pac_name), '/'.join(sa_name))
+        return tuple([genome_file + suffix for suffix in ['.amb', '.ann', '.bwt', '.pac', '.sa']])
         
         
     def bwa_align_reads(self, genome_file, reads_file):
@@ -0,0 +1,625 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import zlib, struct, threading, Queue, multiprocessing, shutil
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try :
+    import zstandard
+except ImportError :
+    zstandard = None
+
+# Number of compressed bytes that are read from the source in a single call
+BLOCK_SIZE = 1024 * 1024
+
+# Number of BGZF blocks (each up to 64KB) that are inflated by a single task
+BGZF_CHUNK_BLOCKS = 64
+
+# Number of bytes collected by a threadedwriter before they are written
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# File name suffixes for the output compression options
+COMPRESSION_SUFFIX = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def member_complete(decompressor):
+    """
+    Check if a gzip decompressor has reached the end of its member. zlib in
+    Python 2 has no eof flag, so a copy of the decompressor is given more
+    data: after the end of the member it is left in unused_data, otherwise it
+    is taken as part of the member (or is an error).
+    """
+    probe = decompressor.copy()
+    try:
+        probe.decompress(GZIP_MAGIC)
+    except zlib.error:
+        return False
+    return probe.unused_data != ''
+
+
+class threadedreader:
+    """
+    File-like reader that inflates a gzip stream in a background thread so
+    that the decompression overlaps with the parsing of the data. Multi-member
+    gzip files (including BGZF) are handled. The source can be any object with
+    a read() function, so this works for network streams as well as files.
+    """
+
+    def __init__(self, file_handle, block_size = BLOCK_SIZE, queue_size = 8):
+        """
+        Initialise the reader and start the decompression thread
+
+        Parameters
+        ----------
+        file_handle : file
+            Handle for the compressed stream
+        block_size : int
+            Number of compressed bytes to read from the stream at a time
+        queue_size : int
+            Maximum number of decompressed blocks held in memory waiting to be
+            read
+        """
+        self.file_handle = file_handle
+        self.block_size = block_size
+        self.queue = Queue.Queue(queue_size)
+
+        self.buffer = ''
+        self.buffer_pos = 0
+        self.finished = False
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.inflate)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def inflate(self):
+        """
+        Decompression loop run in the background thread. Each decompressed
+        block is put on the queue, followed by None at the end of the stream.
+        Any error is passed on the queue so that it is raised by read().
+        """
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            member_started = False
+            while self.closed == False:
+                data = self.file_handle.read(self.block_size)
+                if data == '':
+                    break
+
+                while data != '' and self.closed == False:
+                    block = decompressor.decompress(data)
+                    member_started = True
+                    if block != '':
+                        self.queue.put(block)
+
+                    # Any data after the end of a member is the start of the
+                    # next member
+                    data = decompressor.unused_data
+                    if data != '':
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        member_started = False
+                        if data.strip('\x00') == '':
+                            data = ''
+
+            if self.closed == False and member_started == True and member_complete(decompressor) == False:
+                raise IOError("Compressed stream is truncated")
+
+            block = decompressor.flush()
+            if block != '':
+                self.queue.put(block)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, size = -1):
+        """
+        Return up to size bytes of decompressed data. This can return fewer
+        bytes than requested; an empty string marks the end of the stream.
+        """
+        if self.buffer_pos >= len(self.buffer):
+            if self.finished == True:
+                return ''
+
+            block = self.queue.get()
+            if block is None:
+                self.finished = True
+                return ''
+            if isinstance(block, Exception):
+                self.finished = True
+                raise block
+
+            self.buffer = block
+            self.buffer_pos = 0
+
+        start = self.buffer_pos
+        if size < 0 or start + size >= len(self.buffer):
+            data = self.buffer[start:] if start > 0 else self.buffer
+            self.buffer = ''
+            self.buffer_pos = 0
+            return data
+
+        self.buffer_pos = start + size
+        return self.buffer[start:self.buffer_pos]
+
+    def close(self):
+        """
+        Stop the decompression thread and close the source stream
+        """
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.file_handle.close()
+
+
+class threadedwriter:
+    """
+    File-like writer that collects the written data into large buffers and
+    hands them to a background thread, which compresses them (optionally) and
+    writes them to disk. This keeps the number of write() calls low and takes
+    the compression off the main thread.
+    """
+
+    def __init__(self, file_name, compression = None, level = 1, buffer_size = WRITE_BUFFER_SIZE, queue_size = 4):
+        """
+        Initialise the writer and start the writer thread
+
+        Parameters
+        ----------
+        file_name : str
+            Location of the output file
+        compression : str
+            None for uncompressed output, 'gzip' or 'zstd'
+        level : int
+            Compression level. Level 1 is the fastest for both codecs
+        buffer_size : int
+            Number of bytes collected before they are passed to the thread
+        queue_size : int
+            Maximum number of buffers waiting to be written
+        """
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the \"zstandard\" package")
+        if compression not in COMPRESSION_SUFFIX:
+            raise ValueError("Unknown compression: " + str(compression))
+
+        self.file_name = file_name
+        self.compression = compression
+        self.level = level
+        self.buffer_size = buffer_size
+        self.queue = Queue.Queue(queue_size)
+
+        self.buffer = []
+        self.buffer_len = 0
+        self.error = None
+
+        self.file_handle = open(file_name, 'wb')
+
+        self.thread = threading.Thread(target=self.deflate)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def deflate(self):
+        """
+        Writer loop run in the background thread. Buffers are taken from the
+        queue until None is received.
+        """
+        try:
+            compressor = None
+            if self.compression == 'gzip':
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            elif self.compression == 'zstd':
+                compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                if compressor is not None:
+                    data = compressor.compress(data)
+                self.file_handle.write(data)
+
+            if compressor is not None:
+                self.file_handle.write(compressor.flush())
+        except Exception as e:
+            self.error = e
+            # Keep taking buffers so that write() and close() do not block
+            while self.queue.get() is not None:
+                pass
+        finally:
+            self.file_handle.close()
+
+    def flush(self):
+        """
+        Pass the buffered data to the writer thread
+        """
+        if self.error is not None:
+            raise self.error
+        if self.buffer_len > 0:
+            self.queue.put(''.join(self.buffer))
+            self.buffer = []
+            self.buffer_len = 0
+
+    def write(self, data):
+        """
+        Add data to the buffer
+        """
+        self.buffer.append(data)
+        self.buffer_len += len(data)
+        if self.buffer_len >= self.buffer_size:
+            self.flush()
+
+    def close(self):
+        """
+        Write out the remaining data and wait for the writer thread to finish
+        """
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def default_compression():
+    """
+    Get the fastest compression codec that is available for output files
+    """
+    if zstandard is not None:
+        return 'zstd'
+    return 'gzip'
+
+
+def bgzf_block_size(header):
+    """
+    Get the total size of a BGZF block from the BSIZE field in the extra
+    subfields of its gzip header. Returns None if the header is not a BGZF
+    block header.
+
+    Parameters
+    ----------
+    header : str
+        Bytes from the start of the block, including the full extra field
+    """
+    if len(header) < 18 or header[0:4] != GZIP_MAGIC + '\x08\x04':
+        return None
+
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + xlen]
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == 'BC' and slen == 2:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + slen
+    return None
+
+
+def bgzf_blocks(file_handle, offset = 0, end = None):
+    """
+    Generator of the raw compressed BGZF blocks in a file. The block
+    boundaries are taken from the block headers so no decompression is
+    needed.
+
+    Parameters
+    ----------
+    file_handle : file
+        Handle for the BGZF file, positioned at the start of a block
+    offset : int
+        Position of the file handle in the compressed file
+    end : int
+        Blocks starting at or after this compressed offset are not returned
+
+    Yields
+    ------
+    tuple
+        (offset of the block in the compressed file, block bytes)
+    """
+    while end is None or offset < end:
+        header = file_handle.read(18)
+        if header == '':
+            return
+        if len(header) < 18:
+            raise IOError("Truncated BGZF block at offset " + str(offset))
+        xlen = struct.unpack('<H', header[10:12])[0]
+        header += file_handle.read(xlen - 6)
+
+        block_size = bgzf_block_size(header)
+        if block_size is None:
+            raise IOError("Invalid BGZF block at offset " + str(offset))
+
+        block = header + file_handle.read(block_size - len(header))
+        if len(block) != block_size:
+            raise IOError("Truncated BGZF block at offset " + str(offset))
+
+        yield (offset, block)
+        offset += block_size
+
+
+def inflate_blocks(blocks):
+    """
+    Decompress a list of (offset, block) BGZF blocks
+
+    Returns
+    -------
+    list
+        (offset, decompressed data) for each of the blocks
+    """
+    return [(offset, zlib.decompress(block, 16 + zlib.MAX_WBITS)) for offset, block in blocks]
+
+
+class bgzfreader:
+    """
+    File-like reader for BGZF compressed files that inflates the blocks in
+    parallel on a thread pool while returning the data in order. zlib releases
+    the GIL while it works, so threads give a real speed up.
+
+    A part of the file can be read by giving the BGZF virtual offsets (block
+    offset << 16 | offset within the block) of the start and end.
+    """
+
+    def __init__(self, file_handle, threads = None, chunk_blocks = BGZF_CHUNK_BLOCKS, start = 0, end = None):
+        """
+        Initialise the reader
+
+        Parameters
+        ----------
+        file_handle : file
+            Handle for the BGZF file
+        threads : int
+            Number of decompression threads. Defaults to the number of CPUs
+        chunk_blocks : int
+            Number of BGZF blocks handled by each decompression task
+        start : int
+            Virtual offset to start reading from
+        end : int
+            Virtual offset to stop reading at. None reads to the end of the
+            file
+        """
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+
+        self.file_handle = file_handle
+        self.threads = threads
+        self.chunk_blocks = chunk_blocks
+
+        self.skip = start & 0xffff
+        self.end_block = None
+        self.end_skip = 0
+        block_end = None
+        if end is not None:
+            self.end_block = end >> 16
+            self.end_skip = end & 0xffff
+            block_end = self.end_block + 1 if self.end_skip > 0 else self.end_block
+
+        if start > 0:
+            file_handle.seek(start >> 16)
+        self.blocks = bgzf_blocks(file_handle, start >> 16, block_end)
+        self.pool = ThreadPool(threads)
+        self.pending = deque()
+        self.exhausted = False
+
+        self.buffer = ''
+        self.buffer_pos = 0
+
+    def fill(self):
+        """
+        Keep enough decompression tasks queued to occupy all of the threads
+        without holding the whole file in memory
+        """
+        while self.exhausted == False and len(self.pending) < 2 * self.threads:
+            chunk = []
+            for block in self.blocks:
+                chunk.append(block)
+                if len(chunk) == self.chunk_blocks:
+                    break
+
+            if len(chunk) < self.chunk_blocks:
+                self.exhausted = True
+            if len(chunk) > 0:
+                self.pending.append(self.pool.apply_async(inflate_blocks, (chunk,)))
+
+    def nextBlocks(self):
+        """
+        Get the next set of decompressed blocks, trimmed to the requested
+        range. Returns an empty list at the end of the range.
+
+        Returns
+        -------
+        list
+            (offset of the block in the compressed file, decompressed data)
+        """
+        self.fill()
+        if len(self.pending) == 0:
+            return []
+
+        blocks = self.pending.popleft().get()
+        # The end is cut first, as the range can start and end in one block
+        if self.end_skip > 0 and blocks[-1][0] == self.end_block:
+            blocks[-1] = (blocks[-1][0], blocks[-1][1][:self.end_skip])
+        if self.skip > 0:
+            blocks[0] = (blocks[0][0], blocks[0][1][self.skip:])
+            self.skip = 0
+        return blocks
+
+    def read(self, size = -1):
+        """
+        Return up to size bytes of decompressed data. This can return fewer
+        bytes than requested; an empty string marks the end of the file.
+        """
+        while self.buffer_pos >= len(self.buffer):
+            blocks = self.nextBlocks()
+            if len(blocks) == 0:
+                return ''
+            self.buffer = ''.join([data for offset, data in blocks])
+            self.buffer_pos = 0
+
+        start = self.buffer_pos
+        if size < 0 or start + size >= len(self.buffer):
+            data = self.buffer[start:] if start > 0 else self.buffer
+            self.buffer = ''
+            self.buffer_pos = 0
+            return data
+
+        self.buffer_pos = start + size
+        return self.buffer[start:self.buffer_pos]
+
+    def close(self):
+        """
+        Stop the thread pool and close the file
+        """
+        self.pool.terminate()
+        self.file_handle.close()
+
+
+class rangereader:
+    """
+    File-like reader that returns the bytes between two offsets of an
+    uncompressed stream. Seekable files jump straight to the start, other
+    streams are read up to the start and the data discarded.
+    """
+
+    def __init__(self, file_handle, start = 0, end = None):
+        """
+        Initialise the reader
+
+        Parameters
+        ----------
+        file_handle : file
+            Handle for the uncompressed data
+        start : int
+            Offset of the first byte to return
+        end : int
+            Offset to stop reading at. None reads to the end of the stream
+        """
+        self.file_handle = file_handle
+        self.remaining = None
+        if end is not None:
+            self.remaining = end - start
+
+        if hasattr(file_handle, 'seek'):
+            file_handle.seek(start)
+        else:
+            while start > 0:
+                data = file_handle.read(min(start, BLOCK_SIZE))
+                if data == '':
+                    break
+                start -= len(data)
+
+    def read(self, size = -1):
+        """
+        Return up to size bytes from the range. An empty string marks the end
+        of the range.
+        """
+        if self.remaining is None:
+            return self.file_handle.read(size)
+        if self.remaining <= 0:
+            return ''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file_handle.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        """
+        Close the underlying stream
+        """
+        self.file_handle.close()
+
+
+def is_bgzf(file_name):
+    """
+    Check if a file is BGZF compressed by looking at the first block header
+    """
+    with open(file_name, 'rb') as f_in:
+        return bgzf_block_size(f_in.read(1024)) is not None
+
+
+def is_gzip(file_name):
+    """
+    Check the magic number at the start of a file to see if it is gzip
+    compressed
+    """
+    with open(file_name, 'rb') as f_in:
+        return f_in.read(2) == GZIP_MAGIC
+
+
+def open_input(file_name, threads = None, start = None, end = None):
+    """
+    Open a file for reading. BGZF files are inflated in parallel by a
+    bgzfreader. Other gzip compressed files are decompressed on the fly by a
+    threadedreader, as the member boundaries in these can only be found by
+    inflating the stream. Uncompressed files are opened as they are.
+
+    A part of the file can be read by giving start and end offsets. For BGZF
+    files these are virtual offsets, for other files they are offsets in the
+    uncompressed data (gzip files are inflated from the beginning to find the
+    start).
+
+    Parameters
+    ----------
+    file_name : str
+        Location of the file
+    threads : int
+        Number of threads to use for BGZF files. Defaults to the number of
+        CPUs
+    start : int
+        Offset to start reading from
+    end : int
+        Offset to stop reading at
+
+    Returns
+    -------
+    file
+        Object with read() and close() functions
+    """
+    if is_bgzf(file_name) and (threads != 1 or start is not None or end is not None):
+        return bgzfreader(open(file_name, 'rb'), threads, start=start or 0, end=end)
+
+    if is_gzip(file_name):
+        f_in = threadedreader(open(file_name, 'rb'))
+    else:
+        f_in = open(file_name, 'r')
+
+    if start is not None or end is not None:
+        return rangereader(f_in, start or 0, end)
+    return f_in
+
+
+def decompress_file(file_in, file_out, threads = None):
+    """
+    Decompress a gzip or BGZF file to a new location
+
+    Parameters
+    ----------
+    file_in : str
+        Location of the compressed file
+    file_out : str
+        Location for the decompressed file
+    threads : int
+        Number of threads to use for BGZF files
+    """
+    f_in = open_input(file_in, threads)
+    try:
+        with open(file_out, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, BLOCK_SIZE)
+    finally:
+        f_in.close()
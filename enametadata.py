@@ -0,0 +1,290 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib, json, os, threading, time, urllib2
+
+from multiprocessing.pool import ThreadPool
+
+from filecache import CACHE_DIR_ENV
+
+FILEREPORT_URL = 'http://www.ebi.ac.uk/ena/data/warehouse/filereport?accession={accession}&result=read_run&fields={fields}&download=txt'
+FILEREPORT_FIELDS = ['study_accession', 'run_accession', 'tax_id', 'scientific_name', 'instrument_model', 'library_layout', 'fastq_ftp', 'fastq_md5']
+
+SEQUENCE_REPORT_URL = 'ftp://ftp.ebi.ac.uk/pub/databases/ena/assembly/{prefix7}/{prefix10}/{assembly}_sequence_report.txt'
+
+# Environment variable for the number of seconds that a cached report is used
+# for before it is fetched again
+METADATA_TTL_ENV = 'MG_METADATA_TTL'
+METADATA_TTL = 24 * 60 * 60
+
+# Number of seconds that a report with no records is used for, so that a run
+# whose files are not yet in the report is not hidden for the whole TTL
+METADATA_EMPTY_TTL = 5 * 60
+
+# Number of reports that are fetched at the same time by the bulk queries
+METADATA_THREADS = 8
+
+
+def parse_report(text):
+    """
+    Parse a tab separated report with a header row into a list of records
+
+    Returns
+    -------
+    list
+        A dict for each row, keyed on the names in the header
+    """
+    rows = [row.rstrip('\r') for row in text.split('\n')]
+    rows = [row for row in rows if row.strip() != '']
+    if len(rows) == 0:
+        return []
+
+    header = rows[0].lstrip('#').strip().split('\t')
+    records = []
+    for row in rows[1:]:
+        cols = row.split('\t')
+        records.append(dict(zip(header, cols + [''] * (len(header) - len(cols)))))
+    return records
+
+
+def metadata_from_environment():
+    """
+    Get the metadata layer with the reports cached in the metadata directory
+    of the shared cache (MG_CACHE_DIR). If that is not set the reports are
+    only cached in memory.
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir is not None and cache_dir != '':
+        cache_dir = os.path.join(cache_dir, 'metadata')
+    else:
+        cache_dir = None
+
+    ttl = os.environ.get(METADATA_TTL_ENV)
+    if ttl is None or ttl == '':
+        return enametadata(cache_dir)
+    return enametadata(cache_dir, int(ttl))
+
+
+class enametadata:
+    """
+    Structured access to the ENA filereport and assembly sequence_report
+    metadata. The reports are parsed into records and kept in memory and,
+    if a cache directory is given, on disk as JSON so that they are shared
+    between processes. A cached report is used until it is older than the
+    TTL, or METADATA_EMPTY_TTL if it has no records. Answers that are not a
+    report (eg an error message) are not cached.
+
+    The bulk queries fetch the reports that are not cached concurrently. The
+    filereport endpoint only takes a single accession in each request, so
+    this is one request per accession.
+    """
+
+    def __init__(self, cache_dir = None, ttl = METADATA_TTL):
+        """
+        Initialise the metadata layer
+
+        Parameters
+        ----------
+        cache_dir : str
+            Location to cache the reports in. None to only cache them in
+            memory
+        ttl : int
+            Number of seconds a cached report is used for
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.empty_ttl = min(ttl, METADATA_EMPTY_TTL)
+        self.reports = {}
+        self.lock = threading.Lock()
+
+        if cache_dir is not None and os.path.isdir(cache_dir) == False:
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if os.path.isdir(cache_dir) == False:
+                    raise
+
+    def cacheFile(self, url):
+        """
+        Location of the cached copy of the report for a URL
+        """
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest() + '.json')
+
+    def reportTTL(self, records):
+        """
+        Number of seconds that a report with the given records is used for
+        """
+        if len(records) == 0:
+            return self.empty_ttl
+        return self.ttl
+
+    def cached(self, url):
+        """
+        Get the records for a URL from the cache
+
+        Returns
+        -------
+        list
+            None if the report is not cached or is older than the TTL
+        """
+        now = time.time()
+        with self.lock:
+            if url in self.reports and now - self.reports[url][0] < self.reportTTL(self.reports[url][1]):
+                return self.reports[url][1]
+
+        if self.cache_dir is None or os.path.isfile(self.cacheFile(url)) == False:
+            return None
+
+        with open(self.cacheFile(url), 'r') as f_in:
+            try:
+                report = json.load(f_in)
+            except ValueError:
+                return None
+
+        if report.get('url') != url or now - report['fetched'] >= self.reportTTL(report['records']):
+            return None
+
+        with self.lock:
+            self.reports[url] = (report['fetched'], report['records'])
+        return report['records']
+
+    def save(self, url, records):
+        """
+        Add the records for a URL to the cache
+        """
+        fetched = time.time()
+        with self.lock:
+            self.reports[url] = (fetched, records)
+
+        if self.cache_dir is None:
+            return
+
+        # Written under a unique name and renamed so that other processes
+        # never see a partial file
+        tmp_file = self.cacheFile(url) + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident)
+        with open(tmp_file, 'w') as f_out:
+            json.dump({'url': url, 'fetched': fetched, 'records': records}, f_out)
+        os.rename(tmp_file, self.cacheFile(url))
+
+    def report(self, url, key_field = None):
+        """
+        Get the records for a report, from the cache if there is a current
+        copy and otherwise from the server
+
+        Parameters
+        ----------
+        url : str
+            URL of the report
+        key_field : str
+            Column that every report from the URL has. If the answer from the
+            server has records without it, it is not a report and an IOError
+            is raised.
+        """
+        records = self.cached(url)
+        if records is not None:
+            return records
+
+        f_in = urllib2.urlopen(url)
+        try:
+            records = parse_report(f_in.read())
+        finally:
+            f_in.close()
+
+        if key_field is not None and len(records) > 0 and key_field not in records[0]:
+            raise IOError("Not a valid report: " + url)
+
+        self.save(url, records)
+        return records
+
+    def reports_for(self, urls, key_field = None):
+        """
+        Get the records for a set of reports, fetching the ones that are not
+        cached concurrently. key_field is as for report().
+
+        Returns
+        -------
+        list
+            The records for each of the URLs
+        """
+        missing = [url for url in set(urls) if self.cached(url) is None]
+        if len(missing) > 1:
+            pool = ThreadPool(min(METADATA_THREADS, len(missing)))
+            try:
+                pool.map(lambda url: self.report(url, key_field), missing)
+            finally:
+                pool.close()
+                pool.join()
+        return [self.report(url, key_field) for url in urls]
+
+    def filereportURL(self, accession):
+        """
+        URL of the read_run filereport for an accession
+        """
+        return FILEREPORT_URL.format(accession=str(accession), fields=','.join(FILEREPORT_FIELDS))
+
+    def sequenceReportURL(self, assembly):
+        """
+        URL of the sequence report for an assembly
+        """
+        return SEQUENCE_REPORT_URL.format(prefix7=assembly[0:7], prefix10=assembly[0:10], assembly=assembly)
+
+    def filereport(self, accession):
+        """
+        Get the runs for a study, experiment or run accession
+
+        Returns
+        -------
+        list
+            A dict for each run with the FILEREPORT_FIELDS
+        """
+        return self.report(self.filereportURL(accession), 'run_accession')
+
+    def filereports(self, accessions):
+        """
+        Get the runs for a set of accessions at once
+
+        Returns
+        -------
+        dict
+            accession : list of the runs, as returned by filereport()
+        """
+        records = self.reports_for([self.filereportURL(accession) for accession in accessions], 'run_accession')
+        return dict(zip(accessions, records))
+
+    def sequenceReport(self, assembly):
+        """
+        Get the sequences in an assembly
+
+        Returns
+        -------
+        list
+            A dict for each sequence with the accession, sequence-name,
+            sequence-length, sequence-role, replicon-name, replicon-type and
+            assembly-unit
+        """
+        return self.report(self.sequenceReportURL(assembly), 'accession')
+
+    def sequenceReports(self, assemblies):
+        """
+        Get the sequences for a set of assemblies at once
+
+        Returns
+        -------
+        dict
+            assembly : list of the sequences, as returned by sequenceReport()
+        """
+        records = self.reports_for([self.sequenceReportURL(assembly) for assembly in assemblies], 'accession')
+        return dict(zip(assemblies, records))
@@ -24,14 +24,15 @@ from pytadbit.mapping               import get_intersection
 from pytadbit.mapping.filter        import apply_filter
 from pytadbit.mapping.filter        import filter_reads
 from pytadbit.mapping.mapper        import full_mapping
-from pytadbit.parsers.map_parser    import parse_map
 from pytadbit.parsers.hic_parser    import load_hic_data_from_reads
 from pytadbit.parsers.hic_parser    import read_matrix
-from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.utils.file_handling   import mkdir
 import numpy as np
 import h5py
 
+from genomestore import load_genome
+from resitecache import load_re_sites
+
 
 class fastq2adjacency:
     """
@@ -167,9 +168,11 @@ class fastq2adjacency:
     
     def parseGenomeSeq(self):
         """
-        Loads the genome
+        Loads the genome as a memory mapped, 2-bit packed genomestore. The
+        genome is packed alongside the FASTA file the first time it is used
+        and the packed copy is shared by all of the processes on a node.
         """
-        self.genome_seq = parse_fasta(self.genome_file)
+        self.genome_seq = load_genome(self.genome_file)
     
     
     @constraint(ProcessorCoreCount=8)
@@ -186,8 +189,14 @@ class fastq2adjacency:
         
         mapped_rN = self.getMappedWindows()
 
+        # The restriction sites are only found once for each genome and
+        # enzyme, so the reads are assigned to their fragments from the saved
+        # sites rather than with parse_map, which scans the genome each time
+        re_sites = load_re_sites(self.genome_seq, self.enzyme_name)
+
         print 'Parse MAP files...'
-        parse_map(mapped_rN["mapped_r1"], mapped_rN["mapped_r2"], out_file1=reads1, out_file2=reads2, genome_seq=self.genome_seq, re_name=self.enzyme_name, verbose=True, ncpus=num_cpus)
+        re_sites.parseMaps(mapped_rN["mapped_r1"], reads1, ncpus=num_cpus, verbose=True)
+        re_sites.parseMaps(mapped_rN["mapped_r2"], reads2, ncpus=num_cpus, verbose=True)
     
     def mergeMaps(self):
         """
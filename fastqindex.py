@@ -0,0 +1,256 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json, os.path
+
+from compression import bgzfreader, is_bgzf, is_gzip, open_input
+
+# Suffix of the sidecar file that the index is saved to
+INDEX_SUFFIX = '.fqi'
+
+# Default number of records between the offsets saved in the index
+INDEX_STEP = 10000
+
+
+class fastqindex:
+    """
+    Index of the offsets of every Nth record in a FastQ file. This allows for
+    the file to be divided into ranges of records that can be read directly
+    with fastqreader.openPairedFastQ() without having to write copies of the
+    file.
+
+    The position of each indexed record in the uncompressed data is kept as
+    well, so that ranges can be balanced on size.
+
+    For uncompressed files the offsets are byte offsets. For BGZF files they
+    are virtual offsets (block offset << 16 | offset within the block). Other
+    gzip files can be indexed, but the offsets are into the decompressed data
+    so the file has to be inflated up to the start of a range to read it.
+    """
+
+    def __init__(self, file_name, step = INDEX_STEP):
+        """
+        Initialise the index
+
+        Parameters
+        ----------
+        file_name : str
+            Location of the FastQ file
+        step : int
+            Number of records between each of the indexed offsets
+        """
+        self.file_name = file_name
+        self.index_file = file_name + INDEX_SUFFIX
+        self.step = step
+
+        self.offsets = []
+        self.positions = []
+        self.records = 0
+        self.length = 0
+        self.bgzf = False
+        self.seekable = True
+
+    def segments(self):
+        """
+        Generator of the decompressed data in the file
+
+        Yields
+        ------
+        tuple
+            (position, data, virtual). When virtual is True the position is
+            the offset of the BGZF block, otherwise it is the offset of the
+            data in the decompressed file.
+        """
+        if self.bgzf == True:
+            reader = bgzfreader(open(self.file_name, 'rb'))
+            try:
+                while True:
+                    blocks = reader.nextBlocks()
+                    if len(blocks) == 0:
+                        break
+                    for offset, data in blocks:
+                        yield (offset, data, True)
+            finally:
+                reader.close()
+            return
+
+        f_in = open_input(self.file_name)
+        try:
+            position = 0
+            while True:
+                data = f_in.read(4 * 1024 * 1024)
+                if data == '':
+                    break
+                yield (position, data, False)
+                position += len(data)
+        finally:
+            f_in.close()
+
+    def build(self):
+        """
+        Read through the file once and record the offset of the start of
+        every step-th record. Records are assumed to be 4 lines long, as they
+        are in fastqreader.
+        """
+        self.bgzf = is_bgzf(self.file_name)
+        self.seekable = self.bgzf or is_gzip(self.file_name) == False
+
+        self.offsets = []
+        self.positions = []
+        self.length = 0
+
+        line_count = 0
+        next_line = 0
+        pending = False
+        last_char = '\n'
+
+        for position, data, virtual in self.segments():
+            if len(data) == 0:
+                continue
+
+            # A record starting right after the end of the previous segment
+            if pending == True:
+                self.offsets.append(position << 16 if virtual else position)
+                self.positions.append(self.length)
+                pending = False
+
+            newlines = data.count('\n')
+            while next_line <= line_count + newlines:
+                skip_lines = next_line - line_count
+                if skip_lines == 0:
+                    pos = 0
+                else:
+                    pos = len(data) - len(data.split('\n', skip_lines)[-1])
+
+                if pos == len(data):
+                    pending = True
+                    next_line += 4 * self.step
+                    continue
+
+                if virtual == True:
+                    self.offsets.append(position << 16 | pos)
+                else:
+                    self.offsets.append(position + pos)
+                self.positions.append(self.length + pos)
+                next_line += 4 * self.step
+
+            line_count += newlines
+            self.length += len(data)
+            last_char = data[-1]
+
+        # Count a final line without a trailing new line
+        if last_char != '\n':
+            line_count += 1
+        self.records = line_count // 4
+
+    def save(self):
+        """
+        Save the index to the sidecar file alongside the FastQ file
+        """
+        stat = os.stat(self.file_name)
+        index = {
+            'file': os.path.basename(self.file_name),
+            'size': stat.st_size,
+            'mtime': int(stat.st_mtime),
+            'step': self.step,
+            'records': self.records,
+            'length': self.length,
+            'bgzf': self.bgzf,
+            'seekable': self.seekable,
+            'offsets': self.offsets,
+            'positions': self.positions
+        }
+        with open(self.index_file, 'w') as f_out:
+            json.dump(index, f_out)
+
+    def load(self):
+        """
+        Load the index from the sidecar file. Returns False if there is no
+        index or if it was made for a different version of the FastQ file or
+        with a different step.
+        """
+        if os.path.isfile(self.index_file) == False:
+            return False
+
+        with open(self.index_file, 'r') as f_in:
+            try:
+                index = json.load(f_in)
+            except ValueError:
+                return False
+
+        stat = os.stat(self.file_name)
+        if index['size'] != stat.st_size or index['mtime'] != int(stat.st_mtime) or index['step'] != self.step:
+            return False
+        if 'positions' not in index:
+            return False
+
+        self.records = index['records']
+        self.length = index['length']
+        self.bgzf = index['bgzf']
+        self.seekable = index['seekable']
+        self.offsets = index['offsets']
+        self.positions = index['positions']
+        return True
+
+    def getRanges(self, records_per_range):
+        """
+        Divide the file into ranges of records
+
+        Parameters
+        ----------
+        records_per_range : int
+            Number of records in each range. This is rounded up to a multiple
+            of the index step
+
+        Returns
+        -------
+        list
+            (start, end) offsets for each range that can be passed to
+            compression.open_input(). The end of the last range is None
+        """
+        entries = max(1, -(-records_per_range // self.step))
+        return self.getEntryRanges(range(0, len(self.offsets), entries))
+
+    def getEntryRanges(self, entries):
+        """
+        Get the ranges that start at each of the given entries in the index
+
+        Parameters
+        ----------
+        entries : list
+            Sorted positions in the list of offsets, starting with 0
+
+        Returns
+        -------
+        list
+            (start, end) offsets for each range. The end of the last range is
+            None
+        """
+        starts = [self.offsets[i] for i in entries]
+        ends = starts[1:] + [None]
+        return zip(starts, ends)
+
+
+def index_fastq(file_name, step = INDEX_STEP):
+    """
+    Get the index for a FastQ file, loading it from the sidecar file if it is
+    up to date and building and saving it otherwise
+    """
+    fqi = fastqindex(file_name, step)
+    if fqi.load() == False:
+        fqi.build()
+        fqi.save()
+    return fqi
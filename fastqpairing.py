@@ -0,0 +1,230 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os, shutil, tempfile, zlib
+
+from fastqreader import fastqblockreader, record_text
+
+# Number of records compared at a time while the files are in the same order
+BATCH_SIZE = 10000
+
+# Approximate number of bytes of FastQ from one side held in memory while
+# joining a partition
+PARTITION_SIZE = 128 * 1024 * 1024
+
+# Number of partitions for the hash join of streams, as the size of the
+# files is not known. 64 partitions of PARTITION_SIZE cover 8GB of FastQ on
+# each side.
+STREAM_PARTITIONS = 64
+
+
+def read_key(read_id):
+    """
+    Get the part of a read id that is shared between the two mates. This is
+    the first word of the id with any /1 or /2 suffix removed. Buffers from
+    a fastqmmapreader are copied to a string.
+    """
+    key = str(read_id).split(' ', 1)[0]
+    if key[-2:] == '/1' or key[-2:] == '/2':
+        key = key[:-2]
+    return key
+
+
+class fastqpairer:
+    """
+    Pairs up the reads from two mate FastQ files opened in a fastqreader.
+
+    While both files are in the same order the reads are paired in lock-step.
+    From the first point where they are not, the rest of both files is paired
+    with a hash join. Both sides are partitioned on the hash of the read id
+    into spill files on disk, then each partition is joined in memory, so the
+    memory used is bounded by the partition size whatever the order of the
+    input.
+    """
+
+    def __init__(self, fqr, tmp_dir = None, partition_size = PARTITION_SIZE):
+        """
+        Initialise the pairer
+
+        Parameters
+        ----------
+        fqr : fastqreader
+            Reader with the paired FastQ files already open
+        tmp_dir : str
+            Location for the spill files used by the hash join
+        partition_size : int
+            Target number of bytes of FastQ for one side of a partition
+        """
+        self.fqr = fqr
+        self.tmp_dir = tmp_dir
+        self.partition_size = partition_size
+
+        self.paired = 0
+        self.orphans = {1: 0, 2: 0}
+        self.co_ordered = True
+
+    def pairs(self):
+        """
+        Generator of the matching pairs of reads
+
+        Yields
+        ------
+        tuple
+            (read 1, read 2) with each read as an (id, seq, add, score) tuple
+        """
+        while True:
+            batch1 = self.fqr.nextBatch(1, BATCH_SIZE)
+            batch2 = self.fqr.nextBatch(2, BATCH_SIZE)
+            reads1 = zip(batch1['id'], batch1['seq'], batch1['add'], batch1['score'])
+            reads2 = zip(batch2['id'], batch2['seq'], batch2['add'], batch2['score'])
+
+            if len(reads1) == 0 or len(reads2) == 0:
+                self.orphans[1] += len(reads1)
+                self.orphans[2] += len(reads2)
+                self.countOrphans()
+                return
+
+            keys1 = [read_key(read_id) for read_id in batch1['id']]
+            keys2 = [read_key(read_id) for read_id in batch2['id']]
+            if keys1 == keys2:
+                self.paired += len(reads1)
+                for pair in zip(reads1, reads2):
+                    yield pair
+                continue
+
+            # Pair up to the first difference then join the rest
+            i = 0
+            while i < len(keys1) and i < len(keys2) and keys1[i] == keys2[i]:
+                yield (reads1[i], reads2[i])
+                i += 1
+            self.paired += i
+
+            self.co_ordered = False
+            for pair in self.hashJoin(reads1[i:], reads2[i:]):
+                yield pair
+            return
+
+    def countOrphans(self):
+        """
+        Count the reads that are left in either file once the other has
+        finished
+        """
+        for side in [1, 2]:
+            while self.fqr.eof(side) == False:
+                self.orphans[side] += len(self.fqr.nextBatch(side, BATCH_SIZE)['id'])
+
+    def hashJoin(self, reads1, reads2):
+        """
+        Pair the given reads and the rest of both files with a partitioned
+        hash join
+
+        Parameters
+        ----------
+        reads1 : list
+            Reads already taken from file 1 that still need pairing
+        reads2 : list
+            Reads already taken from file 2 that still need pairing
+        """
+        partitions = self.partitionCount()
+
+        spill_dir = tempfile.mkdtemp(prefix='pairing_', dir=self.tmp_dir)
+        try:
+            spill_files = {}
+            for side, reads in [[1, reads1], [2, reads2]]:
+                spill_files[side] = self.partition(side, reads, spill_dir, partitions)
+
+            for p in range(partitions):
+                for pair in self.joinPartition(spill_files[1][p], spill_files[2][p]):
+                    yield pair
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    def partitionCount(self):
+        """
+        Number of partitions for the hash join, enough for each partition to
+        be about partition_size. The size of files is estimated from the
+        larger of the two (gzip files taken to be a quarter of the size of the
+        FastQ). Streams have no size, so they get STREAM_PARTITIONS.
+        """
+        if self.fqr.streamed == True:
+            return STREAM_PARTITIONS
+
+        size = 0
+        for fastq in [self.fqr.fastq1, self.fqr.fastq2]:
+            file_size = os.path.getsize(fastq)
+            if fastq.endswith('.gz'):
+                file_size *= 4
+            size = max(size, file_size)
+        return max(1, -(-size // self.partition_size))
+
+    def partition(self, side, reads, spill_dir, partitions):
+        """
+        Write the reads and the rest of one of the files to spill files,
+        partitioned on the hash of the read id
+
+        Returns
+        -------
+        list
+            Locations of the spill file for each partition
+        """
+        file_names = [os.path.join(spill_dir, str(side) + '_' + str(p) + '.fastq') for p in range(partitions)]
+        spill = [open(file_name, 'w') for file_name in file_names]
+        try:
+            while True:
+                for read in reads:
+                    p = (zlib.crc32(read_key(read[0])) & 0xffffffff) % partitions
+                    spill[p].write(record_text(read))
+
+                if self.fqr.eof(side) == True:
+                    break
+                batch = self.fqr.nextBatch(side, BATCH_SIZE)
+                reads = zip(batch['id'], batch['seq'], batch['add'], batch['score'])
+        finally:
+            for f_out in spill:
+                f_out.close()
+        return file_names
+
+    def joinPartition(self, file1, file2):
+        """
+        Join a single partition in memory. Reads from file 1 are loaded into a
+        dict and the reads from file 2 are matched against them.
+        """
+        reads1 = {}
+        with open(file1, 'r') as f_in:
+            reader = fastqblockreader(f_in)
+            while True:
+                read = reader.nextRecord()
+                if read == False:
+                    break
+                key = read_key(read[0])
+                if key in reads1:
+                    self.orphans[1] += 1
+                reads1[key] = read
+
+        with open(file2, 'r') as f_in:
+            reader = fastqblockreader(f_in)
+            while True:
+                read = reader.nextRecord()
+                if read == False:
+                    break
+                read1 = reads1.pop(read_key(read[0]), None)
+                if read1 is None:
+                    self.orphans[2] += 1
+                else:
+                    self.paired += 1
+                    yield (read1, read)
+
+        self.orphans[1] += len(reads1)
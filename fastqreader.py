@@ -16,6 +16,337 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import mmap, os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from compression import is_gzip, open_input, threadedwriter, COMPRESSION_SUFFIX
+
+try:
+    from fastqstats import fastqstats
+except ImportError:
+    fastqstats = None
+
+# Size of the blocks that are read from the FastQ files in a single call
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Number of bytes of a memory mapped file that are scanned for new lines at a
+# time
+MMAP_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Characters that are stripped from the end of each line, as rstrip() did for
+# each line read with readline()
+TRAILING_WHITESPACE = ' \t\r'
+TRAILING_BYTES = [ord(char) for char in TRAILING_WHITESPACE]
+
+
+def record_text(record):
+    """
+    Get the text of a record tuple as it is written to a FastQ file. Records
+    from a fastqmmapreader hold buffers that are copied into strings here.
+    """
+    try:
+        return "\n".join(record) + "\n"
+    except TypeError:
+        return "\n".join([str(line) for line in record]) + "\n"
+
+
+class fastqblockreader:
+    """
+    Block buffered parser for a single FastQ file. Large blocks are read from
+    the file handle and split into lines in a single pass so that the records
+    can be handed out without a readline() call for each line. Trailing
+    whitespace is removed from each line. Blank lines between records, as
+    left by concatenating files, are skipped.
+    """
+    
+    def __init__(self, file_handle, block_size = BLOCK_SIZE):
+        """
+        Initialise the parser
+        
+        Parameters
+        ----------
+        file_handle : file
+            Open file handle (or object with a matching read() function) for
+            the FastQ file
+        block_size : int
+            Number of bytes to request from the file handle for each block
+        """
+        self.file_handle = file_handle
+        self.block_size = block_size
+        
+        self.lines = []
+        self.line_pos = 0
+        self.remainder = ''
+        self.eof = False
+    
+    def fill(self):
+        """
+        Read blocks from the file until there is at least one complete record
+        in the line buffer. Returns False when there are no more records.
+        """
+        lines = self.lines[self.line_pos:]
+        while len(lines) < 4 and self.eof == False:
+            block = self.file_handle.read(self.block_size)
+            if block == '':
+                self.eof = True
+                if self.remainder != '':
+                    lines.append(self.remainder.rstrip(TRAILING_WHITESPACE))
+                    self.remainder = ''
+                break
+            
+            if '\r' in block:
+                block = block.replace('\r', '')
+            
+            text = self.remainder + block
+            block_lines = text.split('\n')
+            self.remainder = block_lines.pop()
+            
+            # Trailing spaces and tabs are rare, so the lines are only
+            # stripped when there are some in the block
+            if ' \n' in text or '\t\n' in text:
+                block_lines = [line.rstrip(TRAILING_WHITESPACE) for line in block_lines]
+            lines.extend(block_lines)
+        
+        # A truncated final record is padded in the same way that readline()
+        # would have returned empty strings. Blank lines at the end of the
+        # file are dropped first, they are not a record.
+        if self.eof == True:
+            while len(lines) > 0 and lines[0] == '':
+                lines.pop(0)
+            if 0 < len(lines) < 4:
+                lines.extend([''] * (4 - len(lines)))
+        
+        self.lines = lines
+        self.line_pos = 0
+        return len(lines) >= 4
+    
+    def nextRecord(self):
+        """
+        Get the next record from the file as an (id, seq, add, score) tuple.
+        Returns False once the end of the file has been reached.
+        """
+        while True:
+            if self.line_pos + 4 > len(self.lines):
+                if self.fill() == False:
+                    return False
+            
+            # Skip a blank line between records
+            if self.lines[self.line_pos] != '':
+                break
+            self.line_pos += 1
+        
+        lines = self.lines
+        pos = self.line_pos
+        self.line_pos = pos + 4
+        return (lines[pos], lines[pos+1], lines[pos+2], lines[pos+3])
+    
+    def nextBatch(self, count):
+        """
+        Get up to count records from the file as parallel lists. Fewer records
+        are returned once the end of the file is reached.
+        
+        Returns
+        -------
+        dict
+            id : list
+            seq : list
+            add : list
+            score : list
+        """
+        batch = {'id': [], 'seq': [], 'add': [], 'score': []}
+        found = 0
+        while found < count:
+            if self.line_pos + 4 > len(self.lines):
+                if self.fill() == False:
+                    break
+            
+            lines = self.lines
+            pos = self.line_pos
+            end = pos + 4 * min(count - found, (len(lines) - pos) // 4)
+            
+            ids = lines[pos:end:4]
+            if '' in ids:
+                # The records up to a blank line, which is skipped
+                end = pos + 4 * ids.index('')
+                ids = lines[pos:end:4]
+                self.line_pos = end + 1
+            else:
+                self.line_pos = end
+            
+            batch['id'].extend(ids)
+            batch['seq'].extend(lines[pos+1:end:4])
+            batch['add'].extend(lines[pos+2:end:4])
+            batch['score'].extend(lines[pos+3:end:4])
+            found += len(ids)
+        
+        return batch
+
+
+class fastqmmapreader:
+    """
+    Parser for a single uncompressed FastQ file that is memory mapped rather
+    than read. Records are returned with each line as a read-only buffer
+    into the mapped file so no data is copied until the caller converts a
+    line with str(). Several processes reading the same file share its
+    pages in the page cache.
+
+    Buffers support len(), slicing, comparison and numpy.frombuffer(), and
+    can be written to files directly. As in fastqblockreader, blank lines
+    between records are skipped.
+    """
+    
+    def __init__(self, file_name, start = None, end = None):
+        """
+        Initialise the parser
+        
+        Parameters
+        ----------
+        file_name : str
+            Location of the uncompressed FastQ file
+        start : int
+            Byte offset of the first record to read
+        end : int
+            Byte offset to stop reading at. None to read to the end of the
+            file
+        """
+        self.file_handle = open(file_name, 'rb')
+        self.size = os.fstat(self.file_handle.fileno()).st_size
+        
+        self.map = None
+        self.array = None
+        if self.size > 0:
+            self.map = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+            if numpy is not None:
+                self.array = numpy.frombuffer(self.map, dtype=numpy.uint8)
+        
+        self.pos = 0 if start is None else start
+        self.end = self.size if end is None else min(end, self.size)
+        self.eof = self.pos >= self.end
+    
+    def nextLine(self):
+        """
+        Get the next line as a buffer without the new line or trailing
+        whitespace. An empty string is returned once the end of the range has
+        been reached.
+        """
+        if self.pos >= self.end:
+            self.eof = True
+            return ''
+        
+        line_end = self.map.find('\n', self.pos, self.end)
+        if line_end == -1:
+            line_end = self.end
+        
+        start = self.pos
+        self.pos = line_end + 1
+        
+        length = line_end - start
+        while length > 0 and self.map[start + length - 1] in TRAILING_WHITESPACE:
+            length -= 1
+        return buffer(self.map, start, length)
+    
+    def nextRecord(self):
+        """
+        Get the next record from the file as an (id, seq, add, score) tuple of
+        buffers. Returns False once the end of the file has been reached.
+        """
+        if self.eof == True:
+            return False
+        
+        read_id = self.nextLine()
+        while len(read_id) == 0 and self.pos < self.end:
+            # Blank line between records
+            read_id = self.nextLine()
+        if len(read_id) == 0:
+            self.eof = True
+            return False
+        return (read_id, self.nextLine(), self.nextLine(), self.nextLine())
+    
+    def nextBatch(self, count):
+        """
+        Get up to count records from the file as parallel lists of buffers.
+        Fewer records are returned once the end of the file is reached.
+        
+        When numpy is available the new lines are found a chunk at a time
+        with numpy rather than one line at a time.
+        
+        Returns
+        -------
+        dict
+            id : list
+            seq : list
+            add : list
+            score : list
+        """
+        batch = {'id': [], 'seq': [], 'add': [], 'score': []}
+        found = 0
+        while found < count and self.eof == False:
+            lines = []
+            if self.array is not None:
+                lines = self.chunkLines(count - found)
+            
+            if len(lines) == 0:
+                # No complete record in the next chunk, or no numpy
+                record = self.nextRecord()
+                if record == False:
+                    break
+                lines = record
+            
+            batch['id'].extend(lines[0::4])
+            batch['seq'].extend(lines[1::4])
+            batch['add'].extend(lines[2::4])
+            batch['score'].extend(lines[3::4])
+            found += len(lines) // 4
+        
+        return batch
+    
+    def chunkLines(self, count):
+        """
+        Get the lines of up to count complete records from the next chunk of
+        the file as a flat list of buffers
+        """
+        end = min(self.end, self.pos + MMAP_CHUNK_SIZE)
+        newlines = numpy.flatnonzero(self.array[self.pos:end] == 10)
+        line_count = 4 * min(len(newlines) // 4, count)
+        if line_count == 0:
+            return []
+        
+        ends = newlines[:line_count] + self.pos
+        starts = numpy.empty(line_count, dtype=numpy.int64)
+        starts[0] = self.pos
+        starts[1:] = ends[:-1] + 1
+        lengths = ends - starts
+        while True:
+            trailing = (lengths > 0) & numpy.in1d(self.array[starts + lengths - 1], TRAILING_BYTES)
+            if trailing.any() == False:
+                break
+            lengths -= trailing
+        
+        # The records up to a blank line, which is skipped
+        empty = numpy.flatnonzero(lengths[0::4] == 0)
+        if len(empty) > 0:
+            line_count = 4 * int(empty[0])
+            self.pos = int(ends[line_count]) + 1
+        else:
+            self.pos = int(ends[-1]) + 1
+        
+        return map(buffer, [self.map] * line_count, starts[:line_count].tolist(), lengths[:line_count].tolist())
+    
+    def close(self):
+        """
+        Unmap and close the file
+        """
+        self.array = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file_handle.close()
+
+
 class fastqreader:
     
     def __init__(self):
@@ -24,32 +355,104 @@ class fastqreader:
         """
         self.fastq1 = ''
         self.fastq2 = ''
+        self.streamed = False
         
         self.f1_file = None
         self.f2_file = None
         
+        self.f1_reader = None
+        self.f2_reader = None
+        
         self.f1_eof = False
         self.f2_eof = False
         
+        self.f1_stats = None
+        self.f2_stats = None
+        
         self.f1_output_file = None
         self.f2_output_file = None
         
         self.output_tag = ''
         self.output_file_count = 0
+        self.output_compression = None
     
-    def openPairedFastQ(self, file1, file2):
+    def openPairedFastQ(self, file1, file2, range1 = None, range2 = None, threads = None, use_mmap = False):
         """
-        Create file handles for reading the FastQ files
+        Create file handles for reading the FastQ files. gzip compressed files
+        are decompressed on the fly in a background thread.
+        
+        range1 and range2 can be (start, end) offsets from a fastqindex so
+        that only that part of each file is read. threads sets the number of
+        decompression threads for each BGZF file.
+        
+        With use_mmap uncompressed files are memory mapped and the reads are
+        returned with buffers in place of strings (see fastqmmapreader).
         """
         self.fastq1 = file1
         self.fastq2 = file2
+        self.streamed = False
+        
+        if range1 is None:
+            range1 = (None, None)
+        if range2 is None:
+            range2 = (None, None)
         
-        self.f1_file = open(self.fastq1, "r")
-        self.f2_file = open(self.fastq2, "r")
+        self.f1_file, self.f1_reader = self.openReader(self.fastq1, range1, threads, use_mmap)
+        self.f2_file, self.f2_reader = self.openReader(self.fastq2, range2, threads, use_mmap)
         
         self.f1_eof = False
         self.f2_eof = False
     
+    def openPairedStreams(self, stream1, stream2, file1, file2):
+        """
+        Read the FastQ files from a pair of open streams, such as network
+        streams that are being decompressed with a threadedreader. file1 and
+        file2 are the locations of the files that the streams are for, which
+        are used to name the output files, and need not exist.
+        """
+        self.fastq1 = file1
+        self.fastq2 = file2
+        self.streamed = True
+        
+        self.f1_file = stream1
+        self.f2_file = stream2
+        self.f1_reader = fastqblockreader(stream1)
+        self.f2_reader = fastqblockreader(stream2)
+        
+        self.f1_eof = False
+        self.f2_eof = False
+    
+    def openReader(self, fastq, file_range, threads, use_mmap):
+        """
+        Open the parser for one of the FastQ files. Files that cannot be
+        memory mapped (compressed files, pipes) fall back to being read.
+        
+        Returns
+        -------
+        tuple
+            (file handle, parser)
+        """
+        if use_mmap == True and is_gzip(fastq) == False:
+            try:
+                reader = fastqmmapreader(fastq, file_range[0], file_range[1])
+                return (reader, reader)
+            except (EnvironmentError, ValueError, mmap.error):
+                pass
+        
+        file_handle = open_input(fastq, threads, start=file_range[0], end=file_range[1])
+        return (file_handle, fastqblockreader(file_handle))
+    
+    def collectStats(self):
+        """
+        Collect QC statistics (see fastqstats) for each of the FastQ files as
+        the reads are returned by nextRecord() and nextBatch(). The statistics
+        are available as f1_stats and f2_stats.
+        """
+        if fastqstats is None:
+            raise ImportError("numpy is required to collect FastQ statistics")
+        self.f1_stats = fastqstats()
+        self.f2_stats = fastqstats()
+    
     def closePairedFastQ(self):
         """
         Close file handles for the FastQ files.
@@ -72,56 +475,101 @@ class fastqreader:
         """
         Get the next read element for the specific FastQ file pair
         """
-        read_id = ''
-        read_seq = ''
-        read_addition = ''
-        read_score = ''
-        
+        record = self.nextRecord(side)
+        if record == 'ERROR':
+            return 'ERROR'
+        if record == False:
+            return False
+        return {'id': record[0], 'seq': record[1], 'add': record[2], 'score': record[3]}
+    
+    def nextRecord(self, side = 1):
+        """
+        Get the next read element for the specific FastQ file pair as an
+        (id, seq, add, score) tuple. This avoids creating a dict for each read
+        and should be used in preference to next() in tight loops.
+        """
         if side == 1:
-            read_id = self.f1_file.readline()
-            read_seq = self.f1_file.readline()
-            read_addition = self.f1_file.readline()
-            read_score = self.f1_file.readline()
+            record = self.f1_reader.nextRecord()
+            if record == False:
+                self.f1_eof = True
+            elif self.f1_stats is not None:
+                self.f1_stats.addRecord(record)
         elif side == 2:
-            read_id = self.f2_file.readline()
-            read_seq = self.f2_file.readline()
-            read_addition = self.f2_file.readline()
-            read_score = self.f2_file.readline()
+            record = self.f2_reader.nextRecord()
+            if record == False:
+                self.f2_eof = True
+            elif self.f2_stats is not None:
+                self.f2_stats.addRecord(record)
         else:
             return 'ERROR'
-        
-        if read_id == '':
-            if side == 1:
+        return record
+    
+    def nextBatch(self, side = 1, count = 100000):
+        """
+        Get the next count read elements for the specific FastQ file as a dict
+        of parallel lists (id, seq, add, score). Calling this for side 1 and
+        side 2 with the same count returns batches that can be compared in
+        lock-step. A batch shorter than count marks the end of the file.
+        """
+        if side == 1:
+            batch = self.f1_reader.nextBatch(count)
+            if len(batch['id']) < count:
                 self.f1_eof = True
-                return False
-            if side == 2:
+            if self.f1_stats is not None:
+                self.f1_stats.addBatch(batch)
+        elif side == 2:
+            batch = self.f2_reader.nextBatch(count)
+            if len(batch['id']) < count:
                 self.f2_eof = True
-                return False
-        return {'id': read_id.rstrip(), 'seq': read_seq.rstrip(), 'add': read_addition.rstrip(), 'score': read_score.rstrip()}
+            if self.f2_stats is not None:
+                self.f2_stats.addBatch(batch)
+        else:
+            return 'ERROR'
+        return batch
     
-    def createOutputFiles(self, tag = ''):
-        if tag != '' and self.output_tag != tag:
-            self.output_tag = tag
-        
+    def getOutputFiles(self):
+        """
+        Get the locations of the current pair of output files. These are in a
+        tmp directory alongside the input files.
         """
-        Create and open the file handles for the output files
+        output_files = []
+        for fastq in [self.fastq1, self.fastq2]:
+            f = fastq.split("/")
+            if f[-1].endswith(".gz"):
+                f[-1] = f[-1][:-3]
+            f[-1] = f[-1].replace(".fastq", "." + str(self.output_tag) + "_" + str(self.output_file_count) + ".fastq")
+            f[-1] += COMPRESSION_SUFFIX[self.output_compression]
+            f.insert(-1, "tmp")
+            output_files.append("/".join(f))
+        return output_files
+    
+    def createOutputFiles(self, tag = '', compression = None):
+        """
+        Create and open the file handles for the output files. The output is
+        buffered and written from a background thread. compression can be
+        'gzip' or 'zstd' to compress the output files on the fly.
         """
-        f1 = self.fastq1.split("/")
-        f1[-1] = f1[-1].replace(".fastq", "." + str(self.output_tag) + "_" + str(self.output_file_count) + ".fastq")
-        f1.insert(-1, "tmp")
+        if tag != '' and self.output_tag != tag:
+            self.output_tag = tag
+        if compression != None:
+            self.output_compression = compression
         
-        f2 = self.fastq2.split("/")
-        f2[-1] = f2[-1].replace(".fastq", "." + str(self.output_tag) + "_" + str(self.output_file_count) + ".fastq")
-        f2.insert(-1, "tmp")
+        f1, f2 = self.getOutputFiles()
         
-        self.f1_output_file = open("/".join(f1), "w")
-        self.f2_output_file = open("/".join(f2), "w")
+        self.f1_output_file = threadedwriter(f1, self.output_compression)
+        self.f2_output_file = threadedwriter(f2, self.output_compression)
     
     def writeOutput(self, read, side = 1):
         """
         Writer to print the extracted lines
         """
-        line = read["id"] + "\n" + read["seq"] + "\n" + read["add"] + "\n" + read["score"] + "\n"
+        return self.writeRecord((read["id"], read["seq"], read["add"], read["score"]), side)
+    
+    def writeRecord(self, record, side = 1):
+        """
+        Writer to print a record in the tuple form returned by nextRecord()
+        """
+        line = record_text(record)
         if side == 1:
             self.f1_output_file.write(line)
         elif side == 2:
@@ -0,0 +1,225 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import itertools, os.path
+
+import numpy
+
+from compression import open_input, threadedwriter
+from fastqreader import fastqblockreader, fastqreader, record_text
+from fastqpairing import fastqpairer, BATCH_SIZE
+
+
+def sampler_from_option(value, seed = 0):
+    """
+    Create a fastqsampler from a command line option. Values below 1 (eg 0.1)
+    are taken as the fraction of the pairs to keep, other values as the
+    number of pairs to keep.
+
+    Returns
+    -------
+    fastqsampler
+        None if value is None
+    """
+    if value is None:
+        return None
+    value = float(value)
+    if value < 1:
+        return fastqsampler(fraction=value, seed=seed)
+    return fastqsampler(count=int(value), seed=seed)
+
+
+class fastqsampler:
+    """
+    Seeded downsampling of pairs of reads (or single reads). The same seed
+    and input always give the same sample.
+
+    In fraction mode each pair is kept with the given probability. This is a
+    single streaming pass with constant memory. In count mode exactly count
+    pairs are kept (or all of them if there are fewer) with reservoir
+    sampling, so the memory used is bounded by the size of the sample. The
+    sampled pairs are returned in the order that they were in the files.
+    """
+
+    def __init__(self, fraction = None, count = None, seed = 0):
+        """
+        Initialise the sampler
+
+        Parameters
+        ----------
+        fraction : float
+            Fraction of the pairs to keep
+        count : int
+            Number of pairs to keep
+        seed : int
+            Seed for the random number generator
+        """
+        if (fraction is None) == (count is None):
+            raise ValueError("Set one of fraction or count to downsample")
+
+        self.fraction = fraction
+        self.count = count
+        self.seed = seed
+        self.random = numpy.random.RandomState(seed)
+
+        self.pairs_in = 0
+        self.pairs_out = 0
+
+    def forRange(self, part):
+        """
+        Get a fraction mode sampler for one part of a file, such as one of
+        the ranges of fastqsplitter.splitParallel(). Each part has its own
+        seed so that the sample does not depend on the order that the parts
+        are run in. As a result the sample from a parallel split is not the
+        same as the sample from a serial split with the same seed.
+        """
+        if self.fraction is None:
+            raise ValueError("Only fraction mode can be run over parts of a file")
+        sampler = fastqsampler(fraction=self.fraction, seed=self.seed)
+        sampler.random = numpy.random.RandomState([self.seed, part])
+        return sampler
+
+    def sampleBatch(self, pairs):
+        """
+        Sample a batch of pairs in fraction mode
+
+        Parameters
+        ----------
+        pairs : list
+            Pairs, or other items, to sample from
+
+        Returns
+        -------
+        list
+            The pairs that are kept
+        """
+        keep = numpy.flatnonzero(self.random.random_sample(len(pairs)) < self.fraction)
+        self.pairs_in += len(pairs)
+        self.pairs_out += len(keep)
+        return [pairs[i] for i in keep.tolist()]
+
+    def reservoir(self, pairs):
+        """
+        Sample exactly count pairs from an iterator of pairs with reservoir
+        sampling (Algorithm R), drawing the random numbers a batch at a time
+
+        Returns
+        -------
+        list
+            The sampled pairs in the order they were in the iterator
+        """
+        pairs = iter(pairs)
+        sample = list(itertools.islice(pairs, self.count))
+        positions = range(len(sample))
+        seen = len(sample)
+
+        while True:
+            batch = list(itertools.islice(pairs, BATCH_SIZE))
+            if len(batch) == 0:
+                break
+
+            # Item i (counting from 0) replaces a random member of the
+            # reservoir with probability count / (i + 1)
+            indexes = numpy.arange(seen, seen + len(batch))
+            slots = (self.random.random_sample(len(batch)) * (indexes + 1)).astype(numpy.int64)
+            for i in numpy.flatnonzero(slots < self.count).tolist():
+                sample[slots[i]] = batch[i]
+                positions[slots[i]] = seen + i
+            seen += len(batch)
+
+        self.pairs_in += seen
+        self.pairs_out += len(sample)
+        return [sample[i] for i in numpy.argsort(positions, kind='mergesort').tolist()]
+
+    def pairs(self, pairs):
+        """
+        Generator of the sampled pairs from an iterator of pairs. In count
+        mode nothing is returned until the iterator has been used up.
+        """
+        pairs = iter(pairs)
+        if self.count is not None:
+            for pair in self.reservoir(pairs):
+                yield pair
+            return
+
+        while True:
+            batch = list(itertools.islice(pairs, BATCH_SIZE))
+            if len(batch) == 0:
+                return
+            for pair in self.sampleBatch(batch):
+                yield pair
+
+    def sampleFiles(self, in_file1, in_file2, out_file1, out_file2 = None, compression = None):
+        """
+        Write a sample of the pairs in a pair of FastQ files to a new pair of
+        files. The reads are paired on their ids with a fastqpairer.
+
+        If in_file2 is None the reads in in_file1 are sampled on their own
+        and written to out_file1.
+
+        Parameters
+        ----------
+        in_file1 : str
+            Location of the FastQ file for the first mate
+        in_file2 : str
+            Location of the FastQ file for the second mate, or None
+        out_file1 : str
+            Location to save the sample of the first mates to
+        out_file2 : str
+            Location to save the sample of the second mates to
+        compression : str
+            None, 'gzip' or 'zstd' to compress the output files
+
+        Returns
+        -------
+        int
+            Number of pairs, or reads, in the sample
+        """
+        pairs_out = self.pairs_out
+
+        if in_file2 is None:
+            f_in = open_input(in_file1)
+            reader = fastqblockreader(f_in)
+            f_out = threadedwriter(out_file1, compression)
+            try:
+                for read in self.pairs(iter(reader.nextRecord, False)):
+                    f_out.write(record_text(read))
+            finally:
+                f_out.close()
+                f_in.close()
+            return self.pairs_out - pairs_out
+
+        fqr = fastqreader()
+        fqr.openPairedFastQ(in_file1, in_file2)
+        f_out1 = threadedwriter(out_file1, compression)
+        f_out2 = threadedwriter(out_file2, compression)
+        try:
+            pairer = fastqpairer(fqr, os.path.dirname(os.path.abspath(out_file1)))
+            for r1, r2 in self.pairs(pairer.pairs()):
+                f_out1.write(record_text(r1))
+                f_out2.write(record_text(r2))
+        finally:
+            f_out1.close()
+            f_out2.close()
+            fqr.closePairedFastQ()
+        return self.pairs_out - pairs_out
+
+    def merge(self, other):
+        """
+        Add the counts from the sampler for another part of the same files
+        """
+        self.pairs_in += other.pairs_in
+        self.pairs_out += other.pairs_out
@@ -0,0 +1,469 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import bisect, itertools, os, multiprocessing
+
+from compression import is_gzip
+from fastqreader import fastqreader
+from fastqpairing import fastqpairer, read_key, BATCH_SIZE
+from fastqindex import index_fastq, INDEX_STEP
+
+
+def split_range(params):
+    """
+    Write the pairs from a range of each of the paired FastQ files to a single
+    pair of shard files. This is run in the worker processes of
+    fastqsplitter.splitParallel().
+
+    The reads in the two ranges have to be in the same order. If they are not
+    then the shard is left incomplete and flagged so that the caller can fall
+    back to pairing the whole of the files.
+
+    Parameters
+    ----------
+    params : list
+        in_file1, in_file2, range1, range2, tag, shard number, compression,
+        use_mmap, stats, trimmer, sampler
+
+    Returns
+    -------
+    tuple
+        ([shard file 1, shard file 2], True if all of the reads were paired,
+        [fastqstats 1, fastqstats 2] or None, trimmer, sampler, number of
+        pairs read, number of pairs written)
+    """
+    in_file1, in_file2, range1, range2, tag, shard, compression, use_mmap, stats, trimmer, sampler = params
+
+    fqr = fastqreader()
+    fqr.openPairedFastQ(in_file1, in_file2, range1, range2, threads=1, use_mmap=use_mmap)
+    if stats == True:
+        fqr.collectStats()
+    fqr.output_file_count = shard
+    fqr.createOutputFiles(tag, compression)
+
+    paired = True
+    pairs_read = 0
+    pairs_written = 0
+    while paired == True:
+        batch1 = fqr.nextBatch(1, BATCH_SIZE)
+        batch2 = fqr.nextBatch(2, BATCH_SIZE)
+        if len(batch1['id']) == 0 and len(batch2['id']) == 0:
+            break
+
+        keys1 = [read_key(read_id) for read_id in batch1['id']]
+        keys2 = [read_key(read_id) for read_id in batch2['id']]
+        if keys1 != keys2:
+            paired = False
+            break
+
+        pairs_read += len(batch1['id'])
+        pairs = zip(zip(batch1['id'], batch1['seq'], batch1['add'], batch1['score']), zip(batch2['id'], batch2['seq'], batch2['add'], batch2['score']))
+        if trimmer is not None:
+            pairs = trimmer.trimPairs(pairs)
+        if sampler is not None:
+            pairs = sampler.sampleBatch(pairs)
+
+        for r1, r2 in pairs:
+            fqr.writeRecord(r1, 1)
+            fqr.writeRecord(r2, 2)
+            pairs_written += 1
+
+    files_out = fqr.getOutputFiles()
+    fqr.closePairedFastQ()
+    fqr.closeOutputFiles()
+
+    if stats == True:
+        return (files_out, paired, [fqr.f1_stats, fqr.f2_stats], trimmer, sampler, pairs_read, pairs_written)
+    return (files_out, paired, None, trimmer, sampler, pairs_read, pairs_written)
+
+
+class fastqsplitter:
+    """
+    Divides a pair of FastQ files into shards of paired reads so that the
+    aligner can be run over them in parallel.
+
+    Shards can be sized on the number of pairs, the number of bases or the
+    number of bytes of FastQ in them, or the files can be divided into a set
+    number of shards of about the same size. As the time taken to align a
+    shard depends on the number of bases in it rather than the number of
+    reads, sizing on bases or bytes keeps the alignment tasks balanced when
+    the read lengths vary.
+
+    QC statistics for both of the input files can be collected in the same
+    pass (see fastqstats). These are saved as <file>.<tag>_qc.json and
+    <file>.<tag>_qc.npz alongside the shards.
+
+    The pairs can be trimmed and filtered by a fastqtrimmer in the same pass,
+    in place of filtering each of the files before they are split, and then
+    downsampled with a fastqsampler.
+
+    The files can also be split from streams as they are downloaded (see
+    splitStreams()), with on_shard called for each shard as it is closed so
+    that it can be aligned while the rest of the files are still arriving.
+    """
+
+    def __init__(self, in_file1, in_file2, tag, compression = None, reads_per_shard = 1000000, processes = 1, bases_per_shard = None, bytes_per_shard = None, shards = None, use_mmap = False, stats = False, trimmer = None, sampler = None, on_shard = None):
+        """
+        Initialise the splitter
+
+        Only one of the sizing options is used. shards takes precedence over
+        bases_per_shard, then bytes_per_shard and then reads_per_shard.
+
+        Parameters
+        ----------
+        in_file1 : str
+            Location of the FastQ file for the first mate
+        in_file2 : str
+            Location of the FastQ file for the second mate
+        tag : str
+            Tag inserted into the names of the shard files
+        compression : str
+            None, 'gzip' or 'zstd' to compress the shard files
+        reads_per_shard : int
+            Number of pairs in each shard
+        processes : int
+            Number of worker processes. With more than one process the input
+            files are indexed and divided into ranges that are split in
+            parallel.
+        bases_per_shard : int
+            Number of bases from both mates in each shard
+        bytes_per_shard : int
+            Number of bytes of uncompressed FastQ from both mates in each
+            shard
+        shards : int
+            Number of shards to divide the files into, or 'auto' for one
+            shard for each of the cores on the machine
+        use_mmap : bool
+            Memory map uncompressed input files rather than reading them, see
+            fastqreader.fastqmmapreader
+        stats : bool
+            Collect QC statistics for the input files while they are split
+        trimmer : fastqtrimmer
+            Trimmer that the pairs are passed through before they are written
+            to the shards. The counts of the pairs that were trimmed and
+            removed are added to it.
+        sampler : fastqsampler
+            Sampler used to downsample the pairs. In count mode the files are
+            always split in a single process.
+        on_shard : function
+            Called with the [file 1, file 2] locations of each shard once it
+            has been written. When the files are split in parallel this is
+            called for each shard once all of them have been written.
+        """
+        self.in_file1 = in_file1
+        self.in_file2 = in_file2
+        self.tag = tag
+        self.compression = compression
+        self.reads_per_shard = reads_per_shard
+        self.processes = processes
+        self.bases_per_shard = bases_per_shard
+        self.bytes_per_shard = bytes_per_shard
+        self.shards = shards
+        self.use_mmap = use_mmap
+        self.stats = stats
+        self.trimmer = trimmer
+        self.sampler = sampler
+        self.on_shard = on_shard
+
+        self.file_stats = None
+        self.stats_files = None
+
+    def getShardSize(self):
+        """
+        Get the measure used to size the shards and the size of each shard
+
+        Returns
+        -------
+        tuple
+            ('reads', 'bases' or 'bytes', size of each shard)
+        """
+        if self.shards is not None:
+            shards = self.shards
+            if shards == 'auto':
+                shards = multiprocessing.cpu_count()
+            shards = max(1, int(shards))
+            length = self.inputLength()
+            return ('bytes', max(1, -(-length // shards)))
+
+        if self.bases_per_shard is not None:
+            return ('bases', self.bases_per_shard)
+
+        if self.bytes_per_shard is not None:
+            return ('bytes', self.bytes_per_shard)
+
+        return ('reads', self.reads_per_shard)
+
+    def inputLength(self):
+        """
+        Get the total uncompressed length of the two input files. Compressed
+        files are indexed to get their length.
+        """
+        length = 0
+        for fastq in [self.in_file1, self.in_file2]:
+            if is_gzip(fastq) == True:
+                length += index_fastq(fastq).length
+            else:
+                length += os.path.getsize(fastq)
+        return length
+
+    def split(self):
+        """
+        Split the files
+
+        Returns
+        -------
+        list
+            List of lists of the files that have been generated. Each sub list
+            contains the two paired end files for that shard.
+        """
+        if self.processes > 1:
+            files_out = self.splitParallel()
+            if files_out is not None:
+                return files_out
+        return self.splitSerial()
+
+    def splitStreams(self, stream1, stream2):
+        """
+        Split the FastQ files as they are read from a pair of streams, for
+        example network streams that are decompressed on the fly (see
+        common.streamFastqFiles()), so that the files never have to be saved.
+        in_file1 and in_file2 are only used to name the shards.
+
+        As the length of the streams is not known the shards have to be sized
+        on reads, bases or bytes rather than by the number of shards.
+
+        Returns
+        -------
+        list
+            List of lists of the files that have been generated
+        """
+        if self.shards is not None:
+            raise ValueError("Streams cannot be divided into a set number of shards")
+        return self.splitSerial([stream1, stream2])
+
+    def splitSerial(self, streams = None):
+        """
+        Split the files in a single pass, pairing the reads with a
+        fastqpairer so that the files do not need to be in the same order.
+
+        The next shard is only opened once there is a pair to write to it, so
+        no empty shards are generated when the number of pairs is a multiple
+        of the shard size.
+        """
+        unit, shard_size = self.getShardSize()
+
+        fqr = fastqreader()
+        if streams is None:
+            fqr.openPairedFastQ(self.in_file1, self.in_file2, use_mmap=self.use_mmap)
+        else:
+            fqr.openPairedStreams(streams[0], streams[1], self.in_file1, self.in_file2)
+        if self.stats == True:
+            fqr.collectStats()
+        fqr.createOutputFiles(self.tag, self.compression)
+
+        files_out = [fqr.getOutputFiles()]
+
+        pairer = fastqpairer(fqr, os.path.dirname(files_out[0][0]))
+
+        pairs = pairer.pairs()
+        if self.trimmer is not None:
+            pairs = self.trimmedPairs(pairs)
+        if self.sampler is not None:
+            pairs = self.sampler.pairs(pairs)
+
+        size = 0
+        written = 0
+        for r1, r2 in pairs:
+            if size >= shard_size:
+                fqr.incrementOutputFiles()
+                if self.on_shard is not None:
+                    self.on_shard(files_out[-1])
+                files_out.append(fqr.getOutputFiles())
+                size = 0
+
+            fqr.writeRecord(r1, 1)
+            fqr.writeRecord(r2, 2)
+            written += 1
+
+            if unit == 'reads':
+                size += 1
+            elif unit == 'bases':
+                size += len(r1[1]) + len(r2[1])
+            else:
+                size += len(r1[0]) + len(r1[1]) + len(r1[2]) + len(r1[3]) + len(r2[0]) + len(r2[1]) + len(r2[2]) + len(r2[3]) + 8
+
+        print "Paired reads:", pairer.paired, "Orphans:", pairer.orphans[1], pairer.orphans[2]
+        print "Written pairs:", written
+        if self.trimmer is not None:
+            print "Trimmed pairs:", self.trimmer.summary()
+        if self.sampler is not None:
+            print "Sampled pairs:", self.sampler.pairs_out, "of", self.sampler.pairs_in
+
+        fqr.closePairedFastQ()
+        fqr.closeOutputFiles()
+        if self.on_shard is not None:
+            self.on_shard(files_out[-1])
+
+        if self.stats == True:
+            self.saveStats([fqr.f1_stats, fqr.f2_stats], files_out[0])
+
+        return files_out
+
+    def trimmedPairs(self, pairs):
+        """
+        Generator of the pairs that pass the trimmer. The pairs are trimmed a
+        batch at a time.
+        """
+        while True:
+            batch = list(itertools.islice(pairs, BATCH_SIZE))
+            if len(batch) == 0:
+                return
+            for pair in self.trimmer.trimPairs(batch):
+                yield pair
+
+    def saveStats(self, file_stats, shard_files):
+        """
+        Save the QC statistics for each of the input files in the directory
+        of the shards
+
+        Parameters
+        ----------
+        file_stats : list
+            fastqstats for each of the input files
+        shard_files : list
+            Locations of a pair of the shard files
+        """
+        self.file_stats = file_stats
+        self.stats_files = []
+        for fastq, stats, shard_file in zip([self.in_file1, self.in_file2], file_stats, shard_files):
+            name = os.path.basename(fastq)
+            if name.endswith('.gz'):
+                name = name[:-3]
+            name = name.replace('.fastq', '') + '.' + str(self.tag) + '_qc'
+            self.stats_files.append(stats.save(os.path.join(os.path.dirname(shard_file), name)))
+
+    def getRanges(self, index1, index2, unit, shard_size):
+        """
+        Divide both of the indexed files into matching ranges for the shards
+
+        Ranges sized on reads contain a fixed number of records. Otherwise the
+        boundaries are placed at the indexed records closest to even divisions
+        of the combined length of the files, so that the shards are about the
+        same size. The index only holds the uncompressed positions of the
+        records, so shards sized on bases are balanced on bytes, taking each
+        base to account for 2 bytes (the base and its quality score).
+
+        Returns
+        -------
+        list
+            [range 1, range 2] for each shard
+        """
+        if unit == 'reads':
+            return zip(index1.getRanges(shard_size), index2.getRanges(shard_size))
+
+        if unit == 'bases':
+            shard_size = 2 * shard_size
+
+        length = index1.length + index2.length
+        shards = max(1, int(round(float(length) / shard_size)))
+
+        positions = [p1 + p2 for p1, p2 in zip(index1.positions, index2.positions)]
+        entries = [0]
+        for shard in range(1, shards):
+            target = length * shard // shards
+            i = bisect.bisect_left(positions, target)
+            if i > 0 and (i == len(positions) or target - positions[i - 1] <= positions[i] - target):
+                i -= 1
+            if i > entries[-1]:
+                entries.append(i)
+
+        return zip(index1.getEntryRanges(entries), index2.getEntryRanges(entries))
+
+    def splitParallel(self):
+        """
+        Split the files with a pool of worker processes. Each file is indexed
+        (the index is saved alongside the file for reuse) and divided into
+        ranges on record boundaries, one for each shard. Each worker writes
+        the shard pair for one range.
+
+        This only works when the two files are in the same order. None is
+        returned if they are not, if the files cannot be read from an offset
+        (gzip files that are not BGZF), if an exact number of pairs is to be
+        sampled or if the workers did not read the number of pairs in the
+        index, so that the caller can use splitSerial() instead.
+        """
+        if self.sampler is not None and self.sampler.count is not None:
+            return None
+
+        unit, shard_size = self.getShardSize()
+
+        step = INDEX_STEP
+        if unit == 'reads':
+            step = min(INDEX_STEP, shard_size)
+        index1 = index_fastq(self.in_file1, step)
+        index2 = index_fastq(self.in_file2, step)
+
+        if index1.seekable == False or index2.seekable == False:
+            return None
+        if index1.records != index2.records or index1.records == 0:
+            return None
+
+        tasks = []
+        for shard, ranges in enumerate(self.getRanges(index1, index2, unit, shard_size)):
+            sampler = None
+            if self.sampler is not None:
+                sampler = self.sampler.forRange(shard)
+            tasks.append([self.in_file1, self.in_file2, ranges[0], ranges[1], self.tag, shard, self.compression, self.use_mmap, self.stats, self.trimmer, sampler])
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            results = pool.map(split_range, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+        files_out = [result[0] for result in results]
+        pairs_read = sum([result[5] for result in results])
+        if pairs_read != index1.records:
+            print "[Warning] Read", pairs_read, "pairs from the ranges of", index1.records, "indexed pairs, splitting in a single process"
+        if False in [result[1] for result in results] or pairs_read != index1.records:
+            for files in files_out:
+                for file_name in files:
+                    os.remove(file_name)
+            return None
+
+        if self.stats == True:
+            file_stats = results[0][2]
+            for result in results[1:]:
+                file_stats[0].merge(result[2][0])
+                file_stats[1].merge(result[2][1])
+            self.saveStats(file_stats, files_out[0])
+
+        print "Paired reads:", pairs_read, "Orphans:", 0, 0
+        print "Written pairs:", sum([result[6] for result in results])
+        if self.trimmer is not None:
+            for result in results:
+                self.trimmer.merge(result[3])
+            print "Trimmed pairs:", self.trimmer.summary()
+        if self.sampler is not None:
+            for result in results:
+                self.sampler.merge(result[4])
+            print "Sampled pairs:", self.sampler.pairs_out, "of", self.sampler.pairs_in
+
+        if self.on_shard is not None:
+            for files in files_out:
+                self.on_shard(files)
+        return files_out
@@ -0,0 +1,347 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+
+import numpy
+
+# Offset of the quality scores in the FastQ files (Sanger / Illumina 1.8+)
+QUALITY_OFFSET = 33
+
+# Number of distinct quality scores that are counted. Higher scores are
+# counted as the highest score.
+QUALITY_VALUES = 94
+
+# Number of reads from the start of the file that are used to estimate the
+# level of duplication
+DUPLICATE_SAMPLE = 1000000
+
+# Number of records that are held by addRecord() before they are counted
+STATS_BATCH_SIZE = 10000
+
+# The per base statistics are collected from 1 in this many batches
+STATS_SAMPLE = 5
+
+
+def join_lines(lines, width):
+    """
+    Join a list of lines of the same length into a matrix of bytes with a
+    row for each line. Buffers from a fastqmmapreader are copied to strings
+    first.
+    """
+    try:
+        text = ''.join(lines)
+    except TypeError:
+        text = ''.join([str(line) for line in lines])
+    return numpy.frombuffer(text, dtype=numpy.uint8).reshape(len(lines), width)
+
+
+class fastqstats:
+    """
+    QC statistics for the reads in a FastQ file that are accumulated a batch
+    of records at a time with numpy, so that they can be collected in the
+    same pass as the file is split rather than with another read through of
+    the file.
+
+    The number of reads and bases and the histogram of read lengths are
+    counted for every read. To keep the cost down the per base statistics are
+    collected from a sample of 1 in every `sample` batches:
+        - the distribution of quality scores at each position in the reads
+        - the number of Ns at each position in the reads
+        - the histogram of the GC content of each read (as a percentage)
+        - the level of duplication in the reads from the start of the file
+
+    The statistics for different parts of a file can be combined with
+    merge().
+    """
+
+    def __init__(self, quality_offset = QUALITY_OFFSET, duplicate_sample = DUPLICATE_SAMPLE, sample = STATS_SAMPLE):
+        """
+        Initialise the statistics
+
+        Parameters
+        ----------
+        quality_offset : int
+            Offset of the quality scores in the FastQ file
+        duplicate_sample : int
+            Number of reads used to estimate the level of duplication
+        sample : int
+            Collect the per base statistics from 1 in this many batches. 1
+            collects them for every read.
+        """
+        self.quality_offset = quality_offset
+        self.duplicate_sample = duplicate_sample
+        self.sample = sample
+
+        self.reads = 0
+        self.bases = 0
+        self.batches = 0
+        self.sampled = 0
+        self.length_counts = numpy.zeros(1, dtype=numpy.int64)
+        self.quality_counts = numpy.zeros((0, QUALITY_VALUES), dtype=numpy.int64)
+        self.n_counts = numpy.zeros(0, dtype=numpy.int64)
+        self.gc_counts = numpy.zeros(101, dtype=numpy.int64)
+
+        self.hashes = []
+        self.hashed = 0
+
+        self.pending_seqs = []
+        self.pending_scores = []
+
+    def grow(self, length):
+        """
+        Extend the per position arrays to cover reads of the given length
+        """
+        if length > len(self.n_counts):
+            extra = length - len(self.n_counts)
+            self.quality_counts = numpy.vstack([self.quality_counts, numpy.zeros((extra, QUALITY_VALUES), dtype=numpy.int64)])
+            self.n_counts = numpy.concatenate([self.n_counts, numpy.zeros(extra, dtype=numpy.int64)])
+        if length + 1 > len(self.length_counts):
+            self.length_counts = numpy.concatenate([self.length_counts, numpy.zeros(length + 1 - len(self.length_counts), dtype=numpy.int64)])
+
+    def addBatch(self, batch):
+        """
+        Count a batch of records in the form returned by
+        fastqreader.nextBatch()
+        """
+        self.addReads(batch['seq'], batch['score'])
+
+    def addRecord(self, record):
+        """
+        Count a single (id, seq, add, score) record. Records are held until
+        there are enough of them to be counted as a batch.
+        """
+        self.pending_seqs.append(record[1])
+        self.pending_scores.append(record[3])
+        if len(self.pending_seqs) >= STATS_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Count any records held by addRecord()
+        """
+        if len(self.pending_seqs) > 0:
+            self.addReads(self.pending_seqs, self.pending_scores)
+            self.pending_seqs = []
+            self.pending_scores = []
+
+    def addReads(self, seqs, scores):
+        """
+        Count a batch of reads
+
+        Parameters
+        ----------
+        seqs : list
+            Sequence of each read
+        scores : list
+            Quality scores of each read
+        """
+        count = len(seqs)
+        if count == 0:
+            return
+
+        lengths = numpy.fromiter(map(len, seqs), dtype=numpy.int64, count=count)
+        max_length = int(lengths.max())
+        self.grow(max_length)
+
+        self.reads += count
+        self.bases += int(lengths.sum())
+        self.length_counts[:max_length + 1] += numpy.bincount(lengths, minlength=max_length + 1)
+
+        self.batches += 1
+        if (self.batches - 1) % self.sample != 0:
+            return
+        self.sampled += count
+
+        # The reads of each length are counted as a matrix with a row for
+        # each read
+        order = numpy.argsort(lengths, kind='mergesort')
+        sorted_lengths = lengths[order]
+        bounds = numpy.flatnonzero(numpy.diff(sorted_lengths)) + 1
+        order = order.tolist()
+        for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [count]):
+            length = int(sorted_lengths[start])
+            if length > 0:
+                self.addMatrix([seqs[i] for i in order[start:end]], [scores[i] for i in order[start:end]], length)
+
+        # Sample of the reads for the level of duplication
+        if self.hashed < self.duplicate_sample:
+            take = min(count, self.duplicate_sample - self.hashed)
+            self.hashes.append(numpy.array([hash(seq) for seq in seqs[:take]], dtype=numpy.int64))
+            self.hashed += take
+
+    def addMatrix(self, seqs, scores, length):
+        """
+        Count the per base statistics for a set of reads of the same length
+        """
+        seq = join_lines(seqs, length) | 0x20
+
+        self.n_counts[:length] += (seq == 110).sum(axis=0)
+
+        gc = ((seq == 103) | (seq == 99)).sum(axis=1)
+        self.gc_counts += numpy.bincount((200 * gc + length) // (2 * length), minlength=101)
+
+        if sum(map(len, scores)) != len(scores) * length:
+            # Skip the scores of reads where they do not match the sequence
+            scores = [score for score in scores if len(score) == length]
+            if len(scores) == 0:
+                return
+        quality = join_lines(scores, length).astype(numpy.intp) - self.quality_offset
+        numpy.clip(quality, 0, QUALITY_VALUES - 1, out=quality)
+        quality += numpy.arange(length) * QUALITY_VALUES
+        counts = numpy.bincount(quality.ravel(), minlength=length * QUALITY_VALUES)
+        self.quality_counts[:length] += counts.reshape(length, QUALITY_VALUES)
+
+    def merge(self, other):
+        """
+        Add the statistics from another fastqstats, such as one collected
+        for a different range of the same file
+        """
+        self.flush()
+        other.flush()
+
+        self.grow(len(other.n_counts))
+        self.grow(len(other.length_counts) - 1)
+
+        self.reads += other.reads
+        self.bases += other.bases
+        self.batches += other.batches
+        self.sampled += other.sampled
+        self.length_counts[:len(other.length_counts)] += other.length_counts
+        self.quality_counts[:len(other.quality_counts)] += other.quality_counts
+        self.n_counts[:len(other.n_counts)] += other.n_counts
+        self.gc_counts += other.gc_counts
+
+        for hashes in other.hashes:
+            if self.hashed >= self.duplicate_sample:
+                break
+            hashes = hashes[:self.duplicate_sample - self.hashed]
+            self.hashes.append(hashes)
+            self.hashed += len(hashes)
+
+    def qualityPercentile(self, percentile):
+        """
+        Get the given percentile of the quality scores at each position
+        """
+        cumulative = numpy.cumsum(self.quality_counts, axis=1)
+        totals = cumulative[:, -1:]
+        return numpy.argmax(cumulative * 100 >= totals * percentile, axis=1)
+
+    def duplicateLevels(self):
+        """
+        Get the number of distinct sequences in the duplicate sample that
+        are seen once, twice, ... 10 or more times
+
+        Returns
+        -------
+        numpy.array
+            Count of distinct sequences at each level of duplication from 1 to
+            10 or more
+        """
+        if self.hashed == 0:
+            return numpy.zeros(10, dtype=numpy.int64)
+        unique, counts = numpy.unique(numpy.concatenate(self.hashes), return_counts=True)
+        return numpy.bincount(numpy.minimum(counts, 10), minlength=11)[1:]
+
+    def summary(self):
+        """
+        Get a summary of the statistics that can be saved as JSON
+
+        Returns
+        -------
+        dict
+            reads : int
+            bases : int
+            sampled_reads : int, number of reads in the per base statistics
+            length : dict of min, max, mean and histogram
+            quality : dict of the mean, lower quartile, median and upper
+                quartile at each position
+            n_content : list of the fraction of Ns at each position
+            gc : dict of the mean GC percentage and histogram of the GC
+                percentages of the reads
+            duplication : dict of the number of reads hashed, the number of
+                distinct sequences, the fraction of the reads that would be
+                removed by deduplication and the number of distinct sequences
+                at each level of duplication (1 to 10 or more)
+        """
+        self.flush()
+
+        lengths = numpy.flatnonzero(self.length_counts)
+        position_reads = self.quality_counts.sum(axis=1)
+        depth = numpy.maximum(position_reads, 1)
+        mean_quality = (self.quality_counts * numpy.arange(QUALITY_VALUES)).sum(axis=1) / depth.astype(float)
+
+        levels = self.duplicateLevels()
+        distinct = int(levels.sum())
+
+        return {
+            'reads': self.reads,
+            'bases': self.bases,
+            'sampled_reads': self.sampled,
+            'length': {
+                'min': int(lengths[0]) if len(lengths) > 0 else 0,
+                'max': int(lengths[-1]) if len(lengths) > 0 else 0,
+                'mean': float(self.bases) / max(self.reads, 1),
+                'histogram': self.length_counts.tolist()
+            },
+            'quality': {
+                'mean': numpy.round(mean_quality, 2).tolist(),
+                'lower_quartile': self.qualityPercentile(25).tolist(),
+                'median': self.qualityPercentile(50).tolist(),
+                'upper_quartile': self.qualityPercentile(75).tolist()
+            },
+            'n_content': numpy.round(self.n_counts / depth.astype(float), 4).tolist(),
+            'gc': {
+                'mean': float((self.gc_counts * numpy.arange(101)).sum()) / max(self.gc_counts.sum(), 1),
+                'histogram': self.gc_counts.tolist()
+            },
+            'duplication': {
+                'sampled': self.hashed,
+                'distinct': distinct,
+                'duplicate_fraction': 1.0 - float(distinct) / max(self.hashed, 1),
+                'levels': levels.tolist()
+            }
+        }
+
+    def save(self, file_base):
+        """
+        Save the summary as JSON and the full counts as a numpy NPZ file
+
+        Parameters
+        ----------
+        file_base : str
+            Location of the output files without the .json or .npz suffix
+
+        Returns
+        -------
+        list
+            Locations of the JSON and NPZ files
+        """
+        json_file = file_base + '.json'
+        with open(json_file, 'w') as f_out:
+            json.dump(self.summary(), f_out)
+
+        npz_file = file_base + '.npz'
+        numpy.savez_compressed(
+            npz_file,
+            length_counts=self.length_counts,
+            quality_counts=self.quality_counts,
+            n_counts=self.n_counts,
+            gc_counts=self.gc_counts,
+            duplicate_levels=self.duplicateLevels()
+        )
+
+        return [json_file, npz_file]
@@ -0,0 +1,291 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy
+
+from fastqstats import join_lines, QUALITY_OFFSET
+
+# Start of the Illumina TruSeq adapter
+ILLUMINA_ADAPTER = 'AGATCGGAAGAGC'
+
+
+class fastqtrimmer:
+    """
+    Trims and filters pairs of reads a batch at a time so that it can be run
+    in the same pass as the FastQ files are split.
+
+    Each read is:
+        - quality trimmed from the 3' end with the BWA / cutadapt algorithm
+        - clipped at the start of the adapter, including a partial adapter at
+          the 3' end of the read (exact matches only)
+
+    The pair is dropped if either of the trimmed reads is shorter than
+    min_length, has more than max_n of its bases as N or is of low
+    complexity, with more than max_base_fraction of its bases the same.
+    Both reads are always kept or dropped together so the files stay paired.
+    """
+
+    def __init__(self, quality = 20, adapter = None, min_length = 20, max_n = 0.1, max_base_fraction = 0.9, min_overlap = 3, quality_offset = QUALITY_OFFSET):
+        """
+        Initialise the trimmer
+
+        Parameters
+        ----------
+        quality : int
+            Quality cutoff for trimming the 3' end of the reads. None to not
+            quality trim
+        adapter : str
+            Sequence of the 3' adapter (eg ILLUMINA_ADAPTER). None to not
+            clip adapters
+        min_length : int
+            Shortest trimmed read that is kept
+        max_n : float
+            Largest fraction of Ns in a trimmed read that is kept
+        max_base_fraction : float
+            Largest fraction of a trimmed read that can be the same base
+        min_overlap : int
+            Shortest partial adapter at the 3' end of a read that is clipped
+        quality_offset : int
+            Offset of the quality scores in the FastQ files
+        """
+        self.quality = quality
+        self.adapter = adapter
+        self.min_length = min_length
+        self.max_n = max_n
+        self.max_base_fraction = max_base_fraction
+        self.min_overlap = min_overlap
+        self.quality_offset = quality_offset
+
+        self.pairs_in = 0
+        self.pairs_out = 0
+        self.bases_trimmed = 0
+        self.too_short = 0
+        self.too_many_n = 0
+        self.low_complexity = 0
+
+    def adapterPositions(self, seqs):
+        """
+        Get the position of the start of the adapter in each of a batch of
+        reads, or the length of the read if there is no adapter
+
+        Returns
+        -------
+        list
+            Position of the adapter in each read
+        """
+        adapter = self.adapter
+        prefix = adapter[:self.min_overlap]
+        tail = len(adapter) - 1
+
+        if len(seqs) > 0 and isinstance(seqs[0], str) == False:
+            seqs = [str(seq) for seq in seqs]
+        positions = [seq.find(adapter) for seq in seqs]
+        partial = [seq.find(prefix, len(seq) - tail) for seq in seqs]
+
+        for i, pos in enumerate(positions):
+            if pos != -1:
+                continue
+            seq = seqs[i]
+            positions[i] = len(seq)
+
+            # Partial adapter running off the 3' end of the read
+            pos = partial[i]
+            while pos != -1:
+                if adapter.startswith(seq[pos:]):
+                    positions[i] = pos
+                    break
+                pos = seq.find(prefix, pos + 1)
+
+        return positions
+
+    def qualityTrim(self, scores, length):
+        """
+        Find the position to trim each of a set of reads of the same length
+        at. This matches the BWA algorithm where the cut is made at the
+        position that maximises the sum of (cutoff - quality) over the
+        trimmed bases, scanning from the 3' end and stopping once the sum
+        drops below zero.
+
+        Returns
+        -------
+        numpy.array
+            Length of each read after trimming
+        """
+        quality = join_lines(scores, length).astype(numpy.int32) - self.quality_offset
+        sums = numpy.cumsum(self.quality - quality[:, ::-1], axis=1)[:, ::-1]
+
+        # The scan stops at the last position where the sum is negative
+        negative = (sums < 0)[:, ::-1]
+        stop = numpy.where(negative.any(axis=1), length - 1 - numpy.argmax(negative, axis=1), -1)
+        sums[numpy.arange(length)[None, :] <= stop[:, None]] = 0
+
+        # The first maximum found from the 3' end
+        best = sums.max(axis=1)
+        cut = length - 1 - numpy.argmax((sums == best[:, None])[:, ::-1], axis=1)
+        return numpy.where(best > 0, cut, length)
+
+    def countBase(self, seq, base):
+        """
+        Count the occurences of a base in each row of a matrix of reads
+        """
+        return (seq == base).view(numpy.uint8).sum(axis=1, dtype=numpy.int64)
+
+    def filterReads(self, seqs, scores):
+        """
+        Trim a batch of reads
+
+        Parameters
+        ----------
+        seqs : list
+            Sequence of each read
+        scores : list
+            Quality scores of each read
+
+        Returns
+        -------
+        tuple
+            (numpy.array of the length of each read after trimming,
+            numpy.array of the reason each read fails the filters: 0 if it
+            passes, then 1 too short, 2 too many Ns, 3 low complexity)
+        """
+        count = len(seqs)
+        lengths = numpy.fromiter(map(len, seqs), dtype=numpy.int64, count=count)
+        cuts = lengths.copy()
+
+        if self.adapter is not None:
+            cuts = numpy.minimum(cuts, numpy.array(self.adapterPositions(seqs), dtype=numpy.int64))
+
+        fails = numpy.zeros(count, dtype=numpy.int8)
+        n_counts = numpy.zeros(count, dtype=numpy.int64)
+        base_counts = numpy.zeros(count, dtype=numpy.int64)
+
+        # The reads of each length are trimmed as a matrix with a row for
+        # each read
+        order = numpy.argsort(lengths, kind='mergesort')
+        sorted_lengths = lengths[order]
+        bounds = numpy.flatnonzero(numpy.diff(sorted_lengths)) + 1
+        for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [count]):
+            length = int(sorted_lengths[start])
+            if length == 0:
+                continue
+            rows = order[start:end]
+            row_list = rows.tolist()
+
+            row_scores = [scores[i] for i in row_list]
+            if self.quality is not None and sum(map(len, row_scores)) == len(row_list) * length:
+                # Only reads that end in a base at or below the cutoff can be
+                # trimmed
+                ends = numpy.fromiter([ord(score[-1]) for score in row_scores], dtype=numpy.int64, count=len(row_list))
+                trim = numpy.flatnonzero(ends - self.quality_offset <= self.quality)
+                if len(trim) > 0:
+                    trim_scores = [row_scores[i] for i in trim.tolist()]
+                    cuts[rows[trim]] = numpy.minimum(cuts[rows[trim]], self.qualityTrim(trim_scores, length))
+
+            seq = join_lines([seqs[i] for i in row_list], length) | 0x20
+            row_cuts = cuts[rows]
+            trimmed = numpy.flatnonzero(row_cuts < length)
+            if len(trimmed) > 0:
+                # Bases past the cut are not counted
+                seq[trimmed] *= (numpy.arange(length)[None, :] < row_cuts[trimmed][:, None])
+
+            n_counts[rows] = self.countBase(seq, 110)
+            most = numpy.zeros(len(row_list), dtype=numpy.int64)
+            for base in [97, 99, 103, 116]:
+                most = numpy.maximum(most, self.countBase(seq, base))
+            base_counts[rows] = most
+
+        fails[base_counts > self.max_base_fraction * cuts] = 3
+        fails[n_counts > self.max_n * cuts] = 2
+        fails[cuts < self.min_length] = 1
+
+        return (cuts, fails)
+
+    def trimPairs(self, pairs):
+        """
+        Trim and filter a batch of pairs of reads
+
+        Parameters
+        ----------
+        pairs : list
+            (read 1, read 2) pairs with each read as an (id, seq, add, score)
+            tuple
+
+        Returns
+        -------
+        list
+            The pairs where both reads pass the filters, trimmed
+        """
+        if len(pairs) == 0:
+            return []
+
+        trimmed = []
+        for side in [0, 1]:
+            reads = [pair[side] for pair in pairs]
+            trimmed.append(self.filterReads([read[1] for read in reads], [read[3] for read in reads]))
+
+        cuts1, fails1 = trimmed[0]
+        cuts2, fails2 = trimmed[1]
+        fails = numpy.where(fails1 > 0, fails1, fails2)
+
+        self.pairs_in += len(pairs)
+        self.too_short += int((fails == 1).sum())
+        self.too_many_n += int((fails == 2).sum())
+        self.low_complexity += int((fails == 3).sum())
+
+        pairs_out = []
+        for i in numpy.flatnonzero(fails == 0).tolist():
+            r1, r2 = pairs[i]
+            c1 = int(cuts1[i])
+            c2 = int(cuts2[i])
+            pairs_out.append((
+                (r1[0], r1[1][:c1], r1[2], r1[3][:c1]),
+                (r2[0], r2[1][:c2], r2[2], r2[3][:c2])
+            ))
+            self.bases_trimmed += len(r1[1]) - c1 + len(r2[1]) - c2
+
+        self.pairs_out += len(pairs_out)
+        return pairs_out
+
+    def merge(self, other):
+        """
+        Add the counts from another trimmer, such as one run over a different
+        range of the same files
+        """
+        self.pairs_in += other.pairs_in
+        self.pairs_out += other.pairs_out
+        self.bases_trimmed += other.bases_trimmed
+        self.too_short += other.too_short
+        self.too_many_n += other.too_many_n
+        self.low_complexity += other.low_complexity
+
+    def summary(self):
+        """
+        Get the counts of the pairs that have been trimmed and filtered
+
+        Returns
+        -------
+        dict
+            pairs_in, pairs_out, bases_trimmed and the number of pairs
+            removed as too_short, too_many_n or low_complexity
+        """
+        return {
+            'pairs_in': self.pairs_in,
+            'pairs_out': self.pairs_out,
+            'bases_trimmed': self.bases_trimmed,
+            'too_short': self.too_short,
+            'too_many_n': self.too_many_n,
+            'low_complexity': self.low_complexity
+        }
@@ -0,0 +1,359 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import fcntl, glob, hashlib, json, os, time
+
+# Environment variables for the location of the shared cache and the number of
+# bytes that it can use. The cache is only used when the location is set.
+CACHE_DIR_ENV = 'MG_CACHE_DIR'
+CACHE_QUOTA_ENV = 'MG_CACHE_QUOTA'
+
+# Default number of bytes that the cache can use before the least recently
+# used files are removed
+CACHE_QUOTA = 500 * 1024 * 1024 * 1024
+
+# Number of seconds that a file without a checksum is used for when the
+# server gives nothing to check that it has not changed
+CACHE_UNCHECKED_TTL = 24 * 60 * 60
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_LOCK = 'manifest.lock'
+
+
+def cache_from_environment():
+    """
+    Get the shared cache set up with the MG_CACHE_DIR and MG_CACHE_QUOTA
+    environment variables
+
+    Returns
+    -------
+    filecache
+        None if MG_CACHE_DIR is not set
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir is None or cache_dir == '':
+        return None
+
+    quota = os.environ.get(CACHE_QUOTA_ENV)
+    if quota is None or quota == '':
+        return filecache(cache_dir)
+    return filecache(cache_dir, int(quota))
+
+
+class filelock:
+    """
+    Exclusive lock held on a lock file with flock, so that it is safe across
+    processes (on the same host) as well as threads
+    """
+
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.handle = None
+
+    def acquire(self):
+        """
+        Wait for and take the lock
+        """
+        self.handle = open(self.lock_file, 'a')
+        fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        """
+        Give up the lock
+        """
+        fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class filecache:
+    """
+    Content addressed cache of downloaded files that is shared between the
+    pipelines, so that the same assembly or run is only downloaded once
+    whatever data_dir layout it is used from.
+
+    Files are keyed on their URL and checksum (when it is known) and are
+    linked into place: a hardlink when the cache is on the same file system,
+    otherwise a symlink. The state of the cache is kept in a JSON manifest
+    that is only read and written while holding an flock on a lock file, so
+    that any number of processes can use the cache at the same time. Each
+    download also holds a lock for its key so that a file being fetched by
+    one process is waited for rather than downloaded again by another.
+
+    A file without a checksum (eg a "current" release on Ensembl) is only
+    used while the validator from the server (see fetch()) is the same as
+    when it was downloaded, or if there is no validator, for
+    CACHE_UNCHECKED_TTL seconds. Otherwise it is downloaded again.
+
+    When the files in the cache add up to more than the quota the least
+    recently used files are removed. Hardlinked copies are not affected.
+    Files that have been handed out as a symlink are never removed, as that
+    would leave the links dangling, so a cache on a different file system to
+    the data directories can grow past its quota and has to be cleaned up
+    by hand.
+    """
+
+    def __init__(self, cache_dir, quota = CACHE_QUOTA, unchecked_ttl = CACHE_UNCHECKED_TTL):
+        """
+        Initialise the cache
+
+        Parameters
+        ----------
+        cache_dir : str
+            Location of the cache
+        quota : int
+            Number of bytes the cache can use
+        unchecked_ttl : int
+            Number of seconds a file without a checksum or validator is used
+            for
+        """
+        self.cache_dir = cache_dir
+        self.quota = quota
+        self.unchecked_ttl = unchecked_ttl
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.manifest_file = os.path.join(cache_dir, MANIFEST_FILE)
+        self.lock_file = os.path.join(cache_dir, MANIFEST_LOCK)
+
+        if os.path.isdir(self.objects_dir) == False:
+            try:
+                os.makedirs(self.objects_dir)
+            except OSError:
+                # Made by another process
+                if os.path.isdir(self.objects_dir) == False:
+                    raise
+
+    def key(self, url, checksum = None):
+        """
+        Get the key for a file from its URL and checksum
+        """
+        return hashlib.sha1(url + '\n' + (checksum or '').lower()).hexdigest()
+
+    def objectPath(self, key):
+        """
+        Location of the cached file for a key
+        """
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def loadManifest(self):
+        """
+        Read the manifest. Only call this while holding the manifest lock.
+        """
+        if os.path.isfile(self.manifest_file) == False:
+            return {}
+        with open(self.manifest_file, 'r') as f_in:
+            try:
+                return json.load(f_in)
+            except ValueError:
+                return {}
+
+    def saveManifest(self, manifest):
+        """
+        Replace the manifest. Only call this while holding the manifest lock.
+        """
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f_out:
+            json.dump(manifest, f_out)
+        os.rename(tmp_file, self.manifest_file)
+
+    def stale(self, entry, validator = None):
+        """
+        Check if a file without a checksum may have changed on the server
+        since it was downloaded
+
+        Parameters
+        ----------
+        entry : dict
+            Manifest entry for the file
+        validator : str
+            Current validator for the URL from the server, None if there is
+            not one
+        """
+        if entry.get('checksum'):
+            return False
+        if validator is not None and entry.get('validator') is not None:
+            return validator != entry['validator']
+        return time.time() - entry.get('added', 0) >= self.unchecked_ttl
+
+    def lookup(self, key, file_location = None, validator = None):
+        """
+        Get the location of a cached file and mark it as used. If
+        file_location is set the file is linked there while the manifest is
+        locked, so that it cannot be evicted first.
+
+        Returns
+        -------
+        str
+            Location of the file in the cache, None if it is not cached or
+            is stale (see stale())
+        """
+        with filelock(self.lock_file):
+            manifest = self.loadManifest()
+            if key not in manifest or self.stale(manifest[key], validator):
+                return None
+
+            object_path = self.objectPath(key)
+            if os.path.isfile(object_path) == False:
+                del manifest[key]
+                self.saveManifest(manifest)
+                return None
+
+            manifest[key]['last_used'] = time.time()
+            if file_location is not None and self.link(object_path, file_location) == False:
+                manifest[key]['symlinked'] = True
+            self.saveManifest(manifest)
+            return object_path
+
+    def add(self, key, url, checksum, file_location, validator = None):
+        """
+        Record a file that has been downloaded to the location for its key,
+        link it to file_location and remove the least recently used files if
+        the cache is over quota
+        """
+        with filelock(self.lock_file):
+            manifest = self.loadManifest()
+            manifest[key] = {
+                'url': url,
+                'checksum': checksum,
+                'validator': validator,
+                'size': os.path.getsize(self.objectPath(key)),
+                'added': time.time(),
+                'last_used': time.time()
+            }
+            if self.link(self.objectPath(key), file_location) == False:
+                manifest[key]['symlinked'] = True
+            self.evict(manifest, key)
+            self.saveManifest(manifest)
+
+    def evict(self, manifest, keep = None):
+        """
+        Remove the least recently used files from the cache until it is
+        within the quota. Files that have been symlinked are kept. Only call
+        this while holding the manifest lock.
+
+        Parameters
+        ----------
+        manifest : dict
+            Manifest to remove the entries from
+        keep : str
+            Key of a file that should not be removed
+        """
+        total = sum([entry['size'] for entry in manifest.values()])
+        for key in sorted(manifest, key=lambda k: manifest[k]['last_used']):
+            if total <= self.quota:
+                break
+            if key == keep or manifest[key].get('symlinked') == True:
+                continue
+
+            object_path = self.objectPath(key)
+            if os.path.isfile(object_path):
+                os.remove(object_path)
+            total -= manifest[key]['size']
+            del manifest[key]
+
+    def link(self, object_path, file_location):
+        """
+        Hardlink a cached file into place, or symlink it if the cache is on a
+        different file system
+
+        Returns
+        -------
+        bool
+            True if the file was hardlinked, False if it was symlinked
+        """
+        if os.path.lexists(file_location):
+            os.remove(file_location)
+        try:
+            os.link(object_path, file_location)
+            return True
+        except OSError:
+            os.symlink(os.path.abspath(object_path), file_location)
+            return False
+
+    def fetch(self, file_location, url, download, checksum = None, validator = None):
+        """
+        Get a file from the cache, downloading it into the cache first if it
+        is not there
+
+        Parameters
+        ----------
+        file_location : str
+            Location to link the file to
+        url : str
+            URL of the file
+        download : function
+            Called as download(location, url, checksum) to download the file.
+            It should return False if the download failed.
+        checksum : str
+            MD5 checksum of the file, if it is known
+        validator : function
+            Called as validator(url) for files without a checksum to get a
+            string that changes when the file on the server changes (eg its
+            ETag), or None if the server does not give one
+
+        Returns
+        -------
+        bool
+            True if the file is in place
+        """
+        key = self.key(url, checksum)
+        current = None
+        if checksum is None and validator is not None:
+            current = validator(url)
+        if self.lookup(key, file_location, current) is not None:
+            return True
+
+        object_dir = os.path.dirname(self.objectPath(key))
+        if os.path.isdir(object_dir) == False:
+            try:
+                os.makedirs(object_dir)
+            except OSError:
+                if os.path.isdir(object_dir) == False:
+                    raise
+
+        with filelock(self.objectPath(key) + '.lock'):
+            # Another process may have downloaded it while this one was
+            # waiting for the lock
+            if self.lookup(key, file_location, current) is not None:
+                return True
+
+            part_path = self.objectPath(key) + '.part'
+            try:
+                downloaded = download(part_path, url, checksum)
+            except:
+                self.removePart(part_path)
+                raise
+            if downloaded == False:
+                self.removePart(part_path)
+                return False
+            os.rename(part_path, self.objectPath(key))
+            self.add(key, url, checksum, file_location, current)
+        return True
+
+    def removePart(self, part_path):
+        """
+        Remove a failed download, along with any files the download left
+        beside it (such as its progress sidecar), as these are not counted
+        against the quota
+        """
+        for file_name in glob.glob(part_path + '*'):
+            os.remove(file_name)
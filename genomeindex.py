@@ -0,0 +1,279 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib, json, os, re, shlex, subprocess, time
+
+from filecache import filelock
+
+# Suffix of the manifest of the indexes that have been built for a FASTA file
+INDEX_MANIFEST_SUFFIX = '.indexes.json'
+
+# Files written by each indexer. The BWA files are named after the FASTA file,
+# the others after the FASTA file without the .fa. The first file is the one
+# that is returned as the location of the index. Bowtie2 writes .bt2l files
+# in place of .bt2 for large genomes.
+INDEX_FILES = {
+    'bwa' : ['.bwt', '.amb', '.ann', '.pac', '.sa'],
+    'bowtie' : ['.1.bt2', '.2.bt2', '.3.bt2', '.4.bt2', '.rev.1.bt2', '.rev.2.bt2'],
+    'gem' : ['.gem']
+}
+
+# Commands that print the version of each indexer
+INDEXER_VERSION_COMMANDS = {
+    'bwa' : 'bwa',
+    'bowtie' : 'bowtie2-build --version',
+    'gem' : 'gem-indexer --version'
+}
+
+# Number of bytes of the FASTA file read at a time for the checksum
+CHECKSUM_BLOCK_SIZE = 16 * 1024 * 1024
+
+TOOL_VERSIONS = {}
+
+
+def index_prefix(genome_file):
+    """
+    Location of a FASTA file without the .fa, which the Bowtie2 and GEM
+    indexes are named after
+    """
+    if genome_file.endswith('.fa'):
+        return genome_file[:-3]
+    return genome_file
+
+
+def index_files(genome_file, tool):
+    """
+    Locations of the files for the index of a FASTA file made by an indexer
+
+    Returns
+    -------
+    list
+        The primary index file first
+    """
+    if tool == 'bwa':
+        return [genome_file + suffix for suffix in INDEX_FILES[tool]]
+
+    files = [index_prefix(genome_file) + suffix for suffix in INDEX_FILES[tool]]
+    if tool == 'bowtie' and os.path.isfile(files[0]) == False and os.path.isfile(files[0] + 'l'):
+        files = [file_name + 'l' for file_name in files]
+    return files
+
+
+def tool_version(tool):
+    """
+    Get the version of an indexer from its INDEXER_VERSION_COMMANDS. The
+    version is only looked up once in each process.
+
+    Returns
+    -------
+    str
+        'unknown' if the indexer could not be run or did not give a version
+    """
+    if tool in TOOL_VERSIONS:
+        return TOOL_VERSIONS[tool]
+
+    version = 'unknown'
+    try:
+        p = subprocess.Popen(shlex.split(INDEXER_VERSION_COMMANDS[tool]), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        match = re.search(r'[Vv]ersion:?\s+v?(\S+)', output)
+        if match is not None:
+            version = match.group(1)
+        elif output.strip() != '':
+            version = output.strip().split('\n')[0].split()[-1]
+    except OSError:
+        pass
+
+    TOOL_VERSIONS[tool] = version
+    return version
+
+
+class indexregistry:
+    """
+    Registry of the aligner indexes that have been built for a genome FASTA
+    file. The manifest (<genome>.indexes.json) records for each indexer the
+    checksum of the FASTA file, the version of the indexer, the parameters
+    and the size of every file that it produced. The files are recorded
+    relative to the directory of the FASTA file.
+
+    The lookup is cheap: while the FASTA file has the size and modification
+    time that were recorded the checksum is trusted, and only if they have
+    changed (eg the headers were rewritten in place) is the file read to
+    check that the content is the same. An index is valid if the checksum and
+    version match and all of its files are present with the recorded sizes.
+
+    Each indexer has a lock file (<genome>.<tool>.lock) that is held while
+    the index is built, so that concurrent pipelines wait for an index that
+    is being built instead of building it again.
+    """
+
+    def __init__(self, genome_file):
+        """
+        Initialise the registry
+
+        Parameters
+        ----------
+        genome_file : str
+            Location of the (uncompressed) genome FASTA file
+        """
+        self.genome_file = genome_file
+        self.manifest_file = genome_file + INDEX_MANIFEST_SUFFIX
+        self.manifest_lock = self.manifest_file + '.lock'
+        self.genome_dir = os.path.dirname(genome_file)
+        self.fasta_md5 = None
+
+    def lock(self, tool):
+        """
+        Lock to hold while building the index for an indexer
+        """
+        return filelock(self.genome_file + '.' + tool + '.lock')
+
+    def loadManifest(self):
+        """
+        Read the manifest. Only call this while holding the manifest lock.
+        """
+        if os.path.isfile(self.manifest_file) == False:
+            return {}
+        with open(self.manifest_file, 'r') as f_in:
+            try:
+                return json.load(f_in)
+            except ValueError:
+                return {}
+
+    def saveManifest(self, manifest):
+        """
+        Replace the manifest. Only call this while holding the manifest lock.
+        """
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f_out:
+            json.dump(manifest, f_out, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.manifest_file)
+
+    def fastaStat(self):
+        """
+        Size and modification time of the FASTA file
+        """
+        stat = os.stat(self.genome_file)
+        return {'size' : stat.st_size, 'mtime' : stat.st_mtime}
+
+    def checksum(self):
+        """
+        MD5 checksum of the FASTA file. This is only calculated once for each
+        registry.
+        """
+        if self.fasta_md5 is None:
+            md5 = hashlib.md5()
+            with open(self.genome_file, 'rb') as f_in:
+                for block in iter(lambda: f_in.read(CHECKSUM_BLOCK_SIZE), ''):
+                    md5.update(block)
+            self.fasta_md5 = md5.hexdigest()
+        return self.fasta_md5
+
+    def primary(self, entry):
+        """
+        Location of the primary index file for a manifest entry
+        """
+        return os.path.join(self.genome_dir, str(entry['primary']))
+
+    def lookup(self, tool, version = None):
+        """
+        Check if there is a valid index from an indexer
+
+        Parameters
+        ----------
+        tool : str
+            bwa, bowtie or gem
+        version : str
+            Version of the indexer that the index must have been built with.
+            None to accept any version.
+
+        Returns
+        -------
+        dict
+            The manifest entry for the index, None if there is no valid index
+        """
+        with filelock(self.manifest_lock):
+            entry = self.loadManifest().get(tool)
+        if entry is None:
+            return None
+
+        if version is not None and entry['version'] != version:
+            return None
+
+        for file_name, size in entry['files'].items():
+            file_name = os.path.join(self.genome_dir, file_name)
+            if os.path.isfile(file_name) == False or os.path.getsize(file_name) != size:
+                return None
+
+        fasta = self.fastaStat()
+        if fasta['size'] != entry['fasta']['size']:
+            return None
+        if fasta['mtime'] != entry['fasta']['mtime']:
+            # The checksum is calculated without holding the manifest lock so
+            # that other pipelines are not held up while the file is read
+            if self.checksum() != entry['fasta']['md5']:
+                return None
+
+            # Same content, so the new time is recorded to save reading the
+            # file again
+            with filelock(self.manifest_lock):
+                manifest = self.loadManifest()
+                if tool in manifest and manifest[tool]['fasta']['md5'] == entry['fasta']['md5']:
+                    manifest[tool]['fasta']['mtime'] = fasta['mtime']
+                    self.saveManifest(manifest)
+
+        return entry
+
+    def record(self, tool, version, params, files):
+        """
+        Add the index built by an indexer to the manifest
+
+        Parameters
+        ----------
+        tool : str
+            bwa, bowtie or gem
+        version : str
+            Version of the indexer
+        params : str
+            Parameters the indexer was run with
+        files : list
+            Locations of the files of the index. The first is the primary
+            index file.
+        """
+        fasta = self.fastaStat()
+        fasta['md5'] = self.checksum()
+
+        with filelock(self.manifest_lock):
+            manifest = self.loadManifest()
+            manifest[tool] = {
+                'fasta' : fasta,
+                'version' : version,
+                'params' : params,
+                'primary' : os.path.basename(files[0]),
+                'files' : dict([(os.path.basename(file_name), os.path.getsize(file_name)) for file_name in files]),
+                'created' : time.time()
+            }
+            self.saveManifest(manifest)
+
+    def remove(self, tool):
+        """
+        Remove the index from an indexer from the manifest
+        """
+        with filelock(self.manifest_lock):
+            manifest = self.loadManifest()
+            if tool in manifest:
+                del manifest[tool]
+                self.saveManifest(manifest)
@@ -0,0 +1,445 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections, hashlib, json, os, struct, tempfile
+
+import numpy
+
+from filecache import filelock
+
+# Suffix of the packed copy of a genome FASTA file
+GENOME_STORE_SUFFIX = '.pack'
+
+GENOME_STORE_MAGIC = 'MGPACK01'
+
+# Number of bytes of the FASTA file that are read at a time while packing
+PACK_BLOCK_SIZE = 16 * 1024 * 1024
+
+# 2 bit code for each base. Anything else (N, IUPAC codes) is stored as A and
+# covered by the N mask. Lower case (soft masked) bases are packed as upper
+# case.
+BASE_CODES = numpy.zeros(256, dtype=numpy.uint8) + 4
+for code, bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+
+BASE_CHARS = numpy.array([ord(base) for base in 'ACGT'], dtype=numpy.uint8)
+
+
+def store_file(genome_file):
+    """
+    Location of the packed copy of a genome FASTA file
+    """
+    return genome_file + GENOME_STORE_SUFFIX
+
+
+def pack_genome(genome_file, pack_file):
+    """
+    Pack a genome FASTA file 2 bits per base. The FASTA file is read in
+    blocks of PACK_BLOCK_SIZE and never held in memory as a whole.
+
+    Each chromosome is stored as its packed bases (4 per byte, first base in
+    the high bits), padded to 8 bytes, followed by the starts and ends of its
+    runs of Ns as little endian int64s. A JSON index of the chromosomes, with
+    their lengths and offsets, and the size, modification time and MD5 of the
+    FASTA file, is written at the end of the file followed by its offset and
+    the magic string.
+
+    Chromosomes are named after the first word of their header line.
+
+    Parameters
+    ----------
+    genome_file : str
+        Location of the genome FASTA file
+    pack_file : str
+        Location to save the packed genome to
+    """
+    fasta = os.stat(genome_file)
+    md5 = hashlib.md5()
+
+    # Written alongside and renamed so that no process can open a partial
+    # file
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(pack_file) + '.', dir=os.path.dirname(os.path.abspath(pack_file)))
+    try:
+        with os.fdopen(fd, 'wb') as f_out, open(genome_file, 'rb') as f_in:
+            f_out.write(GENOME_STORE_MAGIC)
+            chromosomes = []
+            packer = None
+            text = ''
+            while True:
+                block = f_in.read(PACK_BLOCK_SIZE)
+                md5.update(block)
+                text += block
+                if block == '':
+                    if text == '':
+                        break
+                    # A header line at the end of the file without a newline
+                    text += '\n'
+
+                pos = 0
+                while True:
+                    header = text.find('>', pos)
+                    if header == -1:
+                        if packer is not None:
+                            packer.add(text[pos:])
+                        text = ''
+                        break
+
+                    if packer is not None:
+                        packer.add(text[pos:header])
+
+                    header_end = text.find('\n', header)
+                    if header_end == -1:
+                        # The rest of the header is in the next block
+                        text = text[header:]
+                        break
+
+                    if packer is not None:
+                        chromosomes.append(packer.finish())
+                    name = text[header + 1:header_end].strip().split()
+                    packer = chromosomepacker(name[0] if len(name) > 0 else '', f_out)
+                    pos = header_end + 1
+
+            if packer is not None:
+                chromosomes.append(packer.finish())
+
+            index = json.dumps({
+                'fasta' : {'size' : fasta.st_size, 'mtime' : fasta.st_mtime, 'md5' : md5.hexdigest()},
+                'chromosomes' : chromosomes
+            })
+            index_offset = f_out.tell()
+            f_out.write(index)
+            f_out.write(struct.pack('<Q', index_offset))
+            f_out.write(GENOME_STORE_MAGIC)
+
+        os.chmod(tmp_file, fasta.st_mode & 0777)
+        os.rename(tmp_file, pack_file)
+    except:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def load_genome(genome_file):
+    """
+    Get the packed copy of a genome FASTA file, packing it first if it has
+    not been packed or the FASTA file has changed since it was. Concurrent
+    processes wait for the one that is packing the genome.
+
+    Returns
+    -------
+    genomestore
+    """
+    pack_file = store_file(genome_file)
+
+    store = genomestore.current(genome_file)
+    if store is not None:
+        return store
+
+    with filelock(pack_file + '.lock'):
+        store = genomestore.current(genome_file)
+        if store is not None:
+            return store
+
+        print "Packing genome - " + genome_file
+        pack_genome(genome_file, pack_file)
+        return genomestore(pack_file)
+
+
+class chromosomepacker:
+    """
+    Packs the sequence of one chromosome to the store as it is read, carrying
+    the bases that do not fill a byte and the current run of Ns on to the
+    next piece of sequence
+    """
+
+    def __init__(self, name, f_out):
+        self.name = name
+        self.f_out = f_out
+        self.offset = f_out.tell()
+        self.length = 0
+        self.carry = numpy.zeros(0, dtype=numpy.uint8)
+        self.n_starts = []
+        self.n_ends = []
+
+    def add(self, text):
+        """
+        Pack a piece of the sequence. Line breaks are removed.
+        """
+        text = text.translate(None, '\r\n \t')
+        if text == '':
+            return
+
+        codes = BASE_CODES[numpy.frombuffer(text, dtype=numpy.uint8)]
+
+        # Runs of Ns, from the changes in and out of Ns
+        is_n = numpy.concatenate(([0], (codes == 4).view(numpy.int8), [0]))
+        changes = numpy.flatnonzero(numpy.diff(is_n))
+        if len(changes) > 0:
+            self.n_starts.append(changes[0::2] + self.length)
+            self.n_ends.append(changes[1::2] + self.length)
+            codes[codes == 4] = 0
+
+        self.length += len(codes)
+
+        codes = numpy.concatenate((self.carry, codes))
+        full = len(codes) - len(codes) % 4
+        self.carry = codes[full:]
+        if full > 0:
+            self.write(codes[:full])
+
+    def write(self, codes):
+        """
+        Pack 4 codes into each byte
+        """
+        packed = (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | codes[3::4]
+        self.f_out.write(packed.tostring())
+
+    def finish(self):
+        """
+        Write the last bases and the N mask
+
+        Returns
+        -------
+        dict
+            Index entry for the chromosome
+        """
+        if len(self.carry) > 0:
+            self.write(numpy.concatenate((self.carry, numpy.zeros(4 - len(self.carry), dtype=numpy.uint8))))
+
+        padding = -self.f_out.tell() % 8
+        self.f_out.write('\0' * padding)
+
+        n_starts = numpy.zeros(0, dtype=numpy.int64)
+        n_ends = numpy.zeros(0, dtype=numpy.int64)
+        if len(self.n_starts) > 0:
+            n_starts = numpy.concatenate(self.n_starts).astype(numpy.int64)
+            n_ends = numpy.concatenate(self.n_ends).astype(numpy.int64)
+
+            # Join runs that were split between pieces of the sequence
+            split = n_starts[1:] == n_ends[:-1]
+            n_starts = n_starts[numpy.concatenate(([True], split == False))]
+            n_ends = n_ends[numpy.concatenate((split == False, [True]))]
+
+        n_offset = self.f_out.tell()
+        self.f_out.write(n_starts.astype('<i8').tostring())
+        self.f_out.write(n_ends.astype('<i8').tostring())
+
+        return {
+            'name' : self.name,
+            'length' : self.length,
+            'offset' : self.offset,
+            'n_offset' : n_offset,
+            'n_count' : len(n_starts)
+        }
+
+
+class genomestore:
+    """
+    Read only view of a packed genome (see pack_genome). The file is memory
+    mapped, so all of the processes on a node share one copy of it in the
+    page cache and only the parts that are used are read.
+
+    It behaves like the dict of chromosome name to upper case sequence that
+    is returned by TADbit's parse_fasta, in the order of the FASTA file. A
+    chromosome is unpacked when it is accessed and the last one is kept, so
+    only one chromosome is held as a string at a time. Parts of a chromosome
+    can be unpacked with fetch(), and length() and lengths() give the lengths
+    of the chromosomes without unpacking them.
+
+    It can be pickled, in which case the file is mapped again where it is
+    unpickled.
+    """
+
+    def __init__(self, pack_file):
+        """
+        Open a packed genome
+
+        Parameters
+        ----------
+        pack_file : str
+            Location of the packed genome
+        """
+        self.pack_file = pack_file
+        self.data = numpy.memmap(pack_file, dtype=numpy.uint8, mode='r')
+
+        if self.data[:8].tostring() != GENOME_STORE_MAGIC or self.data[-8:].tostring() != GENOME_STORE_MAGIC:
+            raise ValueError(pack_file + " is not a packed genome")
+
+        index_offset = struct.unpack('<Q', self.data[-16:-8].tostring())[0]
+        self.index = json.loads(self.data[index_offset:-16].tostring())
+        self.chromosomes = [str(chromosome['name']) for chromosome in self.index['chromosomes']]
+        self.entries = dict(zip(self.chromosomes, self.index['chromosomes']))
+
+        self.cached_name = None
+        self.cached_seq = None
+
+    @staticmethod
+    def current(genome_file):
+        """
+        Open the packed copy of a genome FASTA file if there is one that was
+        packed from the FASTA file as it is now. The MD5 of the FASTA file is
+        only checked if its size or modification time have changed.
+
+        Returns
+        -------
+        genomestore
+            None if there is no current packed copy
+        """
+        pack_file = store_file(genome_file)
+        if os.path.isfile(pack_file) == False:
+            return None
+
+        try:
+            store = genomestore(pack_file)
+        except ValueError:
+            return None
+
+        fasta = os.stat(genome_file)
+        packed = store.index['fasta']
+        if fasta.st_size != packed['size']:
+            return None
+        if fasta.st_mtime != packed['mtime']:
+            md5 = hashlib.md5()
+            with open(genome_file, 'rb') as f_in:
+                for block in iter(lambda: f_in.read(PACK_BLOCK_SIZE), ''):
+                    md5.update(block)
+            if md5.hexdigest() != packed['md5']:
+                return None
+        return store
+
+    def __getstate__(self):
+        return {'pack_file' : self.pack_file}
+
+    def __setstate__(self, state):
+        self.__init__(state['pack_file'])
+
+    def length(self, name):
+        """
+        Length of a chromosome, without unpacking it
+        """
+        return self.entries[name]['length']
+
+    def lengths(self):
+        """
+        Lengths of all of the chromosomes, without unpacking them. Use this
+        rather than len() of each chromosome, which unpacks it.
+
+        Returns
+        -------
+        OrderedDict
+            chromosome : length, in the order of the genome
+        """
+        return collections.OrderedDict([(name, self.entries[name]['length']) for name in self.chromosomes])
+
+    def nMask(self, name):
+        """
+        Starts and ends of the runs of Ns in a chromosome
+
+        Returns
+        -------
+        tuple
+            numpy arrays of the starts and ends, 0 based and end exclusive
+        """
+        entry = self.entries[name]
+        start = entry['n_offset']
+        count = entry['n_count']
+        n_starts = self.data[start:start + 8 * count].view('<i8')
+        n_ends = self.data[start + 8 * count:start + 16 * count].view('<i8')
+        return (n_starts, n_ends)
+
+    def fetch(self, name, start = 0, end = None):
+        """
+        Unpack part of a chromosome
+
+        Parameters
+        ----------
+        name : str
+            Name of the chromosome
+        start : int
+            0 based start of the sequence
+        end : int
+            End of the sequence (exclusive). None for the end of the
+            chromosome.
+
+        Returns
+        -------
+        str
+            Upper case sequence with Ns
+        """
+        entry = self.entries[name]
+        if end is None or end > entry['length']:
+            end = entry['length']
+        start = max(0, start)
+        if start >= end:
+            return ''
+
+        packed = self.data[entry['offset'] + start / 4:entry['offset'] + (end + 3) / 4]
+        codes = numpy.empty(len(packed) * 4, dtype=numpy.uint8)
+        codes[0::4] = packed >> 6
+        codes[1::4] = (packed >> 4) & 3
+        codes[2::4] = (packed >> 2) & 3
+        codes[3::4] = packed & 3
+
+        first = start - start % 4
+        seq = BASE_CHARS[codes[start - first:end - first]]
+
+        n_starts, n_ends = self.nMask(name)
+        for i in xrange(numpy.searchsorted(n_ends, start, side='right'), numpy.searchsorted(n_starts, end)):
+            seq[max(n_starts[i], start) - start:min(n_ends[i], end) - start] = ord('N')
+
+        return seq.tostring()
+
+    def __getitem__(self, name):
+        if name != self.cached_name:
+            seq = self.fetch(name)
+            self.cached_name = name
+            self.cached_seq = seq
+        return self.cached_seq
+
+    def get(self, name, default = None):
+        if name not in self.entries:
+            return default
+        return self[name]
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.chromosomes)
+
+    def __iter__(self):
+        return iter(self.chromosomes)
+
+    def keys(self):
+        return list(self.chromosomes)
+
+    def iterkeys(self):
+        return iter(self.chromosomes)
+
+    def itervalues(self):
+        for name in self.chromosomes:
+            yield self[name]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for name in self.chromosomes:
+            yield (name, self[name])
+
+    def items(self):
+        return list(self.iteritems())
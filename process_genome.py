@@ -23,11 +23,9 @@ from basic_modules import Tool, Workflow, Metadata
 from common import common
 from dmp import dmp
 
-import tool
-
 import os
 
-try
+try :
     from pycompss.api.parameter import FILE_IN, FILE_OUT
     from pycompss.api.task import task
     from pycompss.api.constraint import constraint
@@ -61,17 +59,12 @@ class processs_genome(Workflow):
         
         genome_fa = file_ids[0]
         
-        # Bowtie2 Indexer
-        bt = tool.bowtieIndexerTool(self.configuration)
-        bti, btm = bt.run((genome_fa), ())
-        
-        # BWA Indexer
-        bwa = tool.bwaIndexerTool(self.configuration)
-        bwai, bwam = bwa.run((genome_fa), ())
+        # The Bowtie2, BWA and GEM indexers are run at the same time within
+        # the cores and memory given in the configuration
+        cf = common()
+        indexes = cf.run_indexers(genome_fa, self.configuration.get('cores'), self.configuration.get('memory'))
         
-        # GEM Indexer
-        gem = tool.gemIndexerTool(self.configuration)
-        gemi, gemm = gem.run((genome_fa), ())
+        return (indexes, cf.indexer_stats)
 
 # ------------------------------------------------------------------------------
 
@@ -38,6 +38,10 @@ class process_hic:
         Initial grouping to download, parse and filter the individual
         experiments.
         
+        An optional 13th parameter downsamples the FastQ files before they
+        are mapped, either to a fraction (< 1) or a number of the pairs, for
+        test runs and for matching the depth of libraries.
+        
         Returns: None
         
         Output: Raw counts for the experiment in a HiC adjacency matrix saved to
@@ -58,6 +62,9 @@ class process_hic:
         same_fastq  = params[9]
         windows1    = params[10]
         windows2    = params[11]
+        downsample  = None
+        if len(params) > 12:
+            downsample = params[12]
         
         print "Got Params"
         
@@ -70,6 +77,9 @@ class process_hic:
         cf = common()
         in_files = cf.getFastqFiles(sra_id, data_dir)
         
+        if downsample is not None:
+            self.downsample(f2a, downsample)
+        
         map(f2a.mapWindows, [1, 2])
 
         f2a.parseGenomeSeq()
@@ -91,6 +101,38 @@ class process_hic:
         f2a.normalise_hic_data()
         f2a.save_hic_data()
 
+    def downsample(self, f2a, sample_size, seed = 0):
+        """
+        Replace the FastQ files for the experiment with a seeded sample of the
+        pairs (see fastqsampler). The sample is saved alongside the original
+        files.
+        
+        Input:   fastq2adjacency object with the parameters set, the fraction
+                 (< 1) or number of pairs to keep and the seed
+        
+        Returns: None
+        """
+        from fastqsampler import sampler_from_option
+        
+        sampler = sampler_from_option(sample_size, seed)
+        if sampler.count is not None:
+            suffix = '.sample_' + str(sampler.count) + '.fastq'
+        else:
+            suffix = '.sample_{0:.4f}.fastq'.format(sampler.fraction)
+        
+        out_file_1 = f2a.fastq_file_1.replace('.fastq', suffix)
+        if f2a.fastq_file_1 == f2a.fastq_file_2:
+            sampler.sampleFiles(f2a.fastq_file_1, None, out_file_1)
+            out_file_2 = out_file_1
+        else:
+            out_file_2 = f2a.fastq_file_2.replace('.fastq', suffix)
+            sampler.sampleFiles(f2a.fastq_file_1, f2a.fastq_file_2, out_file_1, out_file_2)
+        
+        print "Sampled pairs:", sampler.pairs_out, "of", sampler.pairs_in
+        
+        f2a.fastq_file_1 = out_file_1
+        f2a.fastq_file_2 = out_file_2
+
     def merge_adjacency_data(self, adj_list):
         """
         Merged the HiC filtered data into a single dataset.
@@ -227,6 +269,7 @@ if __name__ == "__main__":
     parser.add_argument("--expt_list", help="TSV detailing the SRA ID, library and restriction enzymeused that are to be treated as a single set")
     parser.add_argument("--tmp_dir", help="Temporary data dir")
     parser.add_argument("--data_dir", help="Data directory; location to download SRA FASTQ files and save results")
+    parser.add_argument("--downsample", help="Fraction (< 1) or number of pairs to sample from each FastQ file", type=float, default=None)
 
     # Get the matching parameters from the command line
     args = parser.parse_args()
@@ -237,6 +280,7 @@ if __name__ == "__main__":
     expt_list   = args.expt_list
     tmp_dir     = args.tmp_dir
     data_dir    = args.data_dir
+    downsample  = args.downsample
     
     # A default value is only required for the first few steps to generate the
     # intial alignments and prepare the HiC data for loading. The resolutions
@@ -257,7 +301,7 @@ if __name__ == "__main__":
         
         #                                sra_id,  library, enzyme_name
         more_params = [[genome, dataset, line[0], line[1], line[2], resolution, tmp_dir, data_dir, expt_name, False, windows1, windows2] for resolution in resolutions]
-        less_params = [genome, dataset, line[0], line[1], line[2], 1000, tmp_dir, data_dir, expt_name, False, windows1, windows2]
+        less_params = [genome, dataset, line[0], line[1], line[2], 1000, tmp_dir, data_dir, expt_name, False, windows1, windows2, downsample]
         more_loading_list += more_params
         less_loading_list += less_params
 
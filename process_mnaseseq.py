@@ -106,11 +106,13 @@ class process_mnaseseq:
         run_fastq_files = {}
         for run_id in expt["run_ids"]:
             run_ids.append(run_id)
-            if (expt.has_key("local") == False):
-                in_files = cf.getFastqFiles(expt["project_id"], data_dir, run_id)
-            else:
+            if (expt.has_key("local") == True):
                 in_files = [f for f in os.listdir(local_files) if re.match(run_id, f)]
-            run_fastq_files[run_id] = in_files
+                run_fastq_files[run_id] = in_files
+        
+        if (expt.has_key("local") == False):
+            # The files for all of the runs are downloaded at the same time
+            run_fastq_files = cf.getFastqRuns(expt["project_id"], data_dir, run_ids)
         
         # Run BWA
         paired = 0
@@ -69,7 +69,7 @@ class process_rnaseq:
         
         command_line = 'kallisto quant -i ' + cdna_idx_file + ' -o ' + data_dir + project
         if single == True:
-            fq_stats = self.seq_read_stats(fastq[0])
+            fq_stats = self.seq_read_stats(fastq[0], sample = 1000000)
             command_line += ' --single -l ' + str(fq_stats['mean']) + ' -s ' + str(fq_stats['std']) + ' ' + fastq[0]
         else:
             command_line += ' ' + fastq[0] + ' ' + fastq[1]
@@ -79,25 +79,81 @@ class process_rnaseq:
         p.wait()
     
     
-    def seq_read_stats(self, file_in):
+    def seq_read_stats(self, file_in, sample = None, tolerance = 0.001):
         """
-        Calculate the mean and standard deviation of the reads in a fastq file
+        Calculate the mean and standard deviation of the length of the reads
+        in a fastq file. The file can be gzip compressed.
+        
+        The read lengths are accumulated into a histogram a batch of reads at a
+        time, so the memory used does not depend on the number of reads.
+        
+        Parameters
+        ----------
+        file_in : str
+            Location of the FastQ file
+        sample : int
+            If set, stop reading once at least this many reads have been
+            counted and the standard error of the mean is within tolerance
+            of the mean. The reads are taken from the start of the file.
+        tolerance : float
+            Relative standard error of the mean at which the sampling stops
+        
+        Returns
+        -------
+        dict
+            mean : float
+            std : float
+            reads : int, number of reads that were counted
         """
         
-        from numpy import std
-        from numpy import mean
-
-        total_len = []
-        with open(file_in, 'r') as f:
-            forthlines = itertools.islice(f, 1, None, 4)
-            for line in forthlines:
-                line = line.rstrip()
-                total_len.append(len(line))
+        import numpy
 
-        s = std(total_len)
-        m = mean(total_len)
-
-        return {'mean' : m, 'std' : s}
+        from compression import open_input
+        from fastqreader import fastqblockreader
+        
+        counts = numpy.zeros(1, dtype=numpy.int64)
+        f = open_input(file_in)
+        try:
+            reader = fastqblockreader(f)
+            while True:
+                batch = reader.nextBatch(100000)
+                if len(batch['seq']) == 0:
+                    break
+                
+                lengths = numpy.fromiter(map(len, batch['seq']), dtype=numpy.int64, count=len(batch['seq']))
+                batch_counts = numpy.bincount(lengths)
+                if len(batch_counts) > len(counts):
+                    batch_counts[:len(counts)] += counts
+                    counts = batch_counts
+                else:
+                    counts[:len(batch_counts)] += batch_counts
+                
+                if sample is not None and counts.sum() >= sample:
+                    stats = self.length_stats(counts)
+                    if stats['std'] <= tolerance * stats['mean'] * numpy.sqrt(stats['reads']):
+                        break
+        finally:
+            f.close()
+        
+        return self.length_stats(counts)
+    
+    
+    def length_stats(self, counts):
+        """
+        Mean and standard deviation of the read lengths from a histogram of
+        the number of reads of each length
+        """
+        import numpy
+        
+        reads = int(counts.sum())
+        if reads == 0:
+            return {'mean' : 0.0, 'std' : 0.0, 'reads' : 0}
+        
+        lengths = numpy.arange(len(counts), dtype=numpy.float64)
+        m = float((lengths * counts).sum()) / reads
+        s = float(numpy.sqrt((((lengths - m) ** 2) * counts).sum() / reads))
+        
+        return {'mean' : m, 'std' : s, 'reads' : reads}
         
 
 if __name__ == "__main__":
@@ -151,7 +207,7 @@ if __name__ == "__main__":
     
     # Optain the paired FastQ files
     if (local == 0):
-        in_files = cf.getFastqFiles(ena_err_id, data_dir)
+        in_files = cf.getFastqFiles(ena_err_id, data_dir, decompress=False)
     else:
         in_files = [f for f in os.listdir(data_dir + project) if re.match(run_id, f)]
     
@@ -37,6 +37,10 @@ from common import common
 import pysam
 
 from fastqreader import *
+from fastqsplitter import fastqsplitter
+from fastqtrimmer import fastqtrimmer
+from fastqsampler import sampler_from_option
+from multiprocessing.pool import ThreadPool
 from FilterReads import *
 from bs_index.wg_build import *
 
@@ -61,6 +65,10 @@ class process_wgbs:
         alignment of whole genome datasets.
         
         If performing RRBS then this step can be skipped
+        
+        This makes a full copy of each of the files and filters the two mates
+        separately. The pipeline can instead trim and filter the pairs with a
+        fastqtrimmer passed to Splitter() (--trim).
         """
         FilterReads(infile, outfile, True)
         return 1
@@ -92,73 +100,37 @@ class process_wgbs:
         wg_build(fasta_file, build_command, ref_path, aligner)
         
 
-    def Splitter(self, in_file1, in_file2, tag):
+    def Splitter(self, in_file1, in_file2, tag, compression = None, processes = 1, reads_per_shard = 1000000, bases_per_shard = None, bytes_per_shard = None, shards = None, stats = False, trimmer = None, sampler = None):
         """
         Function to divide the FastQ files into separte sub files of 1000000
         sequences so that the aligner can get run in parallel.
         
+        Reads are paired on their ids. The input files do not need to be in
+        the same order, reads without a mate in the other file are dropped.
+        
+        The sub files can be compressed as they are written by setting
+        compression to 'gzip' or 'zstd'. With processes > 1 the files are
+        indexed and split in parallel when they are in the same order.
+        
+        The sub files can instead be sized on the number of bases or bytes in
+        them, or the files can be divided into a set number of shards
+        ('auto' for one per core) so that each alignment takes about the same
+        time.
+        
+        With stats the QC statistics for the input files are collected in the
+        same pass and saved alongside the sub files (see fastqstats).
+        
+        A fastqtrimmer can be given to quality trim, clip adapters and filter
+        the pairs as they are split, keeping both mates in sync, and a
+        fastqsampler to downsample them for test runs.
+        
         Returns: Returns a list of lists of the files that have been generated.
                  Each sub list containing the two paired end files for that
                  subset.
         """
         
-        fqr = fastqreader()
-        fqr.openPairedFastQ(in_file1, in_file2)
-        fqr.createOutputFiles(tag)
-
-        r1 = fqr.next(1)
-        r2 = fqr.next(2)
-
-        count_r1 = 0
-        count_r2 = 0
-        count_r3 = 0
-        
-        f1 = fqr.fastq1.split("/")
-        f1[-1] = f1[-1].replace(".fastq", "." + str(fqr.output_tag) + "_" + str(fqr.output_file_count) + ".fastq")
-        f1.insert(-1, "tmp")
-        
-        f2 = fqr.fastq2.split("/")
-        f2[-1] = f2[-1].replace(".fastq", "." + str(fqr.output_tag) + "_" + str(fqr.output_file_count) + ".fastq")
-        f2.insert(-1, "tmp")
-        files_out = [["/".join(f1), "/".join(f2)]]
-
-        while fqr.eof(1) == False and fqr.eof(2) == False:
-            r1_id = r1["id"].split(" ")
-            r2_id = r2["id"].split(" ")
-            
-            if r1_id[0] == r2_id[0]:
-                fqr.writeOutput(r1, 1)
-                fqr.writeOutput(r2, 2)
-                
-                r1 = fqr.next(1)
-                r2 = fqr.next(2)
-                
-                count_r1 += 1
-                count_r2 += 1
-                count_r3 += 1
-            elif r1_id[0] < r2_id[0]:
-                r1 = fqr.next(1)
-                count_r1 += 1
-            else:
-                r2 = fqr.next(2)
-                count_r2 += 1
-            
-            if count_r3 % 1000000 == 0:
-                fqr.incrementOutputFiles()
-                f1 = fqr.fastq1.split("/")
-                f1[-1] = f1[-1].replace(".fastq", "." + str(fqr.output_tag) + "_" + str(fqr.output_file_count) + ".fastq")
-                f1.insert(-1, "tmp")
-                
-                f2 = fqr.fastq2.split("/")
-                f2[-1] = f2[-1].replace(".fastq", "." + str(fqr.output_tag) + "_" + str(fqr.output_file_count) + ".fastq")
-                f2.insert(-1, "tmp")
-                
-                files_out.append(["/".join(f1), "/".join(f2)])
-
-        fqr.closePairedFastQ()
-        fqr.closeOutputFiles()
-        
-        return files_out
+        fqs = fastqsplitter(in_file1, in_file2, tag, compression, reads_per_shard, processes, bases_per_shard, bytes_per_shard, shards, stats=stats, trimmer=trimmer, sampler=sampler)
+        return fqs.split()
 
 
     #@constraint(ProcessorCoreCount=8)
@@ -229,6 +201,16 @@ if __name__ == "__main__":
     parser.add_argument("--data_dir", help="Data directory; location to download SRA FASTQ files and save results")
     parser.add_argument("--aligner_dir", help="Directory for the aligner program")
     parser.add_argument("--local", help="Directory and data files already available", default=0)
+    parser.add_argument("--processes", help="Number of processes used to split the FastQ files", type=int, default=1)
+    parser.add_argument("--bases_per_shard", help="Size the split FastQ files on the number of bases", type=int, default=None)
+    parser.add_argument("--shards", help="Number of split FastQ files, or 'auto' for one per core", default=None)
+    parser.add_argument("--qc_stats", help="Collect QC statistics while splitting the FastQ files", action="store_true")
+    parser.add_argument("--trim", help="Quality trim and filter the pairs as they are split (skip this for RRBS)", action="store_true")
+    parser.add_argument("--trim_quality", help="Quality cutoff for trimming the 3' end of the reads", type=int, default=20)
+    parser.add_argument("--adapter", help="Sequence of the 3' adapter to clip from the reads", default=None)
+    parser.add_argument("--min_length", help="Shortest trimmed read that is kept", type=int, default=20)
+    parser.add_argument("--downsample", help="Fraction (< 1) or number of pairs to sample from the FastQ files", type=float, default=None)
+    parser.add_argument("--stream", help="Split the FastQ files as they are downloaded and align each shard as soon as it is written", action="store_true")
 
     # Get the matching parameters from the command line
     args = parser.parse_args()
@@ -243,6 +225,17 @@ if __name__ == "__main__":
     data_dir = args.data_dir
     tmp_dir  = args.tmp_dir
     local = args.local
+    processes = args.processes
+    bases_per_shard = args.bases_per_shard
+    shards = args.shards
+    qc_stats = args.qc_stats
+    trimmer = None
+    if args.trim == True or args.adapter is not None:
+        trimmer = fastqtrimmer(quality=args.trim_quality, adapter=args.adapter, min_length=args.min_length)
+    sampler = sampler_from_option(args.downsample)
+    stream = args.stream
+    if shards is not None and shards != 'auto':
+        shards = int(shards)
     
     start = time.time()
     
@@ -278,28 +271,39 @@ if __name__ == "__main__":
     cf = common()
     
     # Optain the paired FastQ files
-    if (local == 0):
+    if (local == 0 and stream == True):
+        # The files are streamed into the splitter once the genome is ready
+        in_files = [data_dir + project_id + '/' + srr_id + '_1.fastq', data_dir + project_id + '/' + srr_id + '_2.fastq']
+    elif (local == 0):
         in_files = cf.getFastqFiles(project_id, data_dir, srr_id)
     else:
         in_files = [f for f in os.listdir(data_dir + project_id + '/' + srr_id) if re.match(srr_id, f)]
     
     in_file1 = in_files[0]
     in_file2 = in_files[1]
-    out_file1 = in_file1.replace(".fastq", "_filtered.fastq")
-    out_file2 = in_file2.replace(".fastq", "_filtered.fastq")
     
     # Get the assembly
     genome_fa = cf.getGenomeFromENA(data_dir, species, assembly, False)
     
-    # Run the FilterReads.py steps for the individual FastQ files
-    for l in [[in_file1, out_file1], [in_file2, out_file2]]:
-        pwgbs.FilterFastQReads(l[0], l[1])
-    
     # Run the bs_seeker2-builder.py steps
     pwgbs.Builder(genome_fa["unzipped"], "bowtie2", aligner_dir, genome_dir)
         
-    # Split the paired fastq files
-    tmp_fastq = pwgbs.Splitter(in_file1, in_file2, 'tmp')
+    # Trim, filter and split the paired fastq files
+    if (local == 0 and stream == True):
+        # Start aligning each pair of shards as soon as it has been written
+        align_pool = ThreadPool(processes)
+        alignments = []
+        def align_shard(shard_files):
+            alignments.append(align_pool.apply_async(pwgbs.Aligner, [shard_files[0], shard_files[1], aligner, aligner_path[aligner], genome_fa["unzipped"], shard_files[0] + "_bspe.bam"]))
+        
+        tmp_fastq = cf.streamFastqFiles(project_id, data_dir, srr_id, 'tmp', bases_per_shard=bases_per_shard, stats=qc_stats, trimmer=trimmer, sampler=sampler, on_shard=align_shard)
+        
+        align_pool.close()
+        align_pool.join()
+        for alignment in alignments:
+            alignment.get()
+    else:
+        tmp_fastq = pwgbs.Splitter(in_file1, in_file2, 'tmp', processes=processes, bases_per_shard=bases_per_shard, shards=shards, stats=qc_stats, trimmer=trimmer, sampler=sampler)
     bam_sort_files = []
     bam_merge_files = []
     fastq_for_alignment = []
@@ -315,8 +319,9 @@ if __name__ == "__main__":
         bam_merge_files.append(bam_root + ".sorted.bam")
     
     # Run the bs_seeker2-align.py steps on the split up fastq files
-    for ffa in fastq_for_alignment:
-        pwgbs.Aligner(ffa[0], ffa[1], ffa[2], ffa[3][ffa[2]], ffa[4], ffa[5])
+    if (local != 0 or stream == False):
+        for ffa in fastq_for_alignment:
+            pwgbs.Aligner(ffa[0], ffa[1], ffa[2], ffa[3][ffa[2]], ffa[4], ffa[5])
     
     # Sort and merge the aligned bam files
     # Pre-sort the original input bam files
@@ -0,0 +1,335 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib, heapq, multiprocessing, os, re, tempfile
+
+import numpy
+
+from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
+try:
+    from pytadbit.mapping.restriction_enzymes import iupac2regex
+except ImportError:
+    # Older TADbit releases only have ACGT enzyme patterns
+    def iupac2regex(pattern):
+        return pattern
+
+from filecache import CACHE_DIR_ENV, filelock
+
+# Suffix of the files of restriction sites. They are named
+# <genome checksum>.<enzyme> + RE_SITE_SUFFIX
+RE_SITE_SUFFIX = '.resites.npz'
+
+# Strand column of the parsed reads for the strands in the GEM map files
+READ_STRANDS = {'+' : 1, '-' : 0}
+
+
+def genome_checksum(genome_seq):
+    """
+    Checksum of a genome. For a genomestore this is the MD5 of the FASTA file
+    that it was packed from, otherwise it is calculated from the names and
+    sequences of the chromosomes.
+    """
+    if hasattr(genome_seq, 'index') and 'fasta' in genome_seq.index:
+        return str(genome_seq.index['fasta']['md5'])
+
+    md5 = hashlib.md5()
+    for crm in genome_seq:
+        md5.update('>' + crm + '\n')
+        md5.update(genome_seq[crm])
+    return md5.hexdigest()
+
+
+def genome_lengths(genome_seq):
+    """
+    Lengths of the chromosomes of a genome. These come from the index of a
+    genomestore, so the chromosomes are not unpacked.
+    """
+    if hasattr(genome_seq, 'lengths'):
+        return genome_seq.lengths()
+    return dict([(crm, len(genome_seq[crm])) for crm in genome_seq])
+
+
+def re_site_dir(genome_seq):
+    """
+    Directory to keep the restriction sites in: resites in the shared cache
+    (MG_CACHE_DIR) if it is set, otherwise alongside the packed genome
+
+    Returns
+    -------
+    str
+        None if there is nowhere to keep them
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir is not None and cache_dir != '':
+        return os.path.join(cache_dir, 'resites')
+    if hasattr(genome_seq, 'pack_file'):
+        return os.path.dirname(os.path.abspath(genome_seq.pack_file))
+    return None
+
+
+def scan_re_sites(genome_seq, enzyme_name):
+    """
+    Find the restriction sites of an enzyme in a genome. As in TADbit, the
+    position of a site is the 1 based coordinate of the first base after the
+    cut.
+
+    Returns
+    -------
+    dict
+        chromosome : sorted numpy int64 array of the sites
+    """
+    enzyme = RESTRICTION_ENZYMES[enzyme_name]
+    pattern = re.compile(iupac2regex(enzyme.replace('|', '')))
+    cut = enzyme.index('|') + 1
+
+    sites = {}
+    for crm in genome_seq:
+        sites[crm] = numpy.fromiter((match.start() + cut for match in pattern.finditer(genome_seq[crm])), dtype=numpy.int64)
+    return sites
+
+
+def load_re_sites(genome_seq, enzyme_name, cache_dir = None):
+    """
+    Get the restriction sites of an enzyme in a genome, from the cache if
+    they have already been found for the same genome checksum and enzyme and
+    otherwise by scanning the genome and saving them to the cache.
+    Concurrent processes wait for the one that is scanning the genome.
+
+    Parameters
+    ----------
+    genome_seq : genomestore
+        Genome, or dict of chromosome name to sequence
+    enzyme_name : str
+        Name of the enzyme in TADbit's RESTRICTION_ENZYMES
+    cache_dir : str
+        Directory of the cache. Defaults to re_site_dir()
+
+    Returns
+    -------
+    resitemap
+    """
+    if cache_dir is None:
+        cache_dir = re_site_dir(genome_seq)
+
+    chromosomes = list(genome_seq)
+    crm_lengths = genome_lengths(genome_seq)
+    lengths = [crm_lengths[crm] for crm in chromosomes]
+
+    if cache_dir is None:
+        return resitemap(enzyme_name, chromosomes, lengths, scan_re_sites(genome_seq, enzyme_name))
+
+    if os.path.isdir(cache_dir) == False:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if os.path.isdir(cache_dir) == False:
+                raise
+
+    site_file = os.path.join(cache_dir, genome_checksum(genome_seq) + '.' + enzyme_name + RE_SITE_SUFFIX)
+    if os.path.isfile(site_file) == False:
+        with filelock(site_file + '.lock'):
+            if os.path.isfile(site_file) == False:
+                print "Finding " + enzyme_name + " sites"
+                sites = scan_re_sites(genome_seq, enzyme_name)
+
+                fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(site_file) + '.', dir=cache_dir)
+                try:
+                    arrays = dict([('sites_' + str(i), sites[crm]) for i, crm in enumerate(chromosomes)])
+                    with os.fdopen(fd, 'wb') as f_out:
+                        numpy.savez(f_out, chromosomes=numpy.array(chromosomes), lengths=numpy.array(lengths, dtype=numpy.int64), **arrays)
+                    os.chmod(tmp_file, 0644)
+                    os.rename(tmp_file, site_file)
+                except:
+                    if os.path.isfile(tmp_file):
+                        os.remove(tmp_file)
+                    raise
+
+    saved = numpy.load(site_file)
+    try:
+        chromosomes = [str(crm) for crm in saved['chromosomes']]
+        sites = dict([(crm, saved['sites_' + str(i)]) for i, crm in enumerate(chromosomes)])
+        return resitemap(enzyme_name, chromosomes, saved['lengths'].tolist(), sites)
+    finally:
+        saved.close()
+
+
+def parse_map_file(map_file, re_sites):
+    """
+    Read the uniquely mapped reads from a GEM map file and find the
+    restriction sites either side of each of them. As in TADbit the position
+    of a read is its 5' end, so for the reverse strand it is the last base of
+    the alignment.
+
+    Parameters
+    ----------
+    map_file : str
+        Location of the GEM map file
+    re_sites : resitemap
+
+    Returns
+    -------
+    list
+        Lines of the parsed reads, sorted by the read id
+    """
+    reads = {}
+    with open(map_file, 'r') as f_in:
+        for line in f_in:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5 or fields[4] in ('', '-') or ',' in fields[4]:
+                continue
+            crm, strand, pos = fields[4].split(':')[:3]
+            if crm not in re_sites.lengths:
+                continue
+            if crm not in reads:
+                reads[crm] = ([], [], [], [])
+            read_ids, positions, strands, read_lengths = reads[crm]
+            read_ids.append(fields[0])
+            positions.append(int(pos))
+            strands.append(READ_STRANDS[strand])
+            read_lengths.append(len(fields[1]))
+
+    lines = []
+    for crm, (read_ids, positions, strands, read_lengths) in reads.items():
+        positions = numpy.array(positions, dtype=numpy.int64)
+        read_lengths = numpy.array(read_lengths, dtype=numpy.int64)
+        positions += (numpy.array(strands) == 0) * (read_lengths - 1)
+        before, after = re_sites.fragments(crm, positions)
+        for read in zip(read_ids, positions.tolist(), strands, read_lengths.tolist(), before.tolist(), after.tolist()):
+            lines.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (read[0], crm, read[1], read[2], read[3], read[4], read[5]))
+    lines.sort()
+    return lines
+
+
+def _parse_map_file(args):
+    """
+    parse_map_file() for a multiprocessing Pool
+    """
+    return parse_map_file(*args)
+
+
+class resitemap:
+    """
+    Restriction sites of an enzyme in a genome, as a sorted numpy array for
+    each chromosome. The fragment that a position is in is found with
+    searchsorted.
+
+    parseMaps() uses the sites to write the reads from the GEM map files in
+    the format of TADbit's parse_map, without the scan of the genome that
+    parse_map does each time that it is run.
+    """
+
+    def __init__(self, enzyme_name, chromosomes, lengths, sites):
+        """
+        Initialise the map
+
+        Parameters
+        ----------
+        enzyme_name : str
+            Name of the enzyme
+        chromosomes : list
+            Names of the chromosomes, in the order of the genome
+        lengths : list
+            Lengths of the chromosomes
+        sites : dict
+            chromosome : sorted numpy array of the 1 based sites
+        """
+        self.enzyme_name = enzyme_name
+        self.chromosomes = chromosomes
+        self.lengths = dict(zip(chromosomes, lengths))
+        self.sites = sites
+
+    def boundaries(self, crm):
+        """
+        Ends of the fragments of a chromosome: the start of the chromosome,
+        the sites and the end of the chromosome
+        """
+        return numpy.concatenate(([1], self.sites[crm], [self.lengths[crm]]))
+
+    def fragments(self, crm, positions):
+        """
+        Find the fragments that positions on a chromosome are in
+
+        Parameters
+        ----------
+        crm : str
+            Name of the chromosome
+        positions : numpy array
+            1 based positions
+
+        Returns
+        -------
+        tuple
+            numpy arrays of the restriction sites before and after each
+            position (or the ends of the chromosome)
+        """
+        boundaries = self.boundaries(crm)
+        index = numpy.searchsorted(boundaries, positions, side='right')
+        index = numpy.clip(index, 1, len(boundaries) - 1)
+        return (boundaries[index - 1], boundaries[index])
+
+    def fragment(self, crm, position):
+        """
+        Restriction sites before and after a single position
+        """
+        before, after = self.fragments(crm, numpy.array([position]))
+        return (int(before[0]), int(after[0]))
+
+    def parseMaps(self, map_files, out_file, ncpus = 1, verbose = False):
+        """
+        Write the uniquely mapped reads from the GEM map files of one end of
+        the read pairs as TADbit's parsed reads: a '# CRM' header line with
+        the name and length of each chromosome and then a line for each read
+        of the read id, chromosome, position, strand (1 forward, 0 reverse),
+        length and the restriction sites before and after it, sorted by the
+        read id for get_intersection.
+
+        Parameters
+        ----------
+        map_files : list
+            Locations of the GEM map files, eg one for each mapping window
+        out_file : str
+            Location of the parsed reads
+        ncpus : int
+            Number of map files to read at the same time
+        verbose : bool
+
+        Returns
+        -------
+        int
+            Number of reads written
+        """
+        jobs = [(map_file, self) for map_file in map_files]
+        if ncpus > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(ncpus, len(jobs)))
+            try:
+                parsed = pool.map(_parse_map_file, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parsed = [_parse_map_file(job) for job in jobs]
+
+        count = 0
+        with open(out_file, 'w') as f_out:
+            for crm in self.chromosomes:
+                f_out.write('# CRM %s\t%d\n' % (crm, self.lengths[crm]))
+            for line in heapq.merge(*parsed):
+                f_out.write(line)
+                count += 1
+
+        if verbose:
+            print 'Parsed %d reads into %s' % (count, out_file)
+        return count
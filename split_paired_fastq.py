@@ -18,7 +18,9 @@ limitations under the License.
 
 import argparse, os.path, sys
 
-from fastqreader import fastqreader
+from fastqsplitter import fastqsplitter
+from fastqtrimmer import fastqtrimmer
+from fastqsampler import sampler_from_option
     
         
 # Set up the command line parameters
@@ -26,49 +28,38 @@ parser = argparse.ArgumentParser(description="Load adjacency list into HDF5 file
 parser.add_argument("--input_1", help="File 1")
 parser.add_argument("--input_2", help="File 2")
 parser.add_argument("--output_tag", help="Inserted before the file descriptor and after the file name: e.g. 'matching' would convert file_id-1.fastq to file_id-1.matching.fastq")
+parser.add_argument("--compression", help="Compress the output files (gzip or zstd)", default=None)
+parser.add_argument("--processes", help="Number of processes to split the files with", type=int, default=1)
+parser.add_argument("--reads_per_shard", help="Number of pairs in each shard", type=int, default=1000000)
+parser.add_argument("--bases_per_shard", help="Number of bases in each shard", type=int, default=None)
+parser.add_argument("--bytes_per_shard", help="Number of bytes of FastQ in each shard", type=int, default=None)
+parser.add_argument("--shards", help="Number of shards to divide the files into, or 'auto' for one per core", default=None)
+parser.add_argument("--mmap", help="Memory map the uncompressed input files", action="store_true")
+parser.add_argument("--stats", help="Save QC statistics for the input files alongside the shards", action="store_true")
+parser.add_argument("--trim", help="Quality trim and filter the pairs as they are split", action="store_true")
+parser.add_argument("--trim_quality", help="Quality cutoff for trimming the 3' end of the reads", type=int, default=20)
+parser.add_argument("--adapter", help="Sequence of the 3' adapter to clip from the reads", default=None)
+parser.add_argument("--min_length", help="Shortest trimmed read that is kept", type=int, default=20)
+parser.add_argument("--downsample", help="Fraction (< 1) or number of pairs to sample", type=float, default=None)
+parser.add_argument("--seed", help="Seed for the downsampling", type=int, default=0)
 
 args = parser.parse_args()
 file1 = args.input_1
 file2 = args.input_2
 tag = args.output_tag
+compression = args.compression
+processes = args.processes
+shards = args.shards
+if shards is not None and shards != 'auto':
+    shards = int(shards)
 
-fqr = fastqreader()
-fqr.openPairedFastQ(file1, file2)
-fqr.createOutputFiles(tag)
+trimmer = None
+if args.trim == True or args.adapter is not None:
+    trimmer = fastqtrimmer(quality=args.trim_quality, adapter=args.adapter, min_length=args.min_length)
 
-r1 = fqr.next(1)
-r2 = fqr.next(2)
+fqs = fastqsplitter(file1, file2, tag, compression, args.reads_per_shard, processes, args.bases_per_shard, args.bytes_per_shard, shards, args.mmap, args.stats, trimmer, sampler_from_option(args.downsample, args.seed))
+files_out = fqs.split()
 
-count_r1 = 0
-count_r2 = 0
-count_r3 = 0
-
-while fqr.eof(1) == False and fqr.eof(2) == False:
-    r1_id = r1["id"].split(" ")
-    r2_id = r2["id"].split(" ")
-    
-    if r1_id[0] == r2_id[0]:
-        fqr.writeOutput(r1, 1)
-        fqr.writeOutput(r2, 2)
-        
-        r1 = fqr.next(1)
-        r2 = fqr.next(2)
-        
-        count_r1 += 1
-        count_r2 += 1
-        count_r3 += 1
-    elif r1_id[0] < r2_id[0]:
-        r1 = fqr.next(1)
-        count_r1 += 1
-    else:
-        r2 = fqr.next(2)
-        count_r2 += 1
-    
-    if count_r3 % 1000000 == 0:
-        print count_r1, r1_id[0], count_r2, r2_id[0], count_r3
-        fqr.incrementOutputFiles()
-
-fqr.closePairedFastQ()
-fqr.closeOutputFiles()
-
-print count_r1, r1_id[0], count_r2, r2_id[0], count_r3
+print len(files_out), "shards"
+if fqs.stats_files is not None:
+    print "QC statistics:", " ".join([f for files in fqs.stats_files for f in files])
@@ -0,0 +1,145 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import BaseHTTPServer, os, random, SocketServer, struct, sys, threading, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Empty BGZF block that marks the end of a BGZF file
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def fastq_records(count, prefix = 'read', seed = 1):
+    """
+    List of FastQ records with random sequences of varying length
+    """
+    rand = random.Random(seed)
+    records = []
+    for i in range(count):
+        seq = ''.join([rand.choice('ACGT') for j in range(rand.randint(20, 120))])
+        records.append('@' + prefix + str(i) + '\n' + seq + '\n+\n' + 'I' * len(seq) + '\n')
+    return records
+
+
+def bgzf_block(data):
+    """
+    Compress data (up to 64KB) into a single BGZF block
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+    block_size = len(header) + 2 + len(deflated) + 8
+    return header + struct.pack('<H', block_size - 1) + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def write_bgzf(file_name, data, block_size = 4096):
+    """
+    Write data to a BGZF file, with block_size bytes of data in each block
+    """
+    with open(file_name, 'wb') as f_out:
+        for i in range(0, len(data), block_size):
+            f_out.write(bgzf_block(data[i:i + block_size]))
+        f_out.write(BGZF_EOF)
+
+
+class fileserver(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server for the download and metadata tests, run on a thread.
+    It serves the files in a dict of path to contents, with support for
+    Range requests, and counts the requests for each path.
+
+    status can be set to a dict of path to an HTTP status code to return in
+    place of the file, and range_status to one for the requests with a Range
+    header. Paths in no_ranges get the whole file for a Range request. drop
+    is a dict of path to a number of bytes after which the next response for
+    the path is cut off.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, files = None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), filehandler)
+        self.files = files if files is not None else {}
+        self.status = {}
+        self.range_status = {}
+        self.no_ranges = set()
+        self.drop = {}
+        self.requests = {}
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        """
+        URL of a path on the server
+        """
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + path
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class filehandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler for a fileserver
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests[self.path] = server.requests.get(self.path, 0) + 1
+
+        if self.path in server.status:
+            self.send_error(server.status[self.path])
+            return
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+
+        data = server.files[self.path]
+        start = 0
+        end = len(data)
+        header = self.headers.getheader('Range')
+        if header is not None and self.path in server.range_status:
+            self.send_error(server.range_status[self.path])
+            return
+        if header is not None and header.startswith('bytes=') and self.path not in server.no_ranges:
+            first, last = header[6:].split('-')
+            start = int(first)
+            if last != '':
+                end = min(int(last) + 1, end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end - 1) + '/' + str(len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', '"' + str(hash(data)) + '"')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        drop = server.drop.pop(self.path, None)
+        if drop is not None:
+            self.wfile.write(data[start:min(start + drop, end)])
+            self.wfile.flush()
+            self.close_connection = 1
+            return
+        self.wfile.write(data[start:end])
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,78 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os, shutil, tempfile, unittest
+
+from fixtures import fastq_records, write_bgzf
+
+from compression import open_input
+from fastqindex import fastqindex
+
+
+class bgzfRangeTest(unittest.TestCase):
+    """
+    Reading ranges of a BGZF file by the virtual offsets in its index
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = ''.join(fastq_records(500))
+        self.plain_file = os.path.join(self.tmp_dir, 'reads.fastq')
+        self.bgzf_file = os.path.join(self.tmp_dir, 'reads.fastq.gz')
+        with open(self.plain_file, 'w') as f_out:
+            f_out.write(self.data)
+        write_bgzf(self.bgzf_file, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_range(self, file_name, start, end):
+        f_in = open_input(file_name, threads=2, start=start, end=end)
+        try:
+            return ''.join(iter(lambda: f_in.read(1000), ''))
+        finally:
+            f_in.close()
+
+    def test_index_ranges(self):
+        """
+        Every range between consecutive index entries has the same bytes as
+        the plain file, including ranges that start and end in one block
+        """
+        bgzf_index = fastqindex(self.bgzf_file, 10)
+        bgzf_index.build()
+        plain_index = fastqindex(self.plain_file, 10)
+        plain_index.build()
+
+        self.assertTrue(bgzf_index.bgzf)
+        self.assertEqual(len(bgzf_index.offsets), len(plain_index.offsets))
+        self.assertTrue(len(set([offset >> 16 for offset in bgzf_index.offsets])) > 1)
+
+        bgzf_ranges = bgzf_index.getRanges(10)
+        plain_ranges = plain_index.getRanges(10)
+        same_block = 0
+        for (start, end), (plain_start, plain_end) in zip(bgzf_ranges, plain_ranges):
+            if end is not None and start >> 16 == end >> 16:
+                same_block += 1
+            expected = self.data[plain_start:plain_end]
+            self.assertEqual(self.read_range(self.bgzf_file, start, end), expected)
+        self.assertTrue(same_block > 0)
+
+    def test_whole_file(self):
+        self.assertEqual(self.read_range(self.bgzf_file, 0, None), self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib, os, random, shutil, tempfile, unittest
+
+from fixtures import fileserver
+
+from filecache import filecache
+
+# common exits if pysam cannot be imported
+try :
+    import pysam
+except ImportError :
+    pysam = None
+
+if pysam is not None:
+    import common
+
+
+@unittest.skipIf(pysam is None, "common needs pysam")
+class downloadFileTest(unittest.TestCase):
+    """
+    Segmented and single stream downloads from a local file server
+    """
+
+    def setUp(self):
+        self.constants = (common.DOWNLOAD_BACKOFF, common.SEGMENT_MIN_SIZE)
+        common.DOWNLOAD_BACKOFF = 0
+        common.SEGMENT_MIN_SIZE = 10000
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = fileserver()
+        self.cf = common.common()
+
+        rand = random.Random(1)
+        self.data = ''.join([chr(rand.randint(0, 255)) for i in range(50000)])
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.server.files['/file.bin'] = self.data
+        self.url = self.server.url('/file.bin')
+        self.file_location = os.path.join(self.tmp_dir, 'file.bin')
+
+    def tearDown(self):
+        common.DOWNLOAD_BACKOFF, common.SEGMENT_MIN_SIZE = self.constants
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def check_download(self):
+        with open(self.file_location, 'rb') as f_in:
+            self.assertEqual(f_in.read(), self.data)
+        self.assertFalse(os.path.isfile(self.file_location + common.DOWNLOAD_STATE_SUFFIX))
+
+    def test_segments(self):
+        self.server.drop['/file.bin'] = 1000
+        self.assertTrue(self.cf.download_file(self.file_location, self.url, md5=self.md5))
+        self.check_download()
+        self.assertTrue(self.server.requests['/file.bin'] > 4)
+
+    def test_range_probe_refused(self):
+        """
+        A server that refuses range requests is downloaded in one stream
+        """
+        self.server.range_status['/file.bin'] = 403
+        self.assertTrue(self.cf.download_file(self.file_location, self.url, md5=self.md5))
+        self.check_download()
+
+    def test_empty_file(self):
+        self.server.files['/empty.bin'] = ''
+        self.server.range_status['/empty.bin'] = 416
+        self.assertTrue(self.cf.download_file(self.file_location, self.server.url('/empty.bin'), md5=hashlib.md5('').hexdigest()))
+        self.assertEqual(os.path.getsize(self.file_location), 0)
+
+    def test_ranges_dropped(self):
+        """
+        Segments left in the sidecar are dropped if the server no longer
+        takes range requests
+        """
+        state = common.downloadstate(self.file_location, self.url)
+        state.size = len(self.data)
+        state.segments = [[0, 100, 25000], [25000, 25000, 50000]]
+        state.save()
+        with open(self.file_location, 'wb') as f_out:
+            f_out.write(self.data[:100])
+            f_out.truncate(len(self.data))
+
+        self.server.no_ranges.add('/file.bin')
+        self.assertTrue(self.cf.download_file(self.file_location, self.url, md5=self.md5))
+        self.check_download()
+
+    def test_cache_changed_file(self):
+        """
+        A cached file without a checksum is downloaded again once it has
+        changed on the server
+        """
+        cf = common.common(cache=filecache(os.path.join(self.tmp_dir, 'cache')))
+        self.assertTrue(cf.fetch(self.file_location, self.url))
+        self.assertTrue(cf.fetch(self.file_location, self.url))
+        self.check_download()
+
+        self.data = self.data[::-1]
+        self.server.files['/file.bin'] = self.data
+        requests = self.server.requests['/file.bin']
+        self.assertTrue(cf.fetch(self.file_location, self.url))
+        self.check_download()
+        self.assertTrue(self.server.requests['/file.bin'] > requests + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import shutil, tempfile, unittest, urllib2
+
+from fixtures import fileserver
+
+import enametadata
+
+FILEREPORT = 'study_accession\trun_accession\tfastq_ftp\tfastq_md5\nPRJ1\t{accession}\tftp.example.org/{accession}_1.fastq.gz;ftp.example.org/{accession}_2.fastq.gz\tabc;def\n'
+
+
+class enametadataTest(unittest.TestCase):
+    """
+    Fetching and caching the ENA reports from a fake server
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = fileserver()
+        self.filereport_url = enametadata.FILEREPORT_URL
+        enametadata.FILEREPORT_URL = self.server.url('/filereport?accession={accession}&fields={fields}')
+        self.meta = enametadata.enametadata(self.tmp_dir)
+
+    def tearDown(self):
+        enametadata.FILEREPORT_URL = self.filereport_url
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def serve(self, accession, text):
+        """
+        Serve text as the filereport for an accession
+
+        Returns
+        -------
+        str
+            The path of the report on the server
+        """
+        path = self.meta.filereportURL(accession)[len(self.server.url('')):]
+        self.server.files[path] = text
+        return path
+
+    def test_miss_and_hit(self):
+        path = self.serve('SRR1', FILEREPORT.format(accession='SRR1'))
+
+        runs = self.meta.filereport('SRR1')
+        self.assertEqual(runs[0]['run_accession'], 'SRR1')
+        self.assertEqual(self.server.requests[path], 1)
+
+        self.assertEqual(self.meta.filereport('SRR1'), runs)
+        self.assertEqual(self.server.requests[path], 1)
+
+        # A new process uses the copy on disk
+        meta = enametadata.enametadata(self.tmp_dir)
+        self.assertEqual(meta.filereport('SRR1'), runs)
+        self.assertEqual(self.server.requests[path], 1)
+
+    def test_expired(self):
+        path = self.serve('SRR1', FILEREPORT.format(accession='SRR1'))
+        meta = enametadata.enametadata(self.tmp_dir, 0)
+        meta.filereport('SRR1')
+        meta.filereport('SRR1')
+        self.assertEqual(self.server.requests[path], 2)
+
+    def test_bulk(self):
+        paths = [self.serve(accession, FILEREPORT.format(accession=accession)) for accession in ['SRR1', 'SRR2', 'SRR3']]
+        self.meta.filereport('SRR1')
+
+        runs = self.meta.filereports(['SRR1', 'SRR2', 'SRR3'])
+        self.assertEqual([runs[accession][0]['run_accession'] for accession in ['SRR1', 'SRR2', 'SRR3']], ['SRR1', 'SRR2', 'SRR3'])
+        self.assertEqual([self.server.requests[path] for path in paths], [1, 1, 1])
+
+    def test_empty_report(self):
+        """
+        Empty reports are only kept for the shorter TTL
+        """
+        path = self.serve('SRR1', '')
+        self.assertEqual(self.meta.filereport('SRR1'), [])
+        self.assertEqual(self.meta.filereport('SRR1'), [])
+        self.assertEqual(self.server.requests[path], 1)
+
+        self.meta.empty_ttl = 0
+        self.serve('SRR1', FILEREPORT.format(accession='SRR1'))
+        self.assertEqual(self.meta.filereport('SRR1')[0]['run_accession'], 'SRR1')
+        self.assertEqual(self.server.requests[path], 2)
+
+    def test_error_report(self):
+        """
+        Error answers are not cached
+        """
+        path = self.serve('SRR1', '<html>\n<body>Service unavailable</body>\n</html>\n')
+        self.assertRaises(IOError, self.meta.filereport, 'SRR1')
+
+        self.server.status[path] = 500
+        self.assertRaises(urllib2.HTTPError, self.meta.filereport, 'SRR1')
+
+        del self.server.status[path]
+        self.serve('SRR1', FILEREPORT.format(accession='SRR1'))
+        self.assertEqual(self.meta.filereport('SRR1')[0]['run_accession'], 'SRR1')
+        self.assertEqual(self.server.requests[path], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
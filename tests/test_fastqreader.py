@@ -0,0 +1,79 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os, random, shutil, tempfile, unittest
+
+from fixtures import fastq_records
+
+from fastqreader import fastqblockreader, fastqmmapreader
+
+
+class blankLineTest(unittest.TestCase):
+    """
+    Blank lines between the records of a FastQ file, as left by
+    concatenating files by hand
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.records = fastq_records(300) + ['@empty\n\n+\n\n'] + fastq_records(5, 'last')
+        rand = random.Random(4)
+        text = '\n'
+        for record in self.records:
+            text += record + '\n' * rand.choice([0, 0, 0, 1, 2])
+        self.file_name = os.path.join(self.tmp_dir, 'reads.fastq')
+        with open(self.file_name, 'w') as f_out:
+            f_out.write(text + '\n\n')
+        self.expected = [tuple(record.split('\n')[:4]) for record in self.records]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_records(self, reader):
+        records = []
+        while True:
+            record = reader.nextRecord()
+            if record == False:
+                return records
+            records.append(tuple([str(line) for line in record]))
+
+    def read_batches(self, reader, count):
+        records = []
+        while True:
+            batch = reader.nextBatch(count)
+            records.extend(zip(*[[str(line) for line in batch[key]] for key in ['id', 'seq', 'add', 'score']]))
+            if len(batch['id']) < count:
+                return records
+
+    def test_block_reader(self):
+        for block_size in [100, 1000, 1 << 20]:
+            with open(self.file_name, 'r') as f_in:
+                self.assertEqual(self.read_records(fastqblockreader(f_in, block_size)), self.expected)
+            with open(self.file_name, 'r') as f_in:
+                self.assertEqual(self.read_batches(fastqblockreader(f_in, block_size), 7), self.expected)
+
+    def test_mmap_reader(self):
+        reader = fastqmmapreader(self.file_name)
+        self.assertEqual(self.read_records(reader), self.expected)
+        reader.close()
+
+        reader = fastqmmapreader(self.file_name)
+        self.assertEqual(self.read_batches(reader, 7), self.expected)
+        reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
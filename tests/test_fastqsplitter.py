@@ -0,0 +1,130 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os, random, shutil, tempfile, unittest
+
+from StringIO import StringIO
+
+from fixtures import fastq_records, write_bgzf
+
+import fastqsplitter
+
+
+def lossy_split_range(params):
+    """
+    split_range() for a worker that loses the last pair of its range
+    """
+    in_file1, in_file2, range1, range2 = params[:4]
+    if range1[1] is None:
+        return split_range(params)
+    result = list(split_range(params))
+    result[5] -= 1
+    return tuple(result)
+
+split_range = fastqsplitter.split_range
+
+
+class splitParallelTest(unittest.TestCase):
+    """
+    Splitting BGZF files in parallel over the ranges of their indexes
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.records1 = fastq_records(2000, 'pair', 1)
+        self.records2 = fastq_records(2000, 'pair', 2)
+        self.in_file1 = os.path.join(self.tmp_dir, 'reads_1.fastq.gz')
+        self.in_file2 = os.path.join(self.tmp_dir, 'reads_2.fastq.gz')
+        write_bgzf(self.in_file1, ''.join(self.records1))
+        write_bgzf(self.in_file2, ''.join(self.records2))
+        os.mkdir(os.path.join(self.tmp_dir, 'tmp'))
+
+    def tearDown(self):
+        fastqsplitter.split_range = split_range
+        shutil.rmtree(self.tmp_dir)
+
+    def read_shards(self, files_out, side):
+        data = ''
+        for files in files_out:
+            with open(files[side], 'r') as f_in:
+                data += f_in.read()
+        return data
+
+    def test_split_parallel(self):
+        """
+        Every pair is written once, in order
+        """
+        splitter = fastqsplitter.fastqsplitter(self.in_file1, self.in_file2, 'test', reads_per_shard=100, processes=2)
+        files_out = splitter.splitParallel()
+        self.assertEqual(len(files_out), 20)
+        self.assertEqual(self.read_shards(files_out, 0), ''.join(self.records1))
+        self.assertEqual(self.read_shards(files_out, 1), ''.join(self.records2))
+
+    def test_missing_pairs(self):
+        """
+        Ranges that do not add up to the index are split serially instead
+        """
+        fastqsplitter.split_range = lossy_split_range
+        splitter = fastqsplitter.fastqsplitter(self.in_file1, self.in_file2, 'test', reads_per_shard=100, processes=2)
+        self.assertEqual(splitter.splitParallel(), None)
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'tmp')), [])
+
+        files_out = splitter.split()
+        self.assertEqual(self.read_shards(files_out, 0), ''.join(self.records1))
+        self.assertEqual(self.read_shards(files_out, 1), ''.join(self.records2))
+
+
+class splitStreamsTest(unittest.TestCase):
+    """
+    Splitting streams, where the files they are named after do not exist
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'tmp'))
+        self.in_file1 = os.path.join(self.tmp_dir, 'reads_1.fastq.gz')
+        self.in_file2 = os.path.join(self.tmp_dir, 'reads_2.fastq.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_out_of_order(self):
+        """
+        Mates that are out of order are paired by the hash join
+        """
+        records1 = fastq_records(500, 'pair', 1)
+        records2 = fastq_records(500, 'pair', 2)
+        shuffled = records2[:100] + random.Random(3).sample(records2[100:], 400)
+
+        splitter = fastqsplitter.fastqsplitter(self.in_file1, self.in_file2, 'test', reads_per_shard=100)
+        files_out = splitter.splitStreams(StringIO(''.join(records1)), StringIO(''.join(shuffled)))
+
+        pairs = {}
+        for files in files_out:
+            with open(files[0], 'r') as f_in1:
+                with open(files[1], 'r') as f_in2:
+                    lines1 = f_in1.read().splitlines(True)
+                    lines2 = f_in2.read().splitlines(True)
+            self.assertEqual(len(lines1), len(lines2))
+            for i in range(0, len(lines1), 4):
+                self.assertEqual(lines1[i], lines2[i])
+                pairs[lines1[i]] = (''.join(lines1[i:i + 4]), ''.join(lines2[i:i + 4]))
+
+        self.assertEqual(sorted(pairs.values()), sorted(zip(records1, records2)))
+
+
+if __name__ == "__main__":
+    unittest.main()
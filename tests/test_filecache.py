@@ -0,0 +1,86 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os, shutil, tempfile, unittest
+
+import fixtures
+
+from filecache import filecache
+
+
+class filecacheTest(unittest.TestCase):
+    """
+    Reuse of the files in the cache
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = filecache(os.path.join(self.tmp_dir, 'cache'))
+        self.file_location = os.path.join(self.tmp_dir, 'genome.fa.gz')
+        self.content = 'v1'
+        self.downloads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, location, url, checksum):
+        self.downloads += 1
+        with open(location, 'w') as f_out:
+            f_out.write(self.content)
+        return True
+
+    def fetch(self, checksum = None, validator = None):
+        self.assertTrue(self.cache.fetch(self.file_location, 'ftp://example.org/current/genome.fa.gz', self.download, checksum, validator))
+        with open(self.file_location, 'r') as f_in:
+            return f_in.read()
+
+    def test_checksum(self):
+        self.fetch('abc')
+        self.content = 'v2'
+        self.assertEqual(self.fetch('abc'), 'v1')
+        self.assertEqual(self.downloads, 1)
+
+    def test_validator(self):
+        """
+        Files without a checksum are downloaded again when the validator
+        from the server changes
+        """
+        self.fetch(validator=lambda url: 'mtime 1')
+        self.assertEqual(self.fetch(validator=lambda url: 'mtime 1'), 'v1')
+        self.assertEqual(self.downloads, 1)
+
+        self.content = 'v2'
+        self.assertEqual(self.fetch(validator=lambda url: 'mtime 2'), 'v2')
+        self.assertEqual(self.downloads, 2)
+        self.assertEqual(self.fetch(validator=lambda url: 'mtime 2'), 'v2')
+        self.assertEqual(self.downloads, 2)
+
+    def test_unchecked_ttl(self):
+        """
+        Files without a checksum or validator expire
+        """
+        self.fetch()
+        self.content = 'v2'
+        self.assertEqual(self.fetch(validator=lambda url: None), 'v1')
+        self.assertEqual(self.downloads, 1)
+
+        self.cache.unchecked_ttl = 0
+        self.assertEqual(self.fetch(), 'v2')
+        self.assertEqual(self.downloads, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import gzip, hashlib, os, random, shutil, tempfile, unittest
+
+from StringIO import StringIO
+
+from fixtures import fastq_records, fileserver
+
+from compression import threadedreader
+from fastqsplitter import fastqsplitter
+
+# common exits if pysam cannot be imported
+try :
+    import pysam
+except ImportError :
+    pysam = None
+
+if pysam is not None:
+    import common
+
+
+def gzip_data(data):
+    """
+    Compress data as a gzip file
+    """
+    buf = StringIO()
+    f_out = gzip.GzipFile(fileobj=buf, mode='wb')
+    f_out.write(data)
+    f_out.close()
+    return buf.getvalue()
+
+
+@unittest.skipIf(pysam is None, "common needs pysam")
+class urlstreamTest(unittest.TestCase):
+    """
+    Streaming FastQ files from a local file server
+    """
+
+    def setUp(self):
+        self.backoff = common.DOWNLOAD_BACKOFF
+        common.DOWNLOAD_BACKOFF = 0
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'tmp'))
+        self.server = fileserver()
+        self.cf = common.common()
+
+    def tearDown(self):
+        common.DOWNLOAD_BACKOFF = self.backoff
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def read_stream(self, stream):
+        try:
+            return ''.join(iter(lambda: stream.read(1000), ''))
+        finally:
+            stream.close()
+
+    def test_resume(self):
+        """
+        A dropped connection is resumed from the byte that it got to
+        """
+        data = gzip_data(''.join(fastq_records(500)))
+        self.server.files['/reads_1.fastq.gz'] = data
+        self.server.drop['/reads_1.fastq.gz'] = 1000
+
+        url = self.server.url('/reads_1.fastq.gz')
+        stream = common.urlstream(url, self.cf.open_stream, hashlib.md5(data).hexdigest())
+        self.assertEqual(self.read_stream(stream), data)
+        self.assertEqual(self.server.requests['/reads_1.fastq.gz'], 2)
+
+    def test_checksum(self):
+        """
+        The MD5 checksum is checked at the end of the stream
+        """
+        self.server.files['/reads_1.fastq.gz'] = gzip_data(''.join(fastq_records(10)))
+        stream = common.urlstream(self.server.url('/reads_1.fastq.gz'), self.cf.open_stream, '0' * 32)
+        self.assertRaises(IOError, self.read_stream, stream)
+
+    def test_split_streams(self):
+        """
+        Out of order mates are decompressed and split as they are streamed
+        """
+        records1 = fastq_records(500, 'pair', 1)
+        records2 = fastq_records(500, 'pair', 2)
+        shuffled = records2[:100] + random.Random(3).sample(records2[100:], 400)
+        self.server.files['/reads_1.fastq.gz'] = gzip_data(''.join(records1))
+        self.server.files['/reads_2.fastq.gz'] = gzip_data(''.join(shuffled))
+        self.server.drop['/reads_2.fastq.gz'] = 2000
+
+        streams = [threadedreader(common.urlstream(self.server.url(path), self.cf.open_stream)) for path in ['/reads_1.fastq.gz', '/reads_2.fastq.gz']]
+        try:
+            splitter = fastqsplitter(os.path.join(self.tmp_dir, 'reads_1.fastq.gz'), os.path.join(self.tmp_dir, 'reads_2.fastq.gz'), 'test', reads_per_shard=100)
+            files_out = splitter.splitStreams(streams[0], streams[1])
+        finally:
+            for stream in streams:
+                stream.close()
+
+        pairs = []
+        for files in files_out:
+            with open(files[0], 'r') as f_in1:
+                with open(files[1], 'r') as f_in2:
+                    lines1 = f_in1.read().splitlines(True)
+                    lines2 = f_in2.read().splitlines(True)
+            for i in range(0, len(lines1), 4):
+                pairs.append((''.join(lines1[i:i + 4]), ''.join(lines2[i:i + 4])))
+        self.assertEqual(sorted(pairs), sorted(zip(records1, records2)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+"""
+Copyright 2017 EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import multiprocessing, os, shlex, subprocess, time
+
+# Seconds between checks on the running tools
+POLL_INTERVAL = 0.2
+
+
+def physical_memory():
+    """
+    Get the amount of physical memory on the machine in bytes, or None if it
+    cannot be found
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return None
+
+
+class toolrunner:
+    """
+    Runs a set of external tools at the same time within a budget of cores
+    and memory. Each tool is given the number of threads and an estimate of
+    the memory that it will use. The tools are started in the order that
+    they were added as soon as there are enough free cores and memory for
+    them, with later tools that fit being started ahead of ones that do not.
+    A tool that needs more than the whole budget is run on its own.
+
+    The output of each tool is written to its log file. The wall time, peak
+    resident set size (from os.wait4) and exit code of each tool are
+    returned by run().
+    """
+
+    def __init__(self, cores = None, memory = None):
+        """
+        Initialise the runner
+
+        Parameters
+        ----------
+        cores : int
+            Number of cores the tools can use. Defaults to the number of cores
+            on the machine
+        memory : int
+            Number of bytes of memory the tools can use. Defaults to the
+            physical memory of the machine
+        """
+        if cores is None:
+            cores = multiprocessing.cpu_count()
+        if memory is None:
+            memory = physical_memory()
+
+        self.cores = cores
+        self.memory = memory
+        self.jobs = []
+
+    def add(self, name, command_line, threads = 1, memory = 0, log_file = None):
+        """
+        Add a tool to be run
+
+        Parameters
+        ----------
+        name : str
+            Name to report the tool under
+        command_line : str
+            Command line for the tool
+        threads : int
+            Number of cores the tool uses
+        memory : int
+            Estimate of the peak memory used by the tool in bytes
+        log_file : str
+            Location to write the stdout and stderr of the tool to. None to
+            leave them on the console
+        """
+        self.jobs.append({
+            'name': name,
+            'command_line': command_line,
+            'threads': threads,
+            'memory': memory,
+            'log_file': log_file
+        })
+
+    def fits(self, job, running):
+        """
+        Check if there are enough free cores and memory to start a tool
+        """
+        if len(running) == 0:
+            return True
+
+        cores_used = sum([run['job']['threads'] for run in running.values()])
+        if cores_used + job['threads'] > self.cores:
+            return False
+
+        if self.memory is not None:
+            memory_used = sum([run['job']['memory'] for run in running.values()])
+            if memory_used + job['memory'] > self.memory:
+                return False
+
+        return True
+
+    def start(self, job):
+        """
+        Start a tool with its output going to its log file
+        """
+        print "Starting " + job['name'] + ": " + job['command_line']
+
+        log = None
+        if job['log_file'] is not None:
+            log = open(job['log_file'], 'w')
+
+        args = shlex.split(job['command_line'])
+        try:
+            process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT if log is not None else None)
+        except:
+            if log is not None:
+                log.close()
+            raise
+
+        return {'job': job, 'process': process, 'log': log, 'start': time.time()}
+
+    def run(self):
+        """
+        Run all of the tools that have been added and wait for them to finish
+
+        Returns
+        -------
+        dict
+            For each tool, a dict of the returncode, wall_time (seconds),
+            max_rss (bytes), threads and log_file
+        """
+        pending = list(self.jobs)
+        running = {}
+        results = {}
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for job in list(pending):
+                    if self.fits(job, running):
+                        run = self.start(job)
+                        running[run['process'].pid] = run
+                        pending.remove(job)
+
+                finished = False
+                for pid in list(running.keys()):
+                    wait_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+                    if wait_pid == 0:
+                        continue
+
+                    run = running.pop(pid)
+                    if os.WIFSIGNALED(status):
+                        returncode = -os.WTERMSIG(status)
+                    else:
+                        returncode = os.WEXITSTATUS(status)
+
+                    # The process has been reaped, so Popen must not wait on it
+                    run['process'].returncode = returncode
+                    if run['log'] is not None:
+                        run['log'].close()
+
+                    job = run['job']
+                    results[job['name']] = {
+                        'returncode': returncode,
+                        'wall_time': time.time() - run['start'],
+                        'max_rss': rusage.ru_maxrss * 1024,
+                        'threads': job['threads'],
+                        'log_file': job['log_file']
+                    }
+                    finished = True
+
+                if finished == False:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            for run in running.values():
+                run['process'].kill()
+                run['process'].wait()
+                if run['log'] is not None:
+                    run['log'].close()
+
+        self.jobs = []
+        return results